@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+Bench.py
+Load generator for Server.py. Opens several connections at once, sends a number of messages on
+each one, and reports throughput and latency for each step of the SMTP conversation. With
+--versus, the same load is also sent to a second address (for example loopback TCP against a
+Unix domain socket) and the two are compared. Connections come from an SMTPConnectionPool. Each
+one ends with QUIT after its messages, unless --reuse keeps them open for the next of --rounds.
+"""
+
+import argparse
+import json
+import math
+import sys
+import threading
+import time
+from Client import SMTPConnectionPool, Parser, DebugMode, UNIX_ADDRESS_PREFIX, parse_target, describe_target
+
+PHASES = ["connect", "220", "HELO", "reuse", "MAIL", "RCPT", "DATA", "end-of-data", "RSET", "QUIT"]
+"""
+The steps of the SMTP conversation that are timed, in the order they happen. "reuse" is getting
+a session that was already open from the pool (--reuse), which checks it with NOOP.
+"""
+
+
+def percentile(sorted_samples: list, percent: float) -> float:
+    """
+    Returns the nearest-rank percentile of a list that is already sorted.
+    """
+
+    if not sorted_samples:
+        return 0.0
+
+    rank = max(1, math.ceil(percent / 100 * len(sorted_samples)))
+    return sorted_samples[rank - 1]
+
+
+def summarize(samples: list) -> dict:
+    """
+    Returns the count, mean, p50, p95, p99 and max of a list of durations in seconds, with the
+    durations converted to milliseconds.
+    """
+
+    sorted_samples = sorted(samples)
+
+    if not sorted_samples:
+        return {"count": 0, "mean_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+
+    return {
+        "count": len(sorted_samples),
+        "mean_ms": sum(sorted_samples) / len(sorted_samples) * 1000,
+        "p50_ms": percentile(sorted_samples, 50) * 1000,
+        "p95_ms": percentile(sorted_samples, 95) * 1000,
+        "p99_ms": percentile(sorted_samples, 99) * 1000,
+        "max_ms": sorted_samples[-1] * 1000,
+    }
+
+
+def build_body(body_size: int) -> list:
+    """
+    Returns lines of printable text that add up to roughly body_size bytes.
+    """
+
+    line = "The quick brown fox jumps over the lazy dog; SMTP load generator text line."
+    lines = [line] * (body_size // (len(line) + 1))
+
+    remainder = body_size - len(lines) * (len(line) + 1)
+    if remainder > 0:
+        lines.append(line[:remainder])
+
+    return lines
+
+
+def run_session(args, pool: SMTPConnectionPool, target: tuple, connection_no: int, results: dict, keep_open: bool = False):
+    """
+    Gets a session to target (hostname, port_number) from the pool, sends args.messages messages
+    on it, and ends it with QUIT, or gives it back to the pool if keep_open. Records how long each
+    step took in results. Each thread has its own results dictionary, so no locking is needed.
+    """
+
+    bufsize = 1024
+    body_lines = build_body(args.body_size)
+    timings = results["phases"]
+
+    try:
+        start = time.perf_counter()
+        session = pool.acquire(*target, timings=timings)
+        if session.uses > 1:
+            timings["reuse"].append(time.perf_counter() - start)
+    except (SystemExit, OSError, ValueError) as e:
+        DebugMode.print(args.debug, f"connection #{connection_no}: {e}", DebugMode.ERROR)
+        results["exceptions"][type(e).__name__] = results["exceptions"].get(type(e).__name__, 0) + 1
+        results["failed_sessions"] += 1
+        return
+
+    smtp_client = session.smtp_client
+    sent_before, rejected_before = smtp_client.messages_sent, smtp_client.messages_failed
+
+    for message_no in range(args.messages):
+        to_addresses = [f"user{connection_no}x{i}@d{i}.bench.test" for i in range(args.recipients)]
+        smtp_client.queue_message(f"bench{connection_no}@bench.test", to_addresses, f"bench {connection_no} {message_no}", body_lines)
+
+    smtp_client.begin_next_message()
+    phase_start = None
+    broken = False
+
+    try:
+        while smtp_client.get_state() != smtp_client.EXPECTING_NEXT_MESSAGE:
+            # The body of a message takes several calls to evaluate_state() before there is a
+            # response, so the step starts with the first of them.
+            if phase_start is None:
+                phase_start = time.perf_counter()
+
+            if not smtp_client.evaluate_state():
+                continue
+
+            phase = smtp_client.get_waiting_step()
+            data = session.client_socket.recv(bufsize).decode()
+
+            if not data:
+                raise ConnectionResetError("the server closed the connection")
+
+            smtp_client.set_parser(current_parser=Parser(input_string=data, debug_mode=args.debug))
+
+            # Error codes still end the step; they are counted separately.
+            if smtp_client.parser.is_error_smtp_response_code():
+                results["error_codes"][data[:3]] = results["error_codes"].get(data[:3], 0) + 1
+
+            smtp_client.evaluate_response()
+
+            timings[phase].append(time.perf_counter() - phase_start)
+            phase_start = None
+
+    except (SystemExit, OSError, ValueError) as e:
+        DebugMode.print(args.debug, f"connection #{connection_no}: {e}", DebugMode.ERROR)
+        results["exceptions"][type(e).__name__] = results["exceptions"].get(type(e).__name__, 0) + 1
+        results["failed_sessions"] += 1
+        broken = True
+
+    results["messages_sent"] += smtp_client.messages_sent - sent_before
+    results["messages_rejected"] += smtp_client.messages_failed - rejected_before
+
+    if broken or keep_open:
+        pool.release(session, broken)
+    else:
+        # Server.py serves one connection at a time, so the next connection waits for this QUIT
+        pool.discard(session, timings=timings)
+
+
+def new_results() -> dict:
+    """
+    Returns an empty results dictionary for one connection.
+    """
+
+    return {
+        "phases": {phase: [] for phase in PHASES},
+        "error_codes": {},
+        "exceptions": {},
+        "failed_sessions": 0,
+        "messages_sent": 0,
+        "messages_rejected": 0,
+    }
+
+
+def merge_results(all_results: list) -> dict:
+    """
+    Combines the results of every connection into one dictionary.
+    """
+
+    merged = new_results()
+
+    for results in all_results:
+        for phase in PHASES:
+            merged["phases"][phase].extend(results["phases"][phase])
+        for key in ["error_codes", "exceptions"]:
+            for name, count in results[key].items():
+                merged[key][name] = merged[key].get(name, 0) + count
+        for key in ["failed_sessions", "messages_sent", "messages_rejected"]:
+            merged[key] += results[key]
+
+    return merged
+
+
+def get_command_line_arguments():
+    """
+    Handles command line arguments for the server to connect to and the size of the load.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Load generator and throughput benchmark for Server.py")
+
+    arg_parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="Enable additional logging that is helpful for debugging without modifying code."
+    )
+
+    arg_parser.add_argument("hostname", action="store",
+                            help="hostname of the SMTP server to connect to, or unix:/path for a Unix domain socket")
+    arg_parser.add_argument("port_number", action="store", nargs="?", default=None, type=int,
+                            help="Port number of the SMTP server to connect to (not used with unix:/path)")
+
+    arg_parser.add_argument("-c", "--connections", action="store", default=1, type=int,
+                            help="Number of connections open at the same time")
+    arg_parser.add_argument("-m", "--messages", action="store", default=100, type=int,
+                            help="Number of messages sent on each connection")
+    arg_parser.add_argument("-r", "--recipients", action="store", default=1, type=int,
+                            help="Number of RCPT TO commands per message")
+    arg_parser.add_argument("-b", "--body-size", action="store", default=512, type=int,
+                            help="Approximate size of each message body in bytes")
+    arg_parser.add_argument("-o", "--output", action="store", default=None,
+                            help="Write the results as JSON to this file instead of standard out")
+    arg_parser.add_argument("--versus", action="store", default=None, metavar="ADDRESS",
+                            help="Run the same load against a second address (unix:/path or host:port) and compare")
+    arg_parser.add_argument("--rounds", action="store", default=1, type=int,
+                            help="Run the load this many times")
+    arg_parser.add_argument("--reuse", action="store_true",
+                            help="Keep the connections open between --rounds and reuse them from the pool instead of "
+                                 "ending each with QUIT. With -c above 1, the server has to serve connections at the same "
+                                 "time, which Server.py does not")
+
+    args = arg_parser.parse_args()
+
+    if args.port_number is None and not args.hostname.startswith(UNIX_ADDRESS_PREFIX):
+        arg_parser.error(f"port_number is required unless the hostname is {UNIX_ADDRESS_PREFIX}/path")
+
+    return args
+
+
+def run_load(args, target: tuple) -> dict:
+    """
+    Starts one thread per connection to target, waits for all of them (args.rounds times), and
+    returns the report. With --reuse, the connections stay open until the last round.
+    """
+
+    pool = SMTPConnectionPool(size=args.connections, max_idle_seconds=3600.0,
+                              max_messages=args.messages * args.rounds + 1, debug_mode=args.debug)
+    all_results = [new_results() for _ in range(args.connections)]
+
+    start = time.perf_counter()
+    for round_no in range(args.rounds):
+        keep_open = args.reuse and round_no < args.rounds - 1
+        threads = [
+            threading.Thread(target=run_session, args=(args, pool, target, connection_no, all_results[connection_no], keep_open))
+            for connection_no in range(args.connections)
+        ]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+
+    pool_stats = pool.to_dict()
+    pool.close_all()
+
+    merged = merge_results(all_results)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            "target": describe_target(target),
+            "connections": args.connections,
+            "rounds": args.rounds,
+            "reuse": args.reuse,
+            "messages_per_connection": args.messages,
+            "recipients": args.recipients,
+            "body_size": args.body_size,
+        },
+        "elapsed_s": elapsed,
+        "messages_sent": merged["messages_sent"],
+        "messages_per_second": merged["messages_sent"] / elapsed if elapsed > 0 else 0.0,
+        "phases": {phase: summarize(samples) for phase, samples in merged["phases"].items() if samples},
+        "pool": pool_stats,
+        "errors": {
+            "messages_rejected": merged["messages_rejected"],
+            "failed_sessions": merged["failed_sessions"],
+            "error_codes": merged["error_codes"],
+            "exceptions": merged["exceptions"],
+        },
+    }
+
+    print(f"{report['config']['target']}: {report['messages_sent']} message(s) in {elapsed:.3f}s: "
+          f"{report['messages_per_second']:.1f} messages/second", file=sys.stderr)
+    for phase, summary in report["phases"].items():
+        print(f"  {phase:<12} n={summary['count']:<7} p50={summary['p50_ms']:.3f}ms p95={summary['p95_ms']:.3f}ms "
+              f"p99={summary['p99_ms']:.3f}ms max={summary['max_ms']:.3f}ms", file=sys.stderr)
+
+    return report
+
+
+def compare_reports(first: dict, second: dict):
+    """
+    Prints the p50 and p99 of each step for both targets side by side, with the second as a
+    fraction of the first.
+    """
+
+    print(f"{first['config']['target']} -> {second['config']['target']}", file=sys.stderr)
+    for phase, summary in first["phases"].items():
+        other = second["phases"].get(phase)
+        if other is None:
+            continue
+
+        ratios = [other[key] / summary[key] if summary[key] else 0.0 for key in ["p50_ms", "p99_ms"]]
+        print(f"  {phase:<12} p50 {summary['p50_ms']:.3f} -> {other['p50_ms']:.3f}ms ({ratios[0]:.0%})  "
+              f"p99 {summary['p99_ms']:.3f} -> {other['p99_ms']:.3f}ms ({ratios[1]:.0%})", file=sys.stderr)
+
+    rate_ratio = second["messages_per_second"] / first["messages_per_second"] if first["messages_per_second"] else 0.0
+    print(f"  {'messages/s':<12} {first['messages_per_second']:.1f} -> {second['messages_per_second']:.1f} "
+          f"({rate_ratio:.2f}x)", file=sys.stderr)
+
+
+def main():
+    """
+    Runs the load against the server (and the --versus address, if given), then reports the
+    results.
+    """
+
+    args = get_command_line_arguments()
+
+    if args.connections < 1 or args.messages < 1 or args.recipients < 1 or args.rounds < 1:
+        print("--connections, --messages, --recipients and --rounds must all be at least 1.")
+        sys.exit(1)
+
+    report = run_load(args, (args.hostname, args.port_number))
+
+    if args.versus:
+        report = {"runs": [report, run_load(args, parse_target(args.versus))]}
+        compare_reports(*report["runs"])
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
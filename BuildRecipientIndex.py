@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+BuildRecipientIndex.py
+Builds the file for Server.py --recipient-index from a list of addresses, one per line. The list
+can have tens of millions of addresses: they are split into partition files on disk and only one
+partition is in memory at a time, along with the Bloom filter and the bucket offsets.
+
+The file is the header (RECIPIENT_INDEX_HEADER in Server.py), the Bloom filter, (buckets + 1)
+64-bit offsets, and then the addresses, one per line, grouped by bucket (h1 % buckets). An
+address is in bucket b if it is between offsets b and b + 1 of the address data.
+"""
+
+import argparse
+import math
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from array import array
+from pathlib import Path
+from Server import RECIPIENT_INDEX_MAGIC, RECIPIENT_INDEX_HEADER, RecipientIndex, get_recipient_hashes
+
+PARTITIONS = 256
+"""
+How many partition files the addresses are split into while building. Each one only needs to
+fit in memory on its own.
+"""
+
+
+def read_addresses(path: Path):
+    """
+    Yields the casefolded addresses in path, skipping blank lines and lines that start with "#".
+    """
+
+    with path.open(mode="r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            address = line.strip().casefold()
+            if address and not address.startswith("#"):
+                yield address
+
+
+def build_recipient_index(input_path: Path, output_path: Path, bits_per_address: float = 10.0, bucket_size: int = 8) -> dict:
+    """
+    Writes the index for the addresses in input_path to output_path and returns its sizes. The
+    file is written under a temporary name and renamed at the end, so a running server that
+    reloads on SIGHUP never sees a partial file.
+    """
+
+    # First pass: the number of addresses decides the size of everything else
+    count = sum(1 for _ in read_addresses(input_path))
+
+    bloom_bits = max(64, int(count * bits_per_address))
+    # k = (m / n) ln 2 gives the fewest false positives for a filter of m bits and n addresses
+    bloom_hashes = max(1, round(bits_per_address * math.log(2)))
+    buckets = max(1, count // bucket_size)
+
+    bloom = bytearray((bloom_bits + 7) // 8)
+    bucket_lengths = array("Q", bytes(8 * buckets))
+    unique = 0
+
+    with tempfile.TemporaryDirectory(dir=output_path.parent) as work_folder:
+        work_folder = Path(work_folder)
+
+        # Second pass: set the Bloom filter bits and send each address to the partition of its
+        # bucket
+        partition_files = [(work_folder / f"partition{number}").open("w", encoding="utf-8") for number in range(PARTITIONS)]
+        try:
+            for address in read_addresses(input_path):
+                h1, h2 = get_recipient_hashes(address)
+                for i in range(bloom_hashes):
+                    bit = (h1 + i * h2) % bloom_bits
+                    bloom[bit >> 3] |= 1 << (bit & 7)
+
+                bucket = h1 % buckets
+                partition_files[bucket * PARTITIONS // buckets].write(f"{bucket} {address}\n")
+        finally:
+            for f in partition_files:
+                f.close()
+
+        # Each partition covers a range of buckets, so writing them in order writes the buckets in
+        # order
+        data_path = work_folder / "data"
+        with data_path.open("wb") as data_file:
+            for number in range(PARTITIONS):
+                partition_path = work_folder / f"partition{number}"
+                with partition_path.open("r", encoding="utf-8") as f:
+                    records = sorted(set((int(bucket), address) for bucket, address in (line.rstrip("\n").split(" ", 1) for line in f)))
+                partition_path.unlink()
+
+                for bucket, address in records:
+                    line = address.encode() + b"\n"
+                    data_file.write(line)
+                    bucket_lengths[bucket] += len(line)
+
+                unique += len(records)
+
+        offsets = array("Q", [0])
+        for length in bucket_lengths:
+            offsets.append(offsets[-1] + length)
+
+        temporary_path = output_path.with_name(output_path.name + ".tmp")
+        with temporary_path.open("wb") as f:
+            f.write(RECIPIENT_INDEX_HEADER.pack(RECIPIENT_INDEX_MAGIC, unique, bloom_bits, bloom_hashes, buckets))
+            f.write(bloom)
+            if sys.byteorder != "little":
+                offsets.byteswap()
+            f.write(offsets.tobytes())
+            with data_path.open("rb") as data_file:
+                shutil.copyfileobj(data_file, f)
+
+        os.replace(temporary_path, output_path)
+
+    return {"addresses": unique, "bloom_bits": bloom_bits, "bloom_hashes": bloom_hashes, "buckets": buckets,
+            "bytes": output_path.stat().st_size}
+
+
+def generate_addresses(path: Path, count: int):
+    """
+    Writes count made-up addresses to path, for trying the index out.
+    """
+
+    with path.open(mode="w", encoding="utf-8") as f:
+        for i in range(count):
+            f.write(f"user{i}@host{i % 997}.example{i % 13}.com\n")
+
+
+def check_index(index_path: Path, input_path: Path, samples: int) -> dict:
+    """
+    Looks up samples addresses from the list and samples addresses that are not on it, and returns
+    the lookup times and the false positive rate.
+    """
+
+    index = RecipientIndex(index_path)
+
+    # Reservoir sampling, so the list does not have to fit in memory
+    known = []
+    for number, address in enumerate(read_addresses(input_path)):
+        if number < samples:
+            known.append(address)
+        elif (slot := random.randrange(number + 1)) < samples:
+            known[slot] = address
+
+    unknown = [f"nobody{i}-{random.getrandbits(32)}@nowhere.example" for i in range(samples)]
+
+    results = {}
+    for name, addresses, expected in [("known", known, True), ("unknown", unknown, False)]:
+        times_us = []
+        wrong = 0
+        for address in addresses:
+            start = time.perf_counter_ns()
+            found = index.contains(address)
+            times_us.append((time.perf_counter_ns() - start) / 1000)
+            wrong += found != expected
+
+        times_us.sort()
+        results[name] = {
+            "lookups": len(addresses),
+            "wrong": wrong,
+            "median_us": statistics.median(times_us),
+            "p99_us": times_us[int(len(times_us) * 0.99)],
+        }
+
+    results["index"] = index.to_dict()
+    results["bloom_false_positive_rate"] = index.false_positives / samples
+    return results
+
+
+def get_command_line_arguments():
+    """
+    Handles the input list, the output file and the sizing options.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Build the recipient allowlist index for Server.py --recipient-index")
+
+    arg_parser.add_argument("input", action="store", type=Path, help="Text file with one address per line")
+    arg_parser.add_argument("output", action="store", type=Path, help="Index file to write")
+    arg_parser.add_argument("--bits-per-address", action="store", type=float, default=10.0,
+                            help="Size of the Bloom filter; 10 bits gives about 1%% false positives")
+    arg_parser.add_argument("--bucket-size", action="store", type=int, default=8,
+                            help="Average number of addresses per bucket of the exact list")
+    arg_parser.add_argument("--generate", action="store", type=int, default=0, metavar="COUNT",
+                            help="First write COUNT made-up addresses to the input file")
+    arg_parser.add_argument("--check", action="store", type=int, default=0, metavar="SAMPLES",
+                            help="Afterwards, time SAMPLES lookups of known and of unknown addresses")
+
+    args = arg_parser.parse_args()
+
+    if args.bits_per_address <= 0 or args.bucket_size < 1:
+        arg_parser.error("--bits-per-address and --bucket-size must be positive")
+
+    return args
+
+
+def main():
+    """
+    Builds the index and optionally checks it.
+    """
+
+    args = get_command_line_arguments()
+
+    if args.generate:
+        generate_addresses(args.input, args.generate)
+
+    if not args.input.is_file():
+        print(f"The address list {args.input} does not exist.")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    sizes = build_recipient_index(args.input, args.output, args.bits_per_address, args.bucket_size)
+    print(f"Wrote {args.output}: {sizes['addresses']} address(es), {sizes['bytes'] / 1_000_000:.1f} MB, "
+          f"{sizes['bloom_bits']} Bloom bits with {sizes['bloom_hashes']} hashes, {sizes['buckets']} buckets, "
+          f"in {time.perf_counter() - start:.1f}s")
+
+    if args.check:
+        results = check_index(args.output, args.input, args.check)
+        for name in ["known", "unknown"]:
+            print(f"  {name:<8} median={results[name]['median_us']:.2f}us p99={results[name]['p99_us']:.2f}us "
+                  f"wrong={results[name]['wrong']}")
+        print(f"  Bloom filter false positive rate: {results['bloom_false_positive_rate']:.2%}")
+
+
+if __name__ == "__main__":
+    main()
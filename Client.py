@@ -7,8 +7,19 @@ Client.py
 """
 
 import argparse
+import asyncio
+import io
+import json
+import lzma
+import mmap
 import socket
+import struct
 import sys
+import threading
+import time
+import zlib
+from collections import deque
+from pathlib import Path
 # from Parser import Parser, ParserError, DebugMode, socket_is_connected, socket_send_msg, get_hostname, close_socket
 
 def socket_is_connected(connection_socket: socket.socket, debug_mode: bool = False) -> bool:
@@ -334,6 +345,16 @@ class Parser:
             self.rewind(start)
             return True
 
+        self.reset()
+        if self.rset_cmd(check_only=True):
+            self.rewind(start)
+            return True
+
+        self.reset()
+        if self.noop_cmd(check_only=True):
+            self.rewind(start)
+            return True
+
         # This means no commands have been identified, which can mean a number of things but not
         # necessarily a problem (depending on the state of the SMTP Server)
         self.rewind(start)
@@ -545,7 +566,7 @@ class Parser:
         """
 
         start = self.position
-        codes = ["220", "221", "250", "354", "500", "501", "503"]
+        codes = ["220", "221", "250", "354", "500", "501", "503", "550"]
 
         for code in codes:
             if self.match_chars(code):
@@ -754,9 +775,11 @@ class Parser:
 
         <data-cmd> ::= "DATA" <nullspace> <CRLF>
         <quit-cmd> ::= "QUIT" <nullspace> <CRLF>
+        <rset-cmd> ::= "RSET" <nullspace> <CRLF>
+        <noop-cmd> ::= "NOOP" <nullspace> <CRLF>
         """
 
-        allowed_cmds = ["QUIT", "DATA"]
+        allowed_cmds = ["QUIT", "DATA", "RSET", "NOOP"]
 
         if not cmd_name or not isinstance(cmd_name, str) or not cmd_name in allowed_cmds:
             raise ValueError(f"word_only_commands(); must specify a valid command string literal ({','.join(allowed_cmds)})")
@@ -807,6 +830,28 @@ class Parser:
         DebugMode.print(self.debug_mode, "reached data_cmd()")
         return self.word_only_commands("DATA", check_only=check_only)
 
+    def rset_cmd(self, check_only: bool = False) -> bool:
+        """
+        The <rset-cmd> non-terminal handles the "RSET" command, which abandons the current email
+        message without closing the connection.
+
+        <rset-cmd> ::= "RSET" <nullspace> <CRLF>
+        """
+
+        DebugMode.print(self.debug_mode, "reached rset_cmd()")
+        return self.word_only_commands("RSET", check_only=check_only)
+
+    def noop_cmd(self, check_only: bool = False) -> bool:
+        """
+        The <noop-cmd> non-terminal handles the "NOOP" command, which does nothing other than get
+        a 250 from the server. Useful for checking that a connection is still alive.
+
+        <noop-cmd> ::= "NOOP" <nullspace> <CRLF>
+        """
+
+        DebugMode.print(self.debug_mode, "reached noop_cmd()")
+        return self.word_only_commands("NOOP", check_only=check_only)
+
     def data_read_msg_line(self):
         """
         Handles the reading of mail input lines after a successful DATA command.
@@ -1368,6 +1413,23 @@ class SMTPClientSide:
     the SMTP QUIT command.
     """
 
+    EXPECTING_RSET_RESPONSE = 11
+    """
+    The server sent an error in the middle of a message, and there are more messages waiting to
+    be sent. RSET throws away the failed message so that the next one can use the same connection.
+    """
+
+    EXPECTING_NOOP_RESPONSE = 12
+    """
+    NOOP was sent between messages to make sure the connection is still alive.
+    """
+
+    EXPECTING_NEXT_MESSAGE = 13
+    """
+    Only used with keep_alive: every queued message has been sent, and the connection stays open
+    (after HELO) until more messages are queued.
+    """
+
     def __init__(self, debug_mode: bool = False):
         self.state = self.EXPECTING_USER_MAIL_FROM_ADDRESS
         self.parser = None
@@ -1385,6 +1447,49 @@ class SMTPClientSide:
 
         self.connection_socket = None
 
+        self.pending_messages = deque()
+        """
+        Lists of commands (the same format as self.commands) for messages that will be sent on this
+        connection after the current one, without reconnecting or sending HELO again.
+        """
+
+        self.messages_sent = 0
+        """
+        The number of messages that got a 250 after ".", for this connection.
+        """
+
+        self.messages_failed = 0
+        """
+        The number of messages that were abandoned with RSET after an error, for this connection.
+        """
+
+        self.recipients_accepted = 0
+        """
+        The number of RCPT TO commands of the current message that got a 250.
+        """
+
+        self.recipients_rejected = 0
+        """
+        The number of RCPT TO commands that got an error while the message itself went on to the
+        other recipients, for this connection.
+        """
+
+        self.noop_return_state = self.EXPECTING_MAIL_FROM
+        """
+        The state to go back to once the server responds to NOOP.
+        """
+
+        self.quit_acknowledged = False
+        """
+        True once the server has answered QUIT with a 221, meaning the session ended normally.
+        """
+
+        self.keep_alive = False
+        """
+        When True, the client waits in EXPECTING_NEXT_MESSAGE once there is nothing left to send
+        instead of sending QUIT, so that a long-running program can reuse the connection.
+        """
+
         self.input_line = ""
         """
         This is the current line from the user. This will be useful
@@ -1426,6 +1531,32 @@ class SMTPClientSide:
 
         return self.state
 
+    def get_waiting_step(self) -> str:
+        """
+        Returns the name of the step that the client is waiting on a response for: "220", "HELO",
+        "MAIL", "RCPT", "DATA", "end-of-data", "RSET", "NOOP" or "QUIT". Only call this after
+        evaluate_state() has returned True, since that is when the command has been sent.
+        """
+
+        if self.state == self.EXPECTING_SERVER_GREETING:
+            return "220"
+        if self.state == self.EXPECTING_SERVER_HELLO:
+            return "HELO"
+        if self.state == self.EXPECTING_MAIL_FROM:
+            return "MAIL"
+        if self.state == self.EXPECTING_RCPT_TO:
+            return "RCPT"
+        if self.state == self.EXPECTING_RCPT_TO_OR_DATA:
+            return "DATA" if self.generated_cmd == "DATA" else "RCPT"
+        if self.state == self.EXPECTING_DATA_END:
+            return "end-of-data"
+        if self.state == self.EXPECTING_RSET_RESPONSE:
+            return "RSET"
+        if self.state == self.EXPECTING_NOOP_RESPONSE:
+            return "NOOP"
+
+        return "QUIT"
+
     def get_state_str(self, state: int) -> str:
         """
         Docstring for get_state_str
@@ -1459,6 +1590,12 @@ class SMTPClientSide:
             return "EXPECTING_DATA_END"
         if state == self.EXPECTING_QUIT_RESPONSE:
             return "EXPECTING_QUIT_RESPONSE"
+        if state == self.EXPECTING_RSET_RESPONSE:
+            return "EXPECTING_RSET_RESPONSE"
+        if state == self.EXPECTING_NOOP_RESPONSE:
+            return "EXPECTING_NOOP_RESPONSE"
+        if state == self.EXPECTING_NEXT_MESSAGE:
+            return "EXPECTING_NEXT_MESSAGE"
 
         return ""
 
@@ -1524,6 +1661,143 @@ class SMTPClientSide:
 
         self.parser = Parser(line, debug_mode=self.debug_mode)
 
+    def build_commands(self, from_address: str, to_addresses: list, subject: str, body_lines: list) -> list:
+        """
+        Builds the same list of commands that collect_user_input() builds from the prompts, for a
+        message whose addresses have already been validated.
+        """
+
+        commands = [f"MAIL FROM: <{from_address}>"]
+        commands += [f"RCPT TO: <{email.strip()}>" for email in to_addresses]
+        commands.append("DATA\n")
+
+        commands.append(f"From: <{from_address}>")
+        commands.append("To: " + ", ".join(f"<{email.strip()}>" for email in to_addresses))
+        commands.append(f"Subject: {subject}")
+        # The blank line that is supposed to come after the subject
+        commands.append("")
+        commands += body_lines
+        commands.append(".\n")
+
+        return commands
+
+    def queue_message(self, from_address: str, to_addresses: list, subject: str, body_lines: list):
+        """
+        Adds a message to be sent on this connection after the current one.
+        """
+
+        self.pending_messages.append(self.build_commands(from_address, to_addresses, subject, body_lines))
+
+    def load_next_message(self) -> bool:
+        """
+        Replaces the commands of the message that was just finished with the commands of the next
+        queued message. Returns False if there are no more messages to send.
+        """
+
+        if not self.pending_messages:
+            return False
+
+        self.commands = self.pending_messages.popleft()
+        self.commands_index = -1
+        self.advance_forward_file_line_pointer()
+
+        DebugMode.print(self.debug_mode, f"load_next_message(); {len(self.pending_messages)} message(s) left after this one", DebugMode.INFO)
+        return True
+
+    def begin_next_message(self) -> bool:
+        """
+        Starts on the next queued message from EXPECTING_NEXT_MESSAGE. Returns False if there is
+        nothing queued.
+        """
+
+        if not self.load_next_message():
+            return False
+
+        self.state = self.EXPECTING_MAIL_FROM
+        return True
+
+    def is_waiting_on_rcpt(self) -> bool:
+        """
+        Returns True if the response being read is the answer to a RCPT TO command.
+        """
+
+        return self.state == self.EXPECTING_RCPT_TO or (self.state == self.EXPECTING_RCPT_TO_OR_DATA and self.generated_cmd != "DATA")
+
+    def has_more_recipients(self) -> bool:
+        """
+        Returns True if the command after the current one is another RCPT TO.
+        """
+
+        return self.commands_index + 1 < len(self.commands) and self.commands[self.commands_index + 1].startswith("RCPT TO:")
+
+    def finish_messages(self):
+        """
+        Called when a message is done (sent or abandoned with RSET): moves on to the next queued
+        message, or, when there is none, waits for more (keep_alive) or sends QUIT.
+        """
+
+        if self.load_next_message():
+            self.state = self.EXPECTING_MAIL_FROM
+        elif self.keep_alive:
+            self.state = self.EXPECTING_NEXT_MESSAGE
+        else:
+            self.state = self.EXPECTING_QUIT_RESPONSE
+
+    def send_queued_messages(self, bufsize: int = 1024, timings: dict|None = None):
+        """
+        Carries on the conversation over self.connection_socket until every queued message has
+        been sent or rejected and the client is waiting in EXPECTING_NEXT_MESSAGE again. On a new
+        connection, this also reads the greeting and sends HELO first. Only for keep_alive; like
+        everywhere else, quit_immediately() ends a broken session by raising SystemExit.
+
+        If timings is given, how long each step took is appended to timings[step], with the steps
+        named as get_waiting_step() names them.
+        """
+
+        if not self.keep_alive:
+            raise ValueError("send_queued_messages() needs keep_alive.")
+
+        if self.state == self.EXPECTING_NEXT_MESSAGE and not self.begin_next_message():
+            return
+
+        step_start = None
+
+        while self.state != self.EXPECTING_NEXT_MESSAGE:
+            # The body of a message takes several calls to evaluate_state() before there is a
+            # response, so the step starts with the first of them.
+            if step_start is None:
+                step_start = time.perf_counter()
+
+            if not self.evaluate_state():
+                continue
+
+            step = self.get_waiting_step()
+            data = self.connection_socket.recv(bufsize).decode()
+
+            DebugMode.print(self.debug_mode, f"data received: {data}", DebugMode.WARN)
+
+            if not data:
+                self.quit_immediately("The SMTP server closed the connection.")
+
+            self.set_parser(current_parser=Parser(input_string=data, debug_mode=self.debug_mode))
+            self.evaluate_response()
+
+            if timings is not None:
+                timings.setdefault(step, []).append(time.perf_counter() - step_start)
+            step_start = None
+
+    def request_noop(self):
+        """
+        Sends NOOP before the next message to check that the server is still there. Only allowed
+        between messages.
+        """
+
+        if self.state not in [self.EXPECTING_MAIL_FROM, self.EXPECTING_NEXT_MESSAGE]:
+            raise ValueError("NOOP can only be sent between messages.")
+
+        self.noop_return_state = self.state
+        self.state = self.EXPECTING_NOOP_RESPONSE
+
     def prompt_for_input(self, prompt: str, remove_whitespace: bool = False) -> Parser:
         """
         Code for prompting the user for input. Since it is repeated multiple times, it could be
@@ -1708,6 +1982,22 @@ class SMTPClientSide:
             # Returning True means that we are expecting a response from the server.
             return True
 
+        if self.state == self.EXPECTING_RSET_RESPONSE:
+            if not socket_send_msg(self.connection_socket, "RSET\n", self.debug_mode):
+                self.quit_immediately(
+                    msg=f'Failed to send SMTP RSET in response to error code from SMTP server: "{self.parser.get_input_line()}'
+                )
+
+            return True
+
+        if self.state == self.EXPECTING_NOOP_RESPONSE:
+            if not socket_send_msg(self.connection_socket, "NOOP\n", self.debug_mode):
+                self.quit_immediately(
+                    msg='Failed to send SMTP NOOP to SMTP server. Terminating program.'
+                )
+
+            return True
+
         if self.state == self.EXPECTING_SERVER_HELLO:
             DebugMode.print(self.debug_mode, "About to send HELO message to SMTP server...")
             if not socket_send_msg(self.connection_socket, f"HELO {get_hostname()}\n", self.debug_mode):
@@ -1852,18 +2142,41 @@ class SMTPClientSide:
         # Stop here if a properly formatted error message is received
         # If you get an error while expecting a quit response, then don't redirect to send another
         # QUIT command; make sure to prevent an endless loop!
+        # The command itself is sent by the next call to evaluate_state() from main(); calling it
+        # from here too would send it twice.
         if self.state != self.EXPECTING_QUIT_RESPONSE:
-            if self.parser.match_response_code() and self.parser.is_error_smtp_response_code():
+            if self.parser.is_error_smtp_response_code():
+
+                # A recipient the server will not take only costs that recipient, as long as
+                # another one was accepted or is still to come; the message goes on with the next
+                # RCPT TO or DATA.
+                if self.is_waiting_on_rcpt() and (self.recipients_accepted or self.has_more_recipients()):
+                    self.recipients_rejected += 1
+                    DebugMode.print(self.debug_mode, f"Recipient rejected by SMTP server: '{self.parser.get_input_line()}'; going on with the other recipients.", DebugMode.ERROR)
+                    if self.state == self.EXPECTING_RCPT_TO:
+                        self.advance()
+                    self.advance_forward_file_line_pointer()
+                    return True
+
+                # Only the current message failed; if there are more (or more may come later, with
+                # keep_alive), abandon this one with RSET and keep the connection.
+                if self.EXPECTING_MAIL_FROM <= self.state <= self.EXPECTING_DATA_END and (self.pending_messages or self.keep_alive):
+                    self.messages_failed += 1
+                    self.state = self.EXPECTING_RSET_RESPONSE
+                    DebugMode.print(self.debug_mode, f"Error response code received from SMTP server: '{self.parser.get_input_line()}'; switching to EXPECTING_RSET_RESPONSE state.", DebugMode.ERROR)
+                    return True
+
                 self.state = self.EXPECTING_QUIT_RESPONSE
                 DebugMode.print(self.debug_mode, f"Error response code received from SMTP server: '{self.parser.get_input_line()}'; switching to EXPECTING_QUIT_RESPONSE state.", DebugMode.ERROR)
-                return self.evaluate_state()
+                return True
 
         # Based on the state, if the wrong message is received, then quit immediately
         resp_number = self.parser.get_smtp_response_code()
 
         self.debug_print(f"evaluate_response(); state: {self.get_state_str(self.state)} ({self.state}), resp_number: {resp_number}, generated_cmd: {self.generated_cmd}")
 
-        if self.state in [self.EXPECTING_MAIL_FROM, self.EXPECTING_RCPT_TO, self.EXPECTING_DATA_END, self.EXPECTING_SERVER_HELLO] \
+        if self.state in [self.EXPECTING_MAIL_FROM, self.EXPECTING_RCPT_TO, self.EXPECTING_DATA_END, self.EXPECTING_SERVER_HELLO,
+                          self.EXPECTING_RSET_RESPONSE, self.EXPECTING_NOOP_RESPONSE] \
         and resp_number != '250':
             self.quit_immediately(f"Wrong response code for state '{self.get_state_str(self.state)}' ({self.state}): {resp_number}; Terminating program.")
             return False
@@ -1889,6 +2202,8 @@ class SMTPClientSide:
             # Advance the state if the current command is a DATA command:
             if self.generated_cmd == "DATA":
                 self.advance()
+            else:
+                self.recipients_accepted += 1
             self.advance_forward_file_line_pointer()
             return True
 
@@ -1897,8 +2212,27 @@ class SMTPClientSide:
             return self.quit_immediately("end-of-file was reached during state 'EXPECTING_DATA_END'.")
 
         # 2) After sending the SMTP server "." and getting the correct response, switch from EXPECTING_DATA_END to EXPECTING_QUIT_RESPONSE
+        # unless there is another message to send on this connection.
         if self.state == self.EXPECTING_DATA_END:
-            self.advance()
+            self.messages_sent += 1
+            self.finish_messages()
+            return True
+
+        # The failed message has been thrown away by the server; start on the next one.
+        if self.state == self.EXPECTING_RSET_RESPONSE:
+            self.finish_messages()
+            return True
+
+        if self.state == self.EXPECTING_NOOP_RESPONSE:
+            self.state = self.noop_return_state
+            if self.state != self.EXPECTING_NEXT_MESSAGE:
+                self.self_update_parser()
+            return True
+
+        # A keep_alive connection can be opened before there is anything to send
+        if self.state == self.EXPECTING_SERVER_HELLO and self.keep_alive and not self.commands:
+            if not self.begin_next_message():
+                self.state = self.EXPECTING_NEXT_MESSAGE
             return True
 
         # 4) # If the generated command is "RCPT TO:", then do NOT advance and there is NO need
@@ -1917,9 +2251,16 @@ class SMTPClientSide:
         # If we have reached this point, this means that the correct response code was received
         # for the current state
         if self.state == self.EXPECTING_QUIT_RESPONSE:
+            self.quit_acknowledged = True
             self.quit_immediately("")
             return False
 
+        # Each message counts its own accepted recipients, starting from its MAIL FROM
+        if self.state == self.EXPECTING_MAIL_FROM:
+            self.recipients_accepted = 0
+        elif self.state == self.EXPECTING_RCPT_TO:
+            self.recipients_accepted += 1
+
         # Since you only reach this point if a valid response code is entered, then it is safe
         # to advance the state.
         self.advance()
@@ -1976,71 +2317,1069 @@ class SMTPClientSide:
 
         if msg:
             print(msg)
+        DebugMode.print(self.debug_mode, f"messages sent on this connection: {self.messages_sent}, messages failed: {self.messages_failed}", DebugMode.INFO)
         close_socket(self.connection_socket, self.debug_mode)
         sys.exit(1)
 
-def get_command_line_arguments():
+def validate_addresses(addresses: list, debug_mode: bool = False) -> bool:
     """
-    Your mail agent should take two command line arguments:
-    a hostname followed by a port number
-    Enables debug mode.
+    Checks a list of email addresses with the same <mailboxes> non-terminal that is used for the
+    From: and To: prompts.
     """
 
-    arg_parser = argparse.ArgumentParser(description="HW4: Building an SMTP Client/Server System Using Sockets")
-    # https://docs.python.org/3/library/argparse.html#argparse.ArgumentParser.add_argument
-    arg_parser.add_argument(
-        "--debug",
-        # https://docs.python.org/3/library/argparse.html#action
-        action="store_true",
-        help="Enable additional logging that is helpful for debugging without modifying code."
-    )
+    if not addresses:
+        return False
 
-    arg_parser.add_argument(
-        "hostname",
-        # https://docs.python.org/3/library/argparse.html#action
-        # 'store' - This just stores the argument's value. This is the default action.
-        action="store",
-        help="hostname of the SMTP server to connect to",
-        # https://docs.python.org/3/library/argparse.html#type
-        # TODO: Make sure setting this does not create issues; the default is to store this value
-        # as a "simple string"
-        # type=default
-    )
+    parser = Parser(",".join("".join(address.split()) for address in addresses), debug_mode)
+    return parser.mailboxes() and parser.is_at_end()
 
-    arg_parser.add_argument(
-        "port_number",
-        # https://docs.python.org/3/library/argparse.html#action
-        # 'store' - This just stores the argument's value. This is the default action.
-        action="store",
-        help="Port number of the SMTP server to connect to",
-        # https://docs.python.org/3/library/argparse.html#type
-        # TODO: Make sure setting this does not create issues; the default is to store this value
-        # as a "simple string"
-        type=int
-    )
 
-    return arg_parser.parse_args()
+FORWARD_V2_MAGIC = b"SMTPFWD2"
+"""
+The first bytes of a forward file in the v2 format (Server.py --forward-format v2).
+"""
+
+FORWARD_V2_RECORD = struct.Struct("<IdHH32s")
+"""
+Header of each message in a v2 forward file: length of the rest of the record, when the message
+was accepted, flags, number of recipients and the SHA-256 of the message text. The same as in
+Server.py, which writes them.
+"""
+
+FORWARD_FLAG_DELETED = 1
+"""
+Flag of a message that has been deleted but is still in the file.
+"""
 
-def main():
+FORWARD_DECOMPRESSORS = {
+    2: zlib.decompress,
+    4: lzma.decompress,
+}
+"""
+Flag of a message whose text is compressed (Server.py --forward-compression) -> function that
+decompresses it.
+"""
+
+
+def decompress_forward_text(flags: int, data) -> bytes:
     """
-    Docstring for main
+    Returns the text of a v2 record as it was before it was compressed (data itself if it was not).
     """
 
-    # Get debug_mode, hostname, and port_number
-    args = get_command_line_arguments()
-    debug_mode = args.debug
-    server_name = args.hostname
-    # 8000 + 4956 = 12956
-    server_port = args.port_number
+    for flag, decompress in FORWARD_DECOMPRESSORS.items():
+        if flags & flag:
+            return decompress(data)
 
-    # This is the maximum amount of data, in bytes, that can be received or sent via the socket.
-    bufsize = 1024
+    return data
+
+
+def get_forward_file_format(path: Path) -> str:
+    """
+    Returns "v2" or "text" for a forward file, based on its first bytes.
+    """
+
+    with path.open("rb") as f:
+        return "v2" if f.read(len(FORWARD_V2_MAGIC)) == FORWARD_V2_MAGIC else "text"
+
+
+def read_forward_v2_records(data, start: int = 0, end: int = None, include_deleted: bool = False):
+    """
+    Yields (offset, record_end, timestamp, flags, sender, recipients, body_hash, text) for each
+    record of a v2 forward file in data[start:end] (bytes or a memory-mapped file), where start is
+    where a record begins. Deleted records are skipped by their length without being decoded. A
+    record that is cut short at end is left for later, so record_end of the last record yielded
+    is where the next read should start. Compressed text is decompressed.
+    """
+
+    end = len(data) if end is None else end
+    position = start
+
+    while position + FORWARD_V2_RECORD.size <= end:
+        length, timestamp, flags, recipient_count, body_hash = FORWARD_V2_RECORD.unpack_from(data, position)
+        record_end = position + FORWARD_V2_RECORD.size + length
+        if record_end > end:
+            break
+
+        if flags & FORWARD_FLAG_DELETED and not include_deleted:
+            position = record_end
+            continue
+
+        payload = bytes(data[position + FORWARD_V2_RECORD.size:record_end])
+        addresses = payload.split(b"\n", recipient_count + 1)
+        text = decompress_forward_text(flags, addresses.pop()).decode("utf-8", errors="replace")
+        sender, *recipients = (address.decode("utf-8", errors="replace") for address in addresses)
+
+        yield position, record_end, timestamp, flags, sender, recipients, body_hash, text
+        position = record_end
+
+
+def read_forward_file_messages(path: Path, debug_mode: bool = False):
+    """
+    Yields (from_address, to_addresses, subject, body_lines) for each message in a file that uses
+    the forward file format. A message starts at a "From: <address>" line and is followed by one
+    or more "To:" lines (each with one or more comma-separated addresses), an optional "Subject:"
+    line and a blank line before the body.
+
+    Files in the v2 format are read record by record; the text of each record is the same as in
+    the text format.
+    """
+
+    if get_forward_file_format(path) == "v2":
+        with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for *_, text in read_forward_v2_records(data, len(FORWARD_V2_MAGIC)):
+                yield from read_forward_lines_messages(io.StringIO(text, newline="\n"), debug_mode)
+        return
+
+    with path.open(mode="r", encoding="utf-8", newline="\n") as f:
+        yield from read_forward_lines_messages(f, debug_mode)
+
+
+def read_forward_lines_messages(lines, debug_mode: bool = False):
+    """
+    The same as read_forward_file_messages(), for lines that have already been read (any iterable
+    of strings, such as part of a file that was read from an offset).
+    """
+
+    message = None
+
+    for line in lines:
+        parser = Parser(line if line.endswith("\n") else line + "\n", debug_mode)
+
+        if parser.forwardfile_match_from_address():
+            if message is not None:
+                yield message
+            message = (parser.get_email_address(), [], "", [])
+            in_headers = True
+            continue
+
+        # Anything before the first "From:" line is not part of a message
+        if message is None:
+            continue
+
+        line = parser.get_input_line()
+
+        if in_headers and line.startswith("To:"):
+            message[1].extend(address.strip().strip("<>") for address in line[3:].split(","))
+            continue
+
+        if in_headers and line.startswith("Subject:"):
+            message = (message[0], message[1], line[len("Subject:"):].strip(), message[3])
+            continue
+
+        # The blank line after the headers is not part of the body
+        if in_headers and line == "":
+            in_headers = False
+            continue
+
+        in_headers = False
+        message[3].append(line)
+
+    if message is not None:
+        yield message
+
+
+def parse_json_message(line: str) -> tuple:
+    """
+    Returns (from_address, to_addresses, subject, body_lines) for one line of JSON like:
+    {"from": "a@b.com", "to": ["c@d.com"], "subject": "hi", "body": "text"}
+    "to" can also be a comma-separated string, and "body" can also be a list of lines.
+    Raises ValueError for a line that is not a message in that format.
+    """
+
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("a message has to be a JSON object")
+
+    for key in ("from", "subject"):
+        if not isinstance(record.get(key, ""), str):
+            raise ValueError(f'"{key}" has to be a string')
+
+    to_addresses = record.get("to", [])
+    if isinstance(to_addresses, str):
+        to_addresses = to_addresses.split(",")
+    if not isinstance(to_addresses, list) or not all(isinstance(address, str) for address in to_addresses):
+        raise ValueError('"to" has to be a string or a list of strings')
+
+    body = record.get("body", [])
+    if isinstance(body, str):
+        body = body.split("\n")
+    if not isinstance(body, list) or not all(isinstance(body_line, str) for body_line in body):
+        raise ValueError('"body" has to be a string or a list of strings')
+
+    return (record.get("from", ""), [address.strip() for address in to_addresses], record.get("subject", ""), body)
+
+
+def read_json_lines_messages(path: Path):
+    """
+    Yields (from_address, to_addresses, subject, body_lines) for each line of a JSON lines file,
+    in the format parse_json_message() reads. Lines that are not in that format are skipped.
+    """
+
+    with path.open(mode="r", encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+
+            try:
+                yield parse_json_message(line)
+            except ValueError as e:
+                print(f"Skipping line {number} of {path}: {e}")
+
+
+def get_message_problem(from_address: str, to_addresses: list, body_lines: list, debug_mode: bool = False) -> str:
+    """
+    Returns why a message cannot be sent, or an empty string if it can.
+    """
+
+    if not validate_addresses([from_address], debug_mode):
+        return f"invalid From address '{from_address}'"
+
+    if not validate_addresses(to_addresses, debug_mode):
+        return f"invalid To address in '{', '.join(to_addresses)}'"
+
+    # There is no way to send a line with just a period in the body of a message
+    if "." in body_lines:
+        return "the body contains a line with just a period"
+
+    return ""
+
+
+def read_batch_messages(batch_path: Path, batch_format: str = "", debug_mode: bool = False):
+    """
+    Yields the messages in a batch file, or in every file of a batch directory (sorted by name).
+    If the format is not given, files ending with .jsonl or .json are read as JSON lines and
+    everything else as forward files.
+    """
+
+    paths = sorted(p for p in batch_path.iterdir() if p.is_file()) if batch_path.is_dir() else [batch_path]
+
+    for path in paths:
+        file_format = batch_format or ("jsonl" if path.suffix in [".jsonl", ".json"] else "forward")
+
+        if file_format == "jsonl":
+            yield from read_json_lines_messages(path)
+        else:
+            yield from read_forward_file_messages(path, debug_mode)
+
+
+UNIX_ADDRESS_PREFIX = "unix:"
+"""
+A hostname that starts with this is the path of a Unix domain socket instead of a host to reach
+over TCP. That skips the TCP/IP stack entirely when the server is on the same machine.
+"""
+
+
+def create_client_socket(hostname: str) -> socket.socket:
+    """
+    Returns a new, unconnected socket of the right family for hostname.
+    """
+
+    if hostname.startswith(UNIX_ADDRESS_PREFIX):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    # https://docs.python.org/3.12/library/socket.html#socket.AF_INET
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+
+def get_server_address(hostname: str, port_number: int|None) -> str|tuple:
+    """
+    Returns what .connect() needs for hostname: the path for unix:/path, or (host, port).
+    """
+
+    if hostname.startswith(UNIX_ADDRESS_PREFIX):
+        return hostname[len(UNIX_ADDRESS_PREFIX):]
+
+    return (hostname, port_number)
+
+
+def parse_target(address: str) -> tuple:
+    """
+    Converts "unix:/path" or "host:port" to the (hostname, port_number) pair used for a target.
+    """
+
+    if address.startswith(UNIX_ADDRESS_PREFIX):
+        return (address, None)
+
+    hostname, _, port_number = address.rpartition(":")
+    return (hostname or "localhost", int(port_number))
+
+
+def describe_target(target: tuple) -> str:
+    """
+    Returns a target the way it would be typed on the command line.
+    """
+
+    hostname, port_number = target
+    return hostname if port_number is None else f"{hostname}:{port_number}"
+
+
+class PooledSession:
+    """
+    One connection held by an SMTPConnectionPool. The greeting and HELO are already done, and the
+    client waits in EXPECTING_NEXT_MESSAGE between uses.
+    """
+
+    def __init__(self, key: tuple, client_socket: socket.socket, smtp_client: SMTPClientSide):
+        self.key = key
+        self.client_socket = client_socket
+        self.smtp_client = smtp_client
+        self.last_used = time.monotonic()
+
+        self.uses = 0
+        """
+        The number of times the session has been handed out by acquire(); 1 means this is the use
+        that opened it.
+        """
+
+    def messages_finished(self) -> int:
+        """
+        Returns the number of messages sent or rejected on this connection so far.
+        """
+
+        return self.smtp_client.messages_sent + self.smtp_client.messages_failed
+
+    def is_healthy(self) -> bool:
+        """
+        Sends NOOP and returns True if the server answered with a 250.
+        """
+
+        try:
+            self.smtp_client.request_noop()
+            self.smtp_client.send_queued_messages()
+            return True
+        except (SystemExit, OSError, ValueError):
+            return False
+
+    def close(self, send_quit: bool = True, timings: dict|None = None):
+        """
+        Ends the session with QUIT (unless the connection is known to be broken) and closes it.
+        If timings is given, the time from sending QUIT to the 221 is appended to timings["QUIT"].
+        """
+
+        if send_quit:
+            self.smtp_client.state = self.smtp_client.EXPECTING_QUIT_RESPONSE
+            start = time.perf_counter()
+            try:
+                self.smtp_client.send_queued_messages()
+            except (SystemExit, OSError, ValueError):
+                # quit_immediately() is how the session ends once the 221 arrives
+                if timings is not None and self.smtp_client.quit_acknowledged:
+                    timings.setdefault("QUIT", []).append(time.perf_counter() - start)
+
+        close_socket(self.client_socket)
+
+
+class SMTPConnectionPool:
+    """
+    Keeps up to size open sessions per (hostname, port_number), so that sending a message does
+    not pay for a new connection, greeting and HELO. A session is checked with NOOP before it is
+    reused, and is closed once it has been idle for max_idle_seconds or has finished max_messages
+    messages. Safe to share between threads.
+    """
+
+    def __init__(self, size: int = 1, max_idle_seconds: float = 30.0, max_messages: int = 1000,
+                 check_idle_seconds: float = 0.0, retries: int = 1, debug_mode: bool = False):
+        self.size = size
+        self.max_idle_seconds = max_idle_seconds
+        self.max_messages = max_messages
+        self.debug_mode = debug_mode
+
+        self.check_idle_seconds = check_idle_seconds
+        """
+        A session that has been idle at least this long gets a NOOP before it is handed out. 0
+        checks every time.
+        """
+
+        self.retries = retries
+        """
+        How many times send() opens a new session for the messages that were left unfinished when
+        a session broke.
+        """
+
+        self.idle_sessions = {}
+        """
+        (hostname, port_number) -> sessions that are not in use, most recently used last.
+        """
+
+        self.open_sessions = {}
+        """
+        (hostname, port_number) -> the number of sessions that are open, in use or not.
+        """
+
+        self.condition = threading.Condition()
+
+        self.sessions_opened = 0
+        self.sessions_evicted = 0
+        self.health_checks_failed = 0
+
+    def open_session(self, key: tuple, timings: dict|None = None) -> PooledSession:
+        """
+        Connects to key (hostname, port_number) and gets through the greeting and HELO. If timings
+        is given, how long the connect, the 220 and the HELO took are appended to
+        timings["connect"], timings["220"] and timings["HELO"].
+        """
+
+        client_socket = create_client_socket(key[0])
+
+        try:
+            # The body of a message is sent one line at a time without waiting for a response, so
+            # without this, Nagle's algorithm holds back the "." until the server ACKs the body.
+            if client_socket.family == socket.AF_INET:
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            start = time.perf_counter()
+            client_socket.connect(get_server_address(*key))
+            if timings is not None:
+                timings.setdefault("connect", []).append(time.perf_counter() - start)
+
+            smtp_client = SMTPClientSide(self.debug_mode)
+            smtp_client.keep_alive = True
+            smtp_client.state = smtp_client.EXPECTING_SERVER_GREETING
+            smtp_client.set_socket(client_socket)
+            smtp_client.send_queued_messages(timings=timings)
+        except BaseException:
+            client_socket.close()
+            raise
+
+        with self.condition:
+            self.sessions_opened += 1
+
+        DebugMode.print(self.debug_mode, f"SMTPConnectionPool; opened session #{self.sessions_opened} to {key}", DebugMode.SUCCESS)
+        return PooledSession(key, client_socket, smtp_client)
+
+    def acquire(self, hostname: str, port_number: int|None, timings: dict|None = None) -> PooledSession:
+        """
+        Returns a session that is ready for MAIL FROM: an idle one that passes its checks, or a
+        new one if fewer than size are open. Otherwise, waits for another thread to release one.
+        timings is passed to open_session() when a new session is opened.
+        """
+
+        key = (hostname, port_number)
+
+        while True:
+            with self.condition:
+                while True:
+                    if self.idle_sessions.get(key):
+                        session = self.idle_sessions[key].pop()
+                        break
+
+                    if self.open_sessions.get(key, 0) < self.size:
+                        self.open_sessions[key] = self.open_sessions.get(key, 0) + 1
+                        session = None
+                        break
+
+                    self.condition.wait()
+
+            if session is None:
+                try:
+                    session = self.open_session(key, timings)
+                except BaseException:
+                    self.forget(key)
+                    raise
+
+                session.uses += 1
+                return session
+
+            idle_seconds = time.monotonic() - session.last_used
+
+            if idle_seconds >= self.max_idle_seconds or session.messages_finished() >= self.max_messages:
+                self.sessions_evicted += 1
+                self.discard(session)
+                continue
+
+            if idle_seconds >= self.check_idle_seconds and not session.is_healthy():
+                DebugMode.print(self.debug_mode, f"SMTPConnectionPool; session to {key} failed NOOP", DebugMode.WARN)
+                self.health_checks_failed += 1
+                self.discard(session, send_quit=False)
+                continue
+
+            session.uses += 1
+            return session
+
+    def release(self, session: PooledSession, broken: bool = False):
+        """
+        Gives a session back to the pool. A broken session, or one that has finished
+        max_messages, is closed instead.
+        """
+
+        session.last_used = time.monotonic()
+
+        if broken or session.messages_finished() >= self.max_messages:
+            self.discard(session, send_quit=not broken)
+            return
+
+        with self.condition:
+            self.idle_sessions.setdefault(session.key, []).append(session)
+            self.condition.notify()
+
+    def discard(self, session: PooledSession, send_quit: bool = True, timings: dict|None = None):
+        """
+        Closes a session that is not in the pool's idle list and makes room for a new one.
+        timings is passed to PooledSession.close().
+        """
+
+        session.close(send_quit, timings)
+        self.forget(session.key)
+
+    def forget(self, key: tuple):
+        """
+        Counts one fewer open session for key.
+        """
+
+        with self.condition:
+            self.open_sessions[key] -= 1
+            self.condition.notify()
+
+    def close_idle(self):
+        """
+        Closes every idle session that has been unused for max_idle_seconds.
+        """
+
+        now = time.monotonic()
+        expired = []
+
+        with self.condition:
+            for key, sessions in self.idle_sessions.items():
+                expired += [session for session in sessions if now - session.last_used >= self.max_idle_seconds]
+                sessions[:] = [session for session in sessions if now - session.last_used < self.max_idle_seconds]
+
+        for session in expired:
+            self.sessions_evicted += 1
+            self.discard(session)
+
+    def has_idle_sessions(self) -> bool:
+        """
+        Returns True if any session is open and not in use.
+        """
+
+        with self.condition:
+            return any(self.idle_sessions.values())
+
+    def close_all(self):
+        """
+        Sends QUIT on every idle session. Sessions that are in use are closed when released.
+        """
+
+        with self.condition:
+            sessions = [session for sessions in self.idle_sessions.values() for session in sessions]
+            self.idle_sessions = {}
+
+        for session in sessions:
+            self.discard(session)
+
+    def send(self, hostname: str, port_number: int|None, messages: list) -> tuple:
+        """
+        Sends messages, each (from_address, to_addresses, subject, body_lines), one after the
+        other over one pooled session. If the session breaks (a socket error, or a response such
+        as 421 that ends the session), the unfinished messages are sent again on a new session, up
+        to retries times. Returns (messages sent, messages rejected, messages left unfinished).
+
+        Errors from opening a session (the server cannot be reached) are raised.
+        """
+
+        sent = rejected = 0
+        attempts = 0
+
+        while messages:
+            session = self.acquire(hostname, port_number)
+            smtp_client = session.smtp_client
+            sent_before, rejected_before = smtp_client.messages_sent, smtp_client.messages_failed
+
+            for message in messages:
+                smtp_client.queue_message(*message)
+
+            broken = False
+            try:
+                smtp_client.send_queued_messages()
+            except (SystemExit, OSError, ValueError) as e:
+                DebugMode.print(self.debug_mode, f"SMTPConnectionPool; session to {session.key} broke: {e}", DebugMode.ERROR)
+                broken = True
+
+            sent += smtp_client.messages_sent - sent_before
+            rejected += smtp_client.messages_failed - rejected_before
+            messages = messages[smtp_client.messages_sent - sent_before + smtp_client.messages_failed - rejected_before:]
+
+            self.release(session, broken)
+
+            attempts += 1
+            if not broken or attempts > self.retries:
+                break
+
+        return sent, rejected, messages
+
+    def to_dict(self) -> dict:
+        """
+        Returns counters that show how well sessions are being reused.
+        """
+
+        with self.condition:
+            return {
+                "sessions_opened": self.sessions_opened,
+                "sessions_evicted": self.sessions_evicted,
+                "health_checks_failed": self.health_checks_failed,
+                "open_sessions": sum(self.open_sessions.values()),
+                "idle_sessions": sum(len(sessions) for sessions in self.idle_sessions.values()),
+            }
+
+
+class DomainTableNode:
+    """
+    One label of a DomainTable, such as "unc" in "cs.unc.edu".
+    """
+
+    __slots__ = ("children", "exact", "wildcard")
+
+    def __init__(self):
+        self.children = None
+        """
+        label -> DomainTableNode for the label to the left of this one; None until there is one,
+        since most nodes are leaves.
+        """
+
+        self.exact = None
+        """
+        The value for the domain that ends at this label, from a pattern like "unc.edu".
+        """
+
+        self.wildcard = None
+        """
+        The value for every domain below this one, from a pattern like "*.unc.edu".
+        """
+
+
+class DomainTable:
+    """
+    Maps domain patterns to values. "unc.edu" only matches that domain, "*.unc.edu" matches every
+    domain that ends with ".unc.edu", and "*" matches every domain; the most specific pattern wins.
+    The patterns are kept in a trie of their labels from right to left ("edu", then "unc", ...),
+    so a lookup costs one dictionary lookup per label of the domain, no matter how many patterns
+    there are.
+    """
+
+    def __init__(self):
+        self.root = DomainTableNode()
+        self.size = 0
+
+    def add(self, pattern: str, value):
+        """
+        Adds a pattern, or replaces the value of one that is already in the table.
+        """
+
+        pattern = pattern.strip().casefold()
+        is_wildcard = pattern == "*" or pattern.startswith("*.")
+        labels = [] if pattern == "*" else pattern.removeprefix("*.").split(".")
+
+        if any(not label or "*" in label for label in labels) or not (labels or is_wildcard):
+            raise ValueError(f"not a domain pattern: '{pattern}'")
+
+        node = self.root
+        for label in reversed(labels):
+            if node.children is None:
+                node.children = {}
+
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = DomainTableNode()
+            node = child
+
+        if (node.wildcard if is_wildcard else node.exact) is None:
+            self.size += 1
+
+        if is_wildcard:
+            node.wildcard = value
+        else:
+            node.exact = value
+
+    def lookup(self, domain: str, default=None):
+        """
+        Returns the value of the most specific pattern that matches domain, or default.
+        """
+
+        labels = domain.casefold().split(".")
+        node = self.root
+        best = node.wildcard
+
+        for i in range(len(labels) - 1, -1, -1):
+            if node.children is None:
+                break
+
+            node = node.children.get(labels[i])
+            if node is None:
+                break
+
+            if i == 0:
+                if node.exact is not None:
+                    return node.exact
+            elif node.wildcard is not None:
+                # "*.unc.edu" matches "cs.unc.edu" but not "unc.edu" itself
+                best = node.wildcard
+
+        return default if best is None else best
+
+
+def load_domain_table(path: Path, parse_value=str) -> DomainTable:
+    """
+    Reads a DomainTable from a file with one "pattern value" pair per line, such as
+    "*.unc.edu reject". Blank lines and lines that start with "#" are skipped. parse_value
+    converts each value (and can raise ValueError).
+    """
+
+    table = DomainTable()
+
+    with path.open(mode="r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            fields = line.split()
+
+            try:
+                if len(fields) != 2:
+                    raise ValueError(f"expected 'pattern value': '{line}'")
+                table.add(fields[0], parse_value(fields[1]))
+            except ValueError as e:
+                raise ValueError(f"{path}, line {line_no}: {e}") from e
+
+    return table
+
+
+def parse_route(text: str) -> tuple:
+    """
+    Converts "domain=host:port" (or "domain=unix:/path") from --route to (domain, target). The
+    domain can be a pattern, like "*.unc.edu", as in a DomainTable.
+    """
+
+    domain, separator, address = text.partition("=")
+
+    if not separator or not domain.strip():
+        raise ValueError(f"expected DOMAIN=ADDRESS: {text}")
+
+    return (domain.strip().casefold(), parse_target(address.strip()))
+
+
+def get_address_domain(address: str, debug_mode: bool = False) -> str:
+    """
+    Returns the casefolded domain of an address such as "bob@cs.unc.edu".
+    """
+
+    # get_email_domain() expects the address inside angle brackets, like in RCPT TO
+    return Parser(f"<{address.strip()}>", debug_mode=debug_mode).get_email_domain()
+
+
+class DomainRouter:
+    """
+    Decides which SMTP server (target) each recipient's mail goes to, by the domain of the
+    recipient's address. Domains that no route matches go to the default target, which can be None
+    when there is no default.
+    """
+
+    def __init__(self, routes: dict, default_target: tuple|None, debug_mode: bool = False, routes_file: Path|None = None):
+        self.routes = routes
+        """
+        {domain pattern: (hostname, port_number)} from the command line. These win over routes_file.
+        """
+
+        self.routes_file = routes_file
+        """
+        File of "pattern host:port" lines to read the rest of the routes from, or None.
+        """
+
+        self.default_target = default_target
+        self.debug_mode = debug_mode
+
+        self.table = self.build_table()
+
+    def build_table(self) -> DomainTable:
+        """
+        Returns a DomainTable with the routes from routes_file and then from routes.
+        """
+
+        table = load_domain_table(self.routes_file, parse_target) if self.routes_file else DomainTable()
+
+        for pattern, target in self.routes.items():
+            table.add(pattern, target)
+
+        return table
+
+    def reload(self):
+        """
+        Reads routes_file again and puts the new table in place with one assignment, so that a
+        lookup never sees a table that is only partly loaded. Raises OSError or ValueError (and
+        keeps the old table) if the file cannot be read.
+        """
+
+        self.table = self.build_table()
+
+    def get_domain_target(self, domain: str) -> tuple|None:
+        """
+        Returns the target for mail to domain.
+        """
+
+        return self.table.lookup(domain, self.default_target)
+
+    def get_target(self, address: str) -> tuple|None:
+        """
+        Returns the target for one recipient address.
+        """
+
+        return self.get_domain_target(get_address_domain(address, self.debug_mode))
+
+    def split_recipients(self, to_addresses: list) -> dict:
+        """
+        Returns {target: [the addresses in to_addresses that go there]}, keeping their order.
+        """
+
+        recipients_by_target = {}
+
+        for address in to_addresses:
+            recipients_by_target.setdefault(self.get_target(address), []).append(address)
+
+        return recipients_by_target
+
+    def split_messages(self, messages: list) -> dict:
+        """
+        Returns {target: [messages]} where every message, (from_address, to_addresses, subject,
+        body_lines), only has the recipients that go to that target. Each server only sees its
+        own recipients, in RCPT TO and in the To: line.
+        """
+
+        messages_by_target = {}
+
+        for from_address, to_addresses, subject, body_lines in messages:
+            for target, recipients in self.split_recipients(to_addresses).items():
+                messages_by_target.setdefault(target, []).append((from_address, recipients, subject, body_lines))
+
+        return messages_by_target
+
+
+def send_to_target(pool: SMTPConnectionPool, target: tuple, messages: list) -> dict:
+    """
+    Sends messages to one target with pool.send() and returns what happened. Runs in a worker
+    thread of fan_out(). A target that cannot be reached is reported instead of raised, since
+    SystemExit from quit_immediately() must not reach the event loop.
+    """
+
+    result = {"target": describe_target(target), "messages": len(messages), "sent": 0, "rejected": 0, "unfinished": len(messages), "error": ""}
+    start_time = time.perf_counter()
+
+    try:
+        sent, rejected, unfinished = pool.send(*target, messages)
+        result.update(sent=sent, rejected=rejected, unfinished=len(unfinished))
+    except (SystemExit, OSError, ValueError) as e:
+        result["error"] = str(e) or type(e).__name__
+
+    result["elapsed"] = time.perf_counter() - start_time
+    return result
+
+
+async def fan_out(pool: SMTPConnectionPool, router: DomainRouter, messages: list) -> list:
+    """
+    Splits messages by the target of their recipients and sends to every target at the same
+    time, each over its own pooled session, so that the total time is close to that of the
+    slowest target instead of the sum of all of them. The SMTP conversation itself uses blocking
+    sockets (SMTPClientSide), so each target is handled in a worker thread while the event loop
+    waits for all of them. Returns the send_to_target() result for every target.
+    """
+
+    messages_by_target = router.split_messages(messages)
+
+    return await asyncio.gather(*(
+        asyncio.to_thread(send_to_target, pool, target, target_messages)
+        for target, target_messages in messages_by_target.items()
+    ))
+
+
+def send_routed(args, messages: list, invalid_messages: int) -> int:
+    """
+    Sends the messages from --batch to the servers chosen by --route. Returns the exit code for
+    the program.
+    """
+
+    router = DomainRouter(dict(args.route), (args.hostname, args.port_number), args.debug)
+    pool = SMTPConnectionPool(size=1, max_messages=len(messages) + 1, debug_mode=args.debug)
+    results = []
+
+    start_time = time.perf_counter()
+
+    try:
+        results = asyncio.run(fan_out(pool, router, messages))
+    except KeyboardInterrupt:
+        print("Program terminated by pressing CTRL + C.")
+    finally:
+        # Closing the sessions is not part of the send time
+        elapsed = time.perf_counter() - start_time
+        pool.close_all()
+
+    for result in results:
+        problem = f"; could not connect: {result['error']}" if result["error"] else ""
+        print(f"  {result['target']}: sent {result['sent']} of {result['messages']} in {result['elapsed']:.3f}s, "
+              f"{result['rejected']} rejected{problem}")
+
+    copies = sum(result["messages"] for result in results)
+    sent = sum(result["sent"] for result in results)
+    rejected = sum(result["rejected"] for result in results)
+
+    print(f"Sent {sent} of {copies} message copies to {len(results)} server(s) in {elapsed:.3f}s; "
+          f"{rejected} rejected, {invalid_messages} skipped as invalid.")
+
+    return 1 if not results or any(result["unfinished"] for result in results) else 0
+
+
+def send_batch(args) -> int:
+    """
+    Sends every message from --batch over a single connection with a single HELO, without
+    prompting. Messages with invalid addresses are skipped, and messages the server rejects are
+    abandoned with RSET. If the connection breaks, the rest are sent on a new one. Returns the
+    exit code for the program.
+    """
+
+    debug_mode = args.debug
+
+    messages = []
+    invalid_messages = 0
+
+    for number, (from_address, to_addresses, subject, body_lines) in enumerate(read_batch_messages(args.batch, args.format, debug_mode), start=1):
+        problem = get_message_problem(from_address, to_addresses, body_lines, debug_mode)
+        if problem:
+            print(f"Skipping message #{number}: {problem}")
+            invalid_messages += 1
+            continue
+
+        messages.append((from_address, to_addresses, subject, body_lines))
+
+    if not messages:
+        print("No valid messages to send.")
+        return 1
+
+    if args.route:
+        return send_routed(args, messages, invalid_messages)
+
+    pool = SMTPConnectionPool(size=1, max_messages=len(messages) + 1, debug_mode=debug_mode)
+    sent = rejected = 0
+    unfinished = messages
+
+    start_time = time.perf_counter()
+
+    try:
+        sent, rejected, unfinished = pool.send(args.hostname, args.port_number, messages)
+    except KeyboardInterrupt:
+        print("Program terminated by pressing CTRL + C.")
+    except (SystemExit, OSError, ValueError) as e:
+        print(f"Could not connect to the SMTP server: {e}")
+    finally:
+        pool.close_all()
+
+    elapsed = time.perf_counter() - start_time
+    rate = sent / elapsed if elapsed > 0 else 0.0
+
+    print(f"Sent {sent} of {len(messages)} message(s) in {elapsed:.3f}s "
+          f"({rate:.1f} messages/second); {rejected} rejected, {invalid_messages} skipped as invalid.")
+
+    return 1 if unfinished else 0
+
+
+def get_command_line_arguments():
+    """
+    Your mail agent should take two command line arguments:
+    a hostname followed by a port number
+    Enables debug mode.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="HW4: Building an SMTP Client/Server System Using Sockets")
+    # https://docs.python.org/3/library/argparse.html#argparse.ArgumentParser.add_argument
+    arg_parser.add_argument(
+        "--debug",
+        # https://docs.python.org/3/library/argparse.html#action
+        action="store_true",
+        help="Enable additional logging that is helpful for debugging without modifying code."
+    )
+
+    arg_parser.add_argument(
+        "hostname",
+        # https://docs.python.org/3/library/argparse.html#action
+        # 'store' - This just stores the argument's value. This is the default action.
+        action="store",
+        help="hostname of the SMTP server to connect to, or unix:/path for a Unix domain socket on this machine",
+        # https://docs.python.org/3/library/argparse.html#type
+        # TODO: Make sure setting this does not create issues; the default is to store this value
+        # as a "simple string"
+        # type=default
+    )
+
+    arg_parser.add_argument(
+        "port_number",
+        # https://docs.python.org/3/library/argparse.html#action
+        # 'store' - This just stores the argument's value. This is the default action.
+        action="store",
+        nargs="?",
+        default=None,
+        help="Port number of the SMTP server to connect to (not used with unix:/path)",
+        # https://docs.python.org/3/library/argparse.html#type
+        # TODO: Make sure setting this does not create issues; the default is to store this value
+        # as a "simple string"
+        type=int
+    )
+
+    arg_parser.add_argument(
+        "--batch",
+        action="store",
+        help="Send every message in this file or directory over one connection instead of prompting",
+        type=Path
+    )
+
+    arg_parser.add_argument(
+        "--format",
+        action="store",
+        choices=["forward", "jsonl"],
+        default="",
+        help="Format of the --batch files; guessed from the file extension if not given"
+    )
+
+    arg_parser.add_argument(
+        "--route",
+        action="append",
+        default=[],
+        metavar="DOMAIN=ADDRESS",
+        help="With --batch, send mail for recipients at DOMAIN to ADDRESS (host:port or unix:/path) "
+             "instead of hostname; repeat for more domains. Every server is sent to at the same time",
+        type=parse_route
+    )
+
+    args = arg_parser.parse_args()
+
+    if args.port_number is None and not args.hostname.startswith(UNIX_ADDRESS_PREFIX):
+        arg_parser.error(f"port_number is required unless the hostname is {UNIX_ADDRESS_PREFIX}/path")
+
+    if args.route and not args.batch:
+        arg_parser.error("--route can only be used with --batch")
+
+    return args
+
+def main():
+    """
+    Docstring for main
+    """
+
+    # Get debug_mode, hostname, and port_number
+    args = get_command_line_arguments()
+    debug_mode = args.debug
+    server_name = args.hostname
+    # 8000 + 4956 = 12956
+    server_port = args.port_number
+
+    # This is the maximum amount of data, in bytes, that can be received or sent via the socket.
+    bufsize = 1024
+
+    if args.batch:
+        sys.exit(send_batch(args))
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
+    with create_client_socket(server_name) as client_socket:
 
         # The documentation provides a way to reuse a local socket in the TIME_WAIT state without
         # waiting for its natural timeout to expire
-        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if client_socket.family == socket.AF_INET:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         DebugMode.print(debug_mode, "entered the with statement for client_socket...")
 
@@ -2067,7 +3406,7 @@ def main():
             # with the SMTP HELO message using the format from the non-terminal. It
             # will look like "HELO client-hostname.cs.unc.edu", where that is a
             # hostname of the server the client program is running on
-            client_socket.connect((server_name, server_port))
+            client_socket.connect(get_server_address(server_name, server_port))
 
             DebugMode.print(debug_mode, f"opened a socket to SMTP server {server_name}:{server_port}", DebugMode.SUCCESS)
 
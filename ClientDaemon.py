@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+ClientDaemon.py
+A long-running client that keeps connections to the SMTP server open (after HELO) and sends
+whatever is submitted to it, so that a message does not cost a new Python process, a new
+connection and a new HELO. Messages are submitted over a Unix domain socket (see Submit.py) or
+by dropping files into a spool folder.
+"""
+
+import argparse
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from pathlib import Path
+from Client import SMTPConnectionPool, DebugMode, parse_json_message, get_message_problem, read_batch_messages, \
+    UNIX_ADDRESS_PREFIX
+
+DEFAULT_SUBMIT_SOCKET = f"{UNIX_ADDRESS_PREFIX}/tmp/smtp-client-daemon-{os.getuid()}.sock"
+"""
+Where the daemon listens for submissions and where Submit.py sends them, unless told otherwise.
+"""
+
+
+class SpoolFile:
+    """
+    A spool file whose messages are in the outbox. It is only moved to done/ once every one of
+    them has been sent or rejected, so a daemon that stops before then reads it again next time
+    (and may send some of its messages twice, rather than lose any).
+    """
+
+    __slots__ = ("path", "done_path", "remaining")
+
+    def __init__(self, path: Path, done_path: Path, remaining: int):
+        self.path = path
+        self.done_path = done_path
+        self.remaining = remaining
+
+
+class ClientDaemon:
+    """
+    Sends the messages in self.outbox over pooled connections that stay open between messages.
+    Messages that arrive while others are being sent are sent together, one after the other on
+    the same connection.
+    """
+
+    def __init__(self, hostname: str, port_number: int|None, max_batch: int = 100, retry_seconds: float = 5.0,
+                 idle_seconds: float = 5.0, connections: int = 1, debug_mode: bool = False):
+        self.hostname = hostname
+        self.port_number = port_number
+        self.max_batch = max_batch
+        self.retry_seconds = retry_seconds
+        self.debug_mode = debug_mode
+
+        self.idle_seconds = idle_seconds
+        """
+        A connection is closed with QUIT after this many seconds without a message. Server.py
+        handles one connection at a time, so a connection that is never closed would keep every
+        other client waiting.
+        """
+
+        self.pool = SMTPConnectionPool(size=connections, max_idle_seconds=idle_seconds, debug_mode=debug_mode)
+
+        self.outbox = queue.Queue()
+        """
+        ((from_address, to_addresses, subject, body_lines), SpoolFile or None) for every message
+        waiting to be sent. Filled by the submission and spool threads, emptied by run().
+        """
+
+        self.messages_sent = 0
+        self.messages_rejected = 0
+        self.counter_lock = threading.Lock()
+
+        self.spool_files = set()
+        """
+        Paths of the spool files whose messages are still in the outbox, so the spool thread does
+        not queue them again. Only used under counter_lock.
+        """
+
+    def submit(self, message: tuple, spool_file: SpoolFile|None = None):
+        """
+        Hands a message that has already been checked with get_message_problem() to the daemon,
+        along with the spool file it came from, if any.
+        """
+
+        self.outbox.put((message, spool_file))
+
+    def add_spool_file(self, spool_file: SpoolFile, messages: list):
+        """
+        Queues the messages of a spool file, or moves it to done/ right away if it has none.
+        """
+
+        with self.counter_lock:
+            self.spool_files.add(spool_file.path)
+
+        for message in messages:
+            self.submit(message, spool_file)
+
+        self.finish_spool_file(spool_file, 0)
+
+    def finish_spool_file(self, spool_file: SpoolFile|None, count: int = 1):
+        """
+        Marks count messages of spool_file as sent or rejected, and moves the file to done/ once
+        none are left.
+        """
+
+        if spool_file is None:
+            return
+
+        with self.counter_lock:
+            spool_file.remaining -= count
+            if spool_file.remaining > 0 or spool_file.path not in self.spool_files:
+                return
+            self.spool_files.discard(spool_file.path)
+
+        try:
+            spool_file.path.replace(spool_file.done_path)
+        except OSError as e:
+            print(f"Could not move spool file {spool_file.path.name} to {spool_file.done_path.parent}: {e}")
+
+    def is_spool_file_queued(self, path: Path) -> bool:
+        """
+        Returns True if the messages of the spool file at path are still being sent.
+        """
+
+        with self.counter_lock:
+            return path in self.spool_files
+
+    def warm_up(self):
+        """
+        Opens a connection and gets through the greeting and HELO before there is anything to
+        send, so that the first message can start with MAIL FROM right away.
+        """
+
+        self.pool.release(self.pool.acquire(self.hostname, self.port_number))
+
+    def run(self):
+        """
+        Sends messages from the outbox as they arrive, forever. When a connection breaks, the pool
+        sends the unfinished messages again on a new one; when the server cannot be reached, they
+        are kept and tried again every retry_seconds. More than one thread can run this, one per
+        pooled connection.
+        """
+
+        while True:
+            try:
+                items = [self.outbox.get(timeout=self.idle_seconds if self.pool.has_idle_sessions() else None)]
+            except queue.Empty:
+                DebugMode.print(self.debug_mode, f"no messages for {self.idle_seconds}s; closing idle connections", DebugMode.INFO)
+                self.pool.close_idle()
+                continue
+
+            while len(items) < self.max_batch:
+                try:
+                    items.append(self.outbox.get_nowait())
+                except queue.Empty:
+                    break
+
+            while items:
+                try:
+                    sent, rejected, unfinished = self.pool.send(self.hostname, self.port_number, [message for message, _ in items])
+                except (SystemExit, OSError, ValueError) as e:
+                    print(f"Could not connect to the SMTP server: {e}; trying again in {self.retry_seconds}s")
+                    time.sleep(self.retry_seconds)
+                    continue
+
+                with self.counter_lock:
+                    self.messages_sent += sent
+                    self.messages_rejected += rejected
+
+                if rejected:
+                    print(f"{rejected} message(s) were rejected by the server")
+
+                DebugMode.print(self.debug_mode, f"{sent + rejected} message(s) done, {len(unfinished)} to send again; "
+                                                 f"{self.messages_sent} sent since startup; {self.pool.to_dict()}", DebugMode.INFO)
+
+                # The unfinished messages are the last ones; the ones before them are done
+                done = len(items) - len(unfinished)
+                for _, spool_file in items[:done]:
+                    self.finish_spool_file(spool_file)
+
+                # Do not keep reconnecting right away if the server drops every connection
+                if not done:
+                    time.sleep(self.retry_seconds)
+
+                items = items[done:]
+
+
+class SubmissionHandler(socketserver.StreamRequestHandler):
+    """
+    Reads one message per line, as JSON (see parse_json_message()), and answers each line with
+    "250 queued" or "501 <reason>". The message is only handed off; it is sent afterwards.
+    """
+
+    daemon = None
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode("utf-8", errors="replace")
+            if not line.strip():
+                continue
+
+            try:
+                message = parse_json_message(line)
+            except (ValueError, AttributeError):
+                self.wfile.write(b"501 not a JSON object with from, to, subject and body\n")
+                continue
+
+            from_address, to_addresses, _, body_lines = message
+            problem = get_message_problem(from_address, to_addresses, body_lines, self.daemon.debug_mode)
+
+            if problem:
+                self.wfile.write(f"501 {problem}\n".encode())
+                continue
+
+            self.daemon.submit(message)
+            self.wfile.write(b"250 queued\n")
+
+
+def start_submission_server(daemon: ClientDaemon, path: str, unix_mode: int) -> socketserver.ThreadingUnixStreamServer:
+    """
+    Listens for submissions on the Unix domain socket at path from a background thread. Who can
+    submit is decided by the permissions of the socket file (unix_mode).
+    """
+
+    if Path(path).is_socket():
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            if probe.connect_ex(path) == 0:
+                raise OSError(f"another daemon is already listening on {UNIX_ADDRESS_PREFIX}{path}")
+        Path(path).unlink()
+
+    handler_class = type("BoundSubmissionHandler", (SubmissionHandler,), {"daemon": daemon})
+    submission_server = socketserver.ThreadingUnixStreamServer(path, handler_class)
+    os.chmod(path, unix_mode)
+
+    thread = threading.Thread(target=submission_server.serve_forever, name="submissions", daemon=True)
+    thread.start()
+
+    DebugMode.print(daemon.debug_mode, f"accepting submissions on {UNIX_ADDRESS_PREFIX}{path}", DebugMode.SUCCESS)
+    return submission_server
+
+
+def watch_spool(daemon: ClientDaemon, spool_folder: Path, interval: float):
+    """
+    Every interval seconds, queues the messages in every new file in spool_folder (JSON lines for
+    .jsonl/.json, forward files otherwise). A file is moved to spool_folder/done once all of its
+    messages have been sent or rejected, and a file that cannot be read to spool_folder/failed.
+    Files whose names start with "." are skipped, so a file can be written under a hidden name
+    and renamed once it is complete.
+    """
+
+    done_folder = spool_folder / "done"
+    failed_folder = spool_folder / "failed"
+    done_folder.mkdir(parents=True, exist_ok=True)
+
+    while True:
+        for path in sorted(spool_folder.iterdir()):
+            if not path.is_file() or path.name.startswith(".") or daemon.is_spool_file_queued(path):
+                continue
+
+            try:
+                file_messages = list(read_batch_messages(path, debug_mode=daemon.debug_mode))
+            except (OSError, ValueError, AttributeError) as e:
+                print(f"Could not read spool file {path.name}: {e}; moving it to {failed_folder}")
+                try:
+                    failed_folder.mkdir(exist_ok=True)
+                    path.replace(failed_folder / path.name)
+                except OSError as move_error:
+                    print(f"Could not move spool file {path.name} to {failed_folder}: {move_error}")
+                continue
+
+            messages = []
+            for number, (from_address, to_addresses, subject, body_lines) in enumerate(file_messages, start=1):
+                problem = get_message_problem(from_address, to_addresses, body_lines, daemon.debug_mode)
+                if problem:
+                    print(f"Skipping message #{number} of spool file {path.name}: {problem}")
+                    continue
+
+                messages.append((from_address, to_addresses, subject, body_lines))
+
+            daemon.add_spool_file(SpoolFile(path, done_folder / path.name, len(messages)), messages)
+
+        time.sleep(interval)
+
+
+def get_command_line_arguments():
+    """
+    Handles the server to send to and where submissions come from.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Keeps a connection to an SMTP server open and sends submitted messages over it")
+
+    arg_parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="Enable additional logging that is helpful for debugging without modifying code."
+    )
+
+    arg_parser.add_argument("hostname", action="store",
+                            help="hostname of the SMTP server to connect to, or unix:/path for a Unix domain socket")
+    arg_parser.add_argument("port_number", action="store", nargs="?", default=None, type=int,
+                            help="Port number of the SMTP server to connect to (not used with unix:/path)")
+
+    arg_parser.add_argument("--submit-socket", action="store", default=DEFAULT_SUBMIT_SOCKET,
+                            help=f"unix:/path to accept submissions on (default {DEFAULT_SUBMIT_SOCKET})")
+    arg_parser.add_argument("--unix-mode", action="store", type=lambda text: int(text, 8), default=0o600,
+                            help="Permissions of the submission socket file, in octal (default 600: only this user)")
+    arg_parser.add_argument("--spool", action="store", type=Path, default=None,
+                            help="Also send the messages in files dropped into this folder")
+    arg_parser.add_argument("--spool-interval", action="store", type=float, default=1.0,
+                            help="Seconds between checks of the spool folder")
+    arg_parser.add_argument("--max-batch", action="store", type=int, default=100,
+                            help="Most messages to send in a row before checking for newly submitted ones")
+    arg_parser.add_argument("--retry-seconds", action="store", type=float, default=5.0,
+                            help="Seconds to wait before trying again when the server cannot be reached")
+    arg_parser.add_argument("--idle-seconds", action="store", type=float, default=5.0,
+                            help="Close the connection after this many seconds without a message (Server.py serves one connection at a time)")
+    arg_parser.add_argument("--connections", action="store", type=int, default=1,
+                            help="Number of connections to send over at the same time (keep at 1 for Server.py)")
+
+    args = arg_parser.parse_args()
+
+    if args.port_number is None and not args.hostname.startswith(UNIX_ADDRESS_PREFIX):
+        arg_parser.error(f"port_number is required unless the hostname is {UNIX_ADDRESS_PREFIX}/path")
+
+    if not args.submit_socket.startswith(UNIX_ADDRESS_PREFIX):
+        arg_parser.error(f"--submit-socket must look like {UNIX_ADDRESS_PREFIX}/path")
+
+    return args
+
+
+def main():
+    """
+    Starts accepting submissions and sends them until interrupted.
+    """
+
+    args = get_command_line_arguments()
+    debug_mode = args.debug
+
+    daemon = ClientDaemon(args.hostname, args.port_number, args.max_batch, args.retry_seconds, args.idle_seconds, args.connections, debug_mode)
+
+    submit_path = args.submit_socket[len(UNIX_ADDRESS_PREFIX):]
+    submission_server = start_submission_server(daemon, submit_path, args.unix_mode)
+
+    if args.spool:
+        threading.Thread(target=watch_spool, args=(daemon, args.spool, args.spool_interval), name="spool", daemon=True).start()
+
+    try:
+        # Connecting up front means the first message does not wait for the greeting and HELO
+        try:
+            daemon.warm_up()
+        except (SystemExit, OSError, ValueError) as e:
+            print(f"Could not connect to the SMTP server yet: {e}")
+
+        for _ in range(args.connections - 1):
+            threading.Thread(target=daemon.run, name="sender", daemon=True).start()
+
+        daemon.run()
+    except KeyboardInterrupt:
+        print(f"Stopping; {daemon.messages_sent} message(s) sent, {daemon.messages_rejected} rejected, "
+              f"{daemon.outbox.qsize()} not sent, {len(daemon.spool_files)} spool file(s) to read again next time.")
+    finally:
+        submission_server.shutdown()
+        submission_server.server_close()
+        Path(submit_path).unlink(missing_ok=True)
+        daemon.pool.close_all()
+
+
+if __name__ == "__main__":
+    main()
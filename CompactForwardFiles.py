@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+CompactForwardFiles.py
+Lists, rotates and compacts the segments that Server.py --rotate-bytes/--rotate-seconds moves
+forward files into (forward/.segments/<domain>/, see ForwardSegments in Server.py), and marks
+messages of v2 forward files as deleted so the compactor drops them.
+
+It takes the same lock files as the server's compactor, so it can be run while the server is up.
+"""
+
+import argparse
+import struct
+import sys
+import time
+from pathlib import Path
+from Client import FORWARD_FLAG_DELETED
+from ForwardFile import ForwardFile
+from Server import SEGMENTS_FOLDER_NAME, ForwardSegments
+
+FLAGS_OFFSET = struct.calcsize("<Id")
+"""
+Where the flags are in the header of a v2 record (FORWARD_V2_RECORD): after the length and the
+timestamp.
+"""
+
+
+def delete_forward_message(path: Path, number: int):
+    """
+    Marks message number of a v2 forward file (counting the messages that are not deleted yet, as
+    ForwardFile.py --message does) as deleted. The record stays in the file until the segment it
+    is in is compacted. The index of the file is removed, since it still has the message.
+    """
+
+    with ForwardFile(path, save_index=False) as forward_file:
+        if forward_file.format != "v2":
+            raise ValueError(f"{path} is a text forward file; only messages in v2 files can be marked deleted")
+        # message_bounds() raises IndexError for a message that is not there
+        forward_file.message_bounds(number)
+        offset = forward_file.offsets[number]
+        index_path = forward_file.index_path
+
+    with path.open("r+b") as f:
+        f.seek(offset + FLAGS_OFFSET)
+        flags = int.from_bytes(f.read(2), "little")
+        f.seek(offset + FLAGS_OFFSET)
+        f.write((flags | FORWARD_FLAG_DELETED).to_bytes(2, "little"))
+
+    index_path.unlink(missing_ok=True)
+
+
+def print_segments(forward_segments: ForwardSegments, domains: list):
+    """
+    Prints the segments of each domain from its manifest.
+    """
+
+    for domain in domains:
+        folder = forward_segments.get_segment_folder(domain)
+        manifest = forward_segments.read_manifest(folder)
+        total = sum(segment["bytes"] for segment in manifest["segments"])
+        print(f"{domain}: {len(manifest['segments'])} segment(s), {total / 1_000_000:.1f} MB")
+
+        for segment in manifest["segments"]:
+            counted = segment["messages"] is not None
+            print(f"  {segment['name']:<32} {segment['format']:<4} {segment['bytes'] / 1_000_000:>9.2f} MB  "
+                  f"{segment['messages'] if counted else '?':>9} message(s)  {segment['deleted'] if counted else '?':>7} deleted  "
+                  f"sealed {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(segment['sealed']))}")
+
+
+def get_command_line_arguments():
+    """
+    Handles the forward folder and what to do with it.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="List, rotate and compact the segments of forward files")
+
+    arg_parser.add_argument("forward_folder", action="store", type=Path, nargs="?", default=Path("forward"),
+                            help="The server's forward folder (default: ./forward)")
+    arg_parser.add_argument("--domain", action="store", default=None, help="Only this domain")
+    arg_parser.add_argument("--rotate", action="store_true", help="Move the forward file of --domain to its segments now")
+    arg_parser.add_argument("--compact", action="store_true", help="Merge small segments and drop deleted messages now")
+    arg_parser.add_argument("--target-bytes", action="store", type=int, default=0,
+                            help="Merge segments up to this size (default: 64 MB, or the server's --rotate-bytes)")
+    arg_parser.add_argument("--delete", action="store", nargs=2, metavar=("FILE", "N"), default=None,
+                            help="Mark message N of a v2 forward file or segment as deleted")
+
+    args = arg_parser.parse_args()
+
+    if args.rotate and not args.domain:
+        arg_parser.error("--rotate needs --domain")
+
+    return args
+
+
+def main():
+    """
+    Does what the options say, then lists the segments.
+    """
+
+    args = get_command_line_arguments()
+
+    if not args.forward_folder.is_dir():
+        print(f"The forward folder {args.forward_folder} does not exist.")
+        sys.exit(1)
+
+    forward_segments = ForwardSegments(args.forward_folder, args.target_bytes)
+
+    if args.delete:
+        path, number = Path(args.delete[0]), int(args.delete[1])
+        try:
+            delete_forward_message(path, number)
+        except (OSError, ValueError, IndexError) as e:
+            print(f"Could not delete message {number} of {path}: {e}")
+            sys.exit(1)
+        print(f"Marked message {number} of {path} as deleted.")
+
+    if args.rotate:
+        segment_path = forward_segments.rotate(args.domain)
+        print(f"Moved {args.forward_folder / args.domain} to {segment_path}." if segment_path else f"{args.forward_folder / args.domain} does not exist.")
+
+    if args.compact:
+        start = time.perf_counter()
+        written = forward_segments.compact(args.domain) if args.domain else forward_segments.compact_all()
+        if written < 0:
+            print(f"Another compactor is working on {args.domain}.")
+        else:
+            print(f"Wrote {written} segment(s) from {forward_segments.segments_merged}, dropped {forward_segments.messages_dropped} "
+                  f"deleted message(s), reclaimed {forward_segments.bytes_reclaimed / 1_000_000:.1f} MB in {time.perf_counter() - start:.2f}s")
+
+    segments_folder = args.forward_folder / SEGMENTS_FOLDER_NAME
+    domains = [args.domain] if args.domain else sorted(path.name for path in segments_folder.iterdir() if path.is_dir()) if segments_folder.is_dir() else []
+    print_segments(forward_segments, domains)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+CompressionBench.py
+Compares compressing the text of each message in a v2 forward file (Server.py
+--forward-compression) with zlib and lzma at several levels: how much smaller the file gets, what
+it costs to write a message and what it costs to read one back at random through ForwardFile.py.
+
+The messages are made up to look like mail (headers, a few paragraphs, a quoted reply and a
+signature), or come from a text forward file given with --corpus.
+"""
+
+import argparse
+import json
+import mmap
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from Client import FORWARD_V2_MAGIC, read_forward_v2_records
+from ConvertForwardFile import get_message_addresses
+from ForwardFile import ForwardFile, find_message_starts
+from Server import encode_forward_record
+
+WORDS = ("the a of to and in is it that for on with as be this we will at by from have are not our "
+         "meeting project schedule report update team please thanks review draft deadline server "
+         "client message delivery socket response command homework assignment grade question "
+         "attached file version change test result week friday monday morning afternoon lab office "
+         "hours email address domain forward parser grammar").split()
+
+CODECS = [("none", None), ("zlib", 1), ("zlib", 6), ("zlib", 9), ("lzma", 0), ("lzma", 1), ("lzma", 6)]
+"""
+(--forward-compression, level) pairs that are timed by default. "none" is the uncompressed v2
+file everything else is compared with.
+"""
+
+
+def generate_messages(count: int, seed: int = 431) -> list:
+    """
+    Returns count made-up messages in the text forward file format.
+    """
+
+    generator = random.Random(seed)
+    messages = []
+
+    for i in range(count):
+        sender = f"user{generator.randrange(500)}@cs.unc.edu"
+        recipients = [f"user{generator.randrange(5000)}@example{generator.randrange(20)}.com"
+                      for _ in range(1 + (generator.random() < 0.3))]
+
+        paragraphs = []
+        for _ in range(generator.randint(1, 4)):
+            sentences = [" ".join(generator.choices(WORDS, k=generator.randint(6, 16))).capitalize() + "."
+                         for _ in range(generator.randint(2, 6))]
+            paragraphs.append(" ".join(sentences))
+
+        lines = [f"From: <{sender}>"] + [f"To: <{recipient}>" for recipient in recipients]
+        lines += [f"Subject: Re: {' '.join(generator.choices(WORDS, k=4))}", ""]
+        lines += "\n\n".join(paragraphs).split("\n")
+        if generator.random() < 0.5:
+            lines += ["", f"On Monday, {recipients[0]} wrote:"]
+            lines += ["> " + " ".join(generator.choices(WORDS, k=12)) for _ in range(generator.randint(2, 8))]
+        lines += ["", "--", sender.split("@")[0], "Department of Computer Science"]
+
+        messages.append("\n".join(lines) + "\n")
+
+    return messages
+
+
+def read_corpus(path: Path, limit: int) -> list:
+    """
+    Returns up to limit messages from a text forward file.
+    """
+
+    with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        offsets, _ = find_message_starts(data, 0, len(data))
+        offsets = offsets[:limit + 1]
+        ends = list(offsets[1:]) + [len(data)]
+        return [data[start:end].decode("utf-8", errors="replace") for start, end in zip(offsets, ends)][:limit]
+
+
+def time_codec(messages: list, compression: str, level: int, folder: Path, reads: int) -> dict:
+    """
+    Writes messages to a v2 forward file with the given compression and returns its size, the
+    time to encode a message, the time to read a random message and the time to read them all.
+    """
+
+    path = folder / f"forward.{compression}{'' if level is None else level}"
+    addresses = [get_message_addresses(text) for text in messages]
+
+    start = time.perf_counter()
+    records = [encode_forward_record(sender, recipients, text, 0.0, compression=compression, level=level)
+               for text, (sender, recipients) in zip(messages, addresses)]
+    write_seconds = time.perf_counter() - start
+
+    with path.open("wb") as f:
+        f.write(FORWARD_V2_MAGIC)
+        f.writelines(records)
+
+    with ForwardFile(path, save_index=False) as forward_file:
+        numbers = [random.randrange(len(forward_file)) for _ in range(reads)]
+        times_us = []
+        for number in numbers:
+            read_start = time.perf_counter_ns()
+            forward_file.message(number)
+            times_us.append((time.perf_counter_ns() - read_start) / 1000)
+
+    start = time.perf_counter()
+    with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        read_count = sum(1 for _ in read_forward_v2_records(data, len(FORWARD_V2_MAGIC)))
+    scan_seconds = time.perf_counter() - start
+
+    if read_count != len(messages):
+        raise RuntimeError(f"{path} has {read_count} message(s) instead of {len(messages)}")
+
+    return {
+        "compression": compression or "none",
+        "level": level,
+        "bytes": path.stat().st_size,
+        "write_us": write_seconds / len(messages) * 1_000_000,
+        "random_read_us": statistics.median(times_us),
+        "scan_us": scan_seconds / len(messages) * 1_000_000,
+    }
+
+
+def get_command_line_arguments():
+    """
+    Handles the corpus and how much of it to time.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Compression ratio and cost for v2 forward files")
+
+    arg_parser.add_argument("--messages", action="store", type=int, default=20_000,
+                            help="Number of messages to make up, or the most to take from --corpus")
+    arg_parser.add_argument("--corpus", action="store", type=Path, default=None,
+                            help="Take the messages from this text forward file instead")
+    arg_parser.add_argument("--reads", action="store", type=int, default=10_000, help="Random reads per codec")
+    arg_parser.add_argument("--save", action="store", type=Path, default=None, help="Write the results to this file as JSON")
+
+    return arg_parser.parse_args()
+
+
+def main():
+    """
+    Times every codec and prints a table, with the ratio against the uncompressed v2 file.
+    """
+
+    args = get_command_line_arguments()
+
+    if args.corpus:
+        if not args.corpus.is_file():
+            print(f"The forward file {args.corpus} does not exist.")
+            sys.exit(1)
+        messages = read_corpus(args.corpus, args.messages)
+    else:
+        messages = generate_messages(args.messages)
+
+    text_bytes = sum(len(text.encode()) for text in messages)
+    print(f"{len(messages)} message(s), {text_bytes / 1_000_000:.1f} MB of text, "
+          f"{text_bytes / max(1, len(messages)):.0f} bytes per message", file=sys.stderr)
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_folder:
+        for compression, level in CODECS:
+            compression = "" if compression == "none" else compression
+            result = time_codec(messages, compression, level, Path(work_folder), args.reads)
+            result["ratio"] = results[0]["bytes"] / result["bytes"] if results else 1.0
+            results.append(result)
+            print(f"  {result['compression']:<5} {'' if level is None else level:>2}  {result['bytes'] / 1_000_000:>7.2f} MB  "
+                  f"ratio={result['ratio']:.2f}  write={result['write_us']:>6.1f}us  "
+                  f"random read={result['random_read_us']:>6.1f}us  scan={result['scan_us']:>6.1f}us", file=sys.stderr)
+
+    if args.save:
+        with args.save.open("w", encoding="utf-8") as f:
+            json.dump({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "messages": len(messages),
+                       "text_bytes": text_bytes, "results": results}, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
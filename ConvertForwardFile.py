@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+ConvertForwardFile.py
+Converts a forward file between the text format and the v2 format that Server.py writes with
+--forward-format v2 (length-prefixed records; see FORWARD_V2_RECORD in Server.py). The text of each
+message is kept exactly, so converting to v2 and back gives the same file.
+
+Going to v2, a message starts at each "From: <address>" line the grammar accepts (a "From:" line
+in a body stays in its message), and the sender and recipients come from the "From:" and "To:"
+lines at the top of each message. A text forward file does not keep the time each message was
+accepted, so every record gets the time the input file was last changed, the latest it could
+have been. With --forward-compression and --compression-level, the text of each message is
+compressed on its own, the same as Server.py does with those options.
+"""
+
+import argparse
+import mmap
+import sys
+import time
+from pathlib import Path
+from Client import FORWARD_V2_MAGIC, get_forward_file_format, read_forward_v2_records
+from ForwardFile import find_message_starts
+from Server import FORWARD_COMPRESSORS, encode_forward_record
+
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+
+def get_message_addresses(text: str) -> tuple:
+    """
+    Returns (sender, recipients) from the "From:" line and the "To:" lines (each with one or more
+    comma-separated addresses) that a message in a forward file starts with.
+    """
+
+    sender = ""
+    recipients = []
+
+    for line in text.split("\n"):
+        if line.startswith("From:") and not sender and not recipients:
+            sender = line[len("From:"):].strip().strip("<>")
+        elif line.startswith("To:"):
+            recipients.extend(address.strip().strip("<>") for address in line[len("To:"):].split(","))
+        else:
+            break
+
+    return sender, recipients
+
+
+def convert_text_to_v2(input_path: Path, output_path: Path, compression: str = "", level: int = None) -> int:
+    """
+    Writes every message of a text forward file to a v2 forward file and returns how many there
+    were. Anything before the first "From:" line is not part of a message and is left out. Every
+    record gets the modification time of the input file as its timestamp. compression and level
+    are passed on to encode_forward_record().
+    """
+
+    count = 0
+    timestamp = input_path.stat().st_mtime
+
+    with input_path.open("rb") as f, output_path.open("wb", buffering=OUTPUT_BUFFER_SIZE) as output:
+        output.write(FORWARD_V2_MAGIC)
+        if f.seek(0, 2) == 0:
+            return 0
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offsets, _ = find_message_starts(data, 0, len(data))
+
+            # find_message_starts() leaves out a last line without a newline, which is still part
+            # of the last message here
+            for number, start in enumerate(offsets):
+                end = offsets[number + 1] if number + 1 < len(offsets) else len(data)
+                text = data[start:end].decode("utf-8", errors="replace")
+                sender, recipients = get_message_addresses(text)
+                output.write(encode_forward_record(sender, recipients, text, timestamp, compression=compression, level=level))
+                count += 1
+
+    return count
+
+
+def convert_v2_to_text(input_path: Path, output_path: Path) -> int:
+    """
+    Writes the text of every message of a v2 forward file that has not been deleted to a text
+    forward file and returns how many there were.
+    """
+
+    count = 0
+
+    with input_path.open("rb") as f, output_path.open("wb", buffering=OUTPUT_BUFFER_SIZE) as output, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for *_, text in read_forward_v2_records(data, len(FORWARD_V2_MAGIC)):
+            output.write(text.encode())
+            count += 1
+
+    return count
+
+
+def get_command_line_arguments():
+    """
+    Handles the input and output files and which way to convert.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Convert a forward file between the text and the v2 formats")
+
+    arg_parser.add_argument("input", action="store", type=Path, help="Forward file to read")
+    arg_parser.add_argument("output", action="store", type=Path, help="Forward file to write")
+    arg_parser.add_argument("--to", action="store", choices=["text", "v2"], default=None,
+                            help="Format to convert to (default: the other one)")
+    arg_parser.add_argument("--forward-compression", action="store", choices=list(FORWARD_COMPRESSORS), default="",
+                            help="Compress the text of each message when converting to v2, as for Server.py")
+    arg_parser.add_argument("--compression-level", action="store", type=int, default=None,
+                            help="zlib level (1-9, default 6) or lzma preset (0-9, default 1)")
+
+    args = arg_parser.parse_args()
+
+    if args.output.exists() and args.output.resolve() == args.input.resolve():
+        arg_parser.error("the output has to be a different file from the input")
+
+    if args.compression_level is not None and not 0 <= args.compression_level <= 9:
+        arg_parser.error("--compression-level must be between 0 and 9")
+
+    return args
+
+
+def main():
+    """
+    Converts the file and says how long it took.
+    """
+
+    args = get_command_line_arguments()
+
+    if not args.input.is_file():
+        print(f"The forward file {args.input} does not exist.")
+        sys.exit(1)
+
+    input_format = get_forward_file_format(args.input)
+    output_format = args.to or ("text" if input_format == "v2" else "v2")
+
+    start = time.perf_counter()
+    if input_format == output_format:
+        print(f"{args.input} is already in the {output_format} format.")
+        sys.exit(1)
+    elif args.forward_compression and output_format != "v2":
+        print("Only v2 forward files can be compressed.")
+        sys.exit(1)
+    elif output_format == "v2":
+        count = convert_text_to_v2(args.input, args.output, args.forward_compression, args.compression_level)
+    else:
+        count = convert_v2_to_text(args.input, args.output)
+
+    print(f"Converted {count} message(s) from {input_format} to {output_format}: {args.input.stat().st_size / 1_000_000:.1f} MB -> "
+          f"{args.output.stat().st_size / 1_000_000:.1f} MB in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
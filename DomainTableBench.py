@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+DomainTableBench.py
+Times DomainTable lookups (the suffix trie behind --domain-table in Server.py and the routes of
+Relay.py) for tables of increasing size, up to 1,000,000 patterns by default. A lookup should
+cost the same at every size, since it only depends on the number of labels in the domain. For
+the smaller tables, a linear scan over the patterns is timed too for comparison.
+"""
+
+import argparse
+import json
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+from Server import DomainTable, load_domain_table
+from ParserBench import time_case
+
+TOP_LEVEL_DOMAINS = ["com", "org", "net", "edu", "gov", "io", "dev", "uk", "de", "jp"]
+
+
+def generate_patterns(count: int):
+    """
+    Yields (pattern, value) pairs: every other one is a wildcard for an organization
+    ("*.org12.com") and the rest are single hosts ("host13.org6.net").
+    """
+
+    for i in range(count):
+        tld = TOP_LEVEL_DOMAINS[i % len(TOP_LEVEL_DOMAINS)]
+        if i % 2 == 0:
+            yield f"*.org{i}.{tld}", "reject"
+        else:
+            yield f"host{i}.org{i // 2}.{tld}", "accept"
+
+
+def build_cases(count: int) -> dict:
+    """
+    Returns {case name: domain} for domains that hit the table in different ways and for ones that
+    miss it.
+    """
+
+    last_wildcard = (count - 1) // 2 * 2
+    last_host = count - 1 if count % 2 == 0 else count - 2
+
+    return {
+        "exact_host": f"host{last_host}.org{last_host // 2}.{TOP_LEVEL_DOMAINS[last_host % len(TOP_LEVEL_DOMAINS)]}",
+        "wildcard": f"mail.org{last_wildcard}.{TOP_LEVEL_DOMAINS[last_wildcard % len(TOP_LEVEL_DOMAINS)]}",
+        "wildcard_deep": f"a.b.c.d.mail.org{last_wildcard}.{TOP_LEVEL_DOMAINS[last_wildcard % len(TOP_LEVEL_DOMAINS)]}",
+        "miss_tld": "cs.unc.example",
+        "miss_org": "mail.nobody.com",
+        "miss_long": ".".join(f"d{i}" for i in range(20)) + ".com",
+    }
+
+
+def linear_lookup(patterns: list, domain: str):
+    """
+    What a lookup costs without the trie: check every pattern, keeping the longest match.
+    """
+
+    best, best_length = None, -1
+    for pattern, value in patterns:
+        if pattern.startswith("*."):
+            matches = domain.endswith(pattern[1:])
+        else:
+            matches = domain == pattern
+
+        if matches and len(pattern) > best_length:
+            best, best_length = value, len(pattern)
+
+    return best
+
+
+def max_rss_mb() -> float:
+    """
+    Returns the most memory this process has used so far, in MB (ru_maxrss is in KB on Linux).
+    """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_benchmarks(sizes: list, repeat: int, min_time: float, linear_limit: int, load_file: bool) -> dict:
+    """
+    Builds a table of each size and times every case against it.
+    """
+
+    results = {}
+
+    for count in sizes:
+        patterns = list(generate_patterns(count))
+
+        start = time.perf_counter()
+        table = DomainTable()
+        for pattern, value in patterns:
+            table.add(pattern, value)
+        build_seconds = time.perf_counter() - start
+
+        size_results = {"patterns": table.size, "build_s": build_seconds, "max_rss_mb": max_rss_mb(), "cases": {}}
+
+        # Reading the same table from a file is what a SIGHUP reload costs
+        if load_file:
+            with tempfile.NamedTemporaryFile("w", suffix=".table", encoding="utf-8", delete=False) as f:
+                f.writelines(f"{pattern} {value}\n" for pattern, value in patterns)
+            start = time.perf_counter()
+            load_domain_table(Path(f.name))
+            size_results["load_file_s"] = time.perf_counter() - start
+            Path(f.name).unlink()
+
+        print(f"{count:>9} patterns: built in {build_seconds:.2f}s, max RSS {size_results['max_rss_mb']:.0f} MB"
+              + (f", loaded from a file in {size_results['load_file_s']:.2f}s" if load_file else ""), file=sys.stderr)
+
+        for name, domain in build_cases(count).items():
+            summary = time_case(lambda: table.lookup(domain), repeat, min_time)
+            size_results["cases"][name] = summary
+            print(f"  {name:<20} {table.lookup(domain)!s:<8} min={summary['min_us']:>8.3f}us  median={summary['median_us']:>8.3f}us", file=sys.stderr)
+
+            if count <= linear_limit:
+                summary = time_case(lambda: linear_lookup(patterns, domain), repeat, min_time)
+                size_results["cases"][f"{name}/linear"] = summary
+                print(f"  {name + '/linear':<20} {linear_lookup(patterns, domain)!s:<8} min={summary['min_us']:>8.1f}us", file=sys.stderr)
+
+        results[str(count)] = size_results
+
+        # Free this table before building the next one
+        del table, patterns
+
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "sizes": results}
+
+
+def get_command_line_arguments():
+    """
+    Handles the table sizes and the timing options.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Lookup benchmark for DomainTable")
+
+    arg_parser.add_argument("--sizes", action="store", type=lambda text: [int(size) for size in text.split(",")],
+                            default=[1_000, 100_000, 1_000_000], help="Comma-separated table sizes (default 1000,100000,1000000)")
+    arg_parser.add_argument("--linear-limit", action="store", type=int, default=1_000,
+                            help="Also time a linear scan for tables up to this size")
+    arg_parser.add_argument("--load-file", action="store_true",
+                            help="Also time reading each table from a file, which is what a SIGHUP reload does")
+    arg_parser.add_argument("--repeat", action="store", type=int, default=5, help="Number of timed repetitions per case")
+    arg_parser.add_argument("--min-time", action="store", type=float, default=0.05,
+                            help="Minimum number of seconds for one repetition")
+    arg_parser.add_argument("--save", action="store", type=Path, default=None, help="Write the results to this file as JSON")
+
+    return arg_parser.parse_args()
+
+
+def main():
+    """
+    Runs the benchmarks and optionally saves them.
+    """
+
+    args = get_command_line_arguments()
+    results = run_benchmarks(args.sizes, args.repeat, args.min_time, args.linear_limit, args.load_file)
+
+    if args.save:
+        with args.save.open("w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
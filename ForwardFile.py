@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+ForwardFile.py
+Reads the forward files that Server.py appends to (forward/<domain>) without going through them
+line by line. The file is memory-mapped and the start of every message (a "From: " at the start of
+a line) is found with mmap.find(), which searches in C; each line it finds is checked with the
+forward file grammar, so a "From: " line in a body stays part of its message. The offsets are kept in an index file next
+to the forward file (forward/.index/<domain>.idx), so they only have to be found once: when the
+file grows, only the new part is searched and the new offsets are appended to the index.
+
+With the index, getting message N is two array lookups and a slice, and going through the
+messages yields memoryview slices of the mapped file, so nothing is copied until it is decoded.
+
+Forward files in the v2 format (Server.py --forward-format v2) are indexed by following the
+lengths in the record headers instead, skipping deleted records, and a message is the text part
+of its record. Records whose text is compressed (--forward-compression) are decompressed one at a
+time when they are read, so getting message N still does not touch any other message.
+"""
+
+import argparse
+import mmap
+import struct
+import sys
+import time
+from array import array
+from functools import lru_cache
+from pathlib import Path
+from Client import FORWARD_V2_MAGIC, FORWARD_V2_RECORD, FORWARD_FLAG_DELETED, Parser, decompress_forward_text
+
+INDEX_FOLDER_NAME = ".index"
+"""
+Folder inside the forward folder that holds the index files. It starts with "." so that Relay.py
+and the client's spool folder skip it like any other hidden file.
+"""
+
+FORWARD_INDEX_MAGIC = b"FWDIDX02"
+FORWARD_INDEX_HEADER = struct.Struct("<8sQQQ")
+"""
+magic, inode of the forward file, number of bytes of the forward file that have been searched,
+number of offsets. The offsets follow as little-endian 64-bit integers.
+"""
+
+MESSAGE_START = b"From: "
+"""
+Every message in a forward file starts with its "From: <address>" line.
+"""
+
+SENDER_CACHE_SIZE = 1 << 16
+"""
+"From: " lines whose check against the grammar is remembered.
+"""
+
+
+def get_index_path(forward_path: Path) -> Path:
+    """
+    Returns where the index of a forward file is kept: forward/.index/<domain>.idx.
+    """
+
+    return forward_path.parent / INDEX_FOLDER_NAME / f"{forward_path.name}.idx"
+
+
+@lru_cache(maxsize=SENDER_CACHE_SIZE)
+def is_message_start(line: bytes) -> bool:
+    """
+    Returns whether a line (with its newline) is a "From: <address>" line that starts a message,
+    with the same check as read_forward_lines_messages(). Most mail comes from a few senders, so
+    the answers are kept.
+    """
+
+    return Parser(line.decode("utf-8", errors="replace")).forwardfile_match_from_address()
+
+
+def find_message_starts(data, start: int, end: int) -> tuple:
+    """
+    Returns (offsets, searched_to): the offset of every message that starts in data[start:end],
+    and how far the search can be trusted. Only whole lines are searched, so a "From: " line that
+    is still being written is found by the next search, which should begin at searched_to. A
+    "From: " line that does not match the grammar (such as one in a body) does not start a message.
+    """
+
+    # Everything after the last newline may be a partial line
+    searched_to = data.rfind(b"\n", start, end) + 1
+    if searched_to <= start:
+        return [], start
+
+    offsets = []
+    if start == 0 and data[:len(MESSAGE_START)] == MESSAGE_START and is_message_start(data[:data.find(b"\n", 0, searched_to) + 1]):
+        offsets.append(0)
+
+    # A message can only start right after a newline, so the newline before start has to be part
+    # of the search as well. find() only returns matches that end before searched_to, which leaves
+    # out a line that starts exactly at searched_to.
+    pattern = b"\n" + MESSAGE_START
+    position = data.find(pattern, max(start - 1, 0), searched_to)
+    while position != -1:
+        if is_message_start(data[position + 1:data.find(b"\n", position + 1, searched_to) + 1]):
+            offsets.append(position + 1)
+        position = data.find(pattern, position + len(pattern), searched_to)
+
+    return offsets, searched_to
+
+
+def find_v2_records(data, start: int, end: int) -> tuple:
+    """
+    The same as find_message_starts() for a v2 forward file: returns the offset of every record in
+    data[start:end] that has not been deleted, and where the last whole record ends. Only the
+    record headers are read.
+    """
+
+    position = max(start, len(FORWARD_V2_MAGIC))
+    offsets = []
+
+    while position + FORWARD_V2_RECORD.size <= end:
+        length, _, flags, _, _ = FORWARD_V2_RECORD.unpack_from(data, position)
+        record_end = position + FORWARD_V2_RECORD.size + length
+        if record_end > end:
+            break
+
+        if not flags & FORWARD_FLAG_DELETED:
+            offsets.append(position)
+        position = record_end
+
+    return offsets, position
+
+
+class ForwardFile:
+    """
+    A memory-mapped forward file and the offsets of its messages. len() is the number of messages
+    and forward_file[n] is message n as a memoryview. Call refresh() to see messages that were
+    appended after it was opened.
+
+    The memoryview slices point into the mapped file, so they have to be released (or simply
+    dropped) before close() can unmap it.
+    """
+
+    def __init__(self, path: Path, index_path: Path = None, save_index: bool = True):
+        self.path = path
+        self.index_path = index_path or get_index_path(path)
+
+        self.save_index = save_index
+        """
+        If False, the offsets are only kept in memory (for a forward file in a folder that cannot
+        be written to).
+        """
+
+        self.offsets = array("Q")
+        """
+        Where each message starts in the file.
+        """
+
+        self.searched_to = 0
+        """
+        How much of the file has been searched for messages. Messages can only be appended, so
+        only the part after this has to be searched when the file grows.
+        """
+
+        self.inode = 0
+        self.size = 0
+        self.mapped = None
+
+        self.format = "text"
+        """
+        "text" or "v2", from the first bytes of the file.
+        """
+
+        self.load_index()
+        self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, number: int) -> memoryview:
+        return self.message(number)
+
+    def __iter__(self):
+        return self.messages()
+
+    def load_index(self):
+        """
+        Reads the saved offsets, unless the index is missing, damaged or for a different file
+        (the forward file was replaced or truncated), in which case the file is searched again
+        from the start.
+        """
+
+        try:
+            with self.index_path.open("rb") as f:
+                header = f.read(FORWARD_INDEX_HEADER.size)
+                if len(header) != FORWARD_INDEX_HEADER.size:
+                    return
+
+                magic, inode, searched_to, count = FORWARD_INDEX_HEADER.unpack(header)
+                stat = self.path.stat()
+                if magic != FORWARD_INDEX_MAGIC or inode != stat.st_ino or searched_to > stat.st_size:
+                    return
+
+                offsets = array("Q")
+                offsets.frombytes(f.read(count * offsets.itemsize))
+        except (OSError, ValueError):
+            return
+
+        if sys.byteorder != "little":
+            offsets.byteswap()
+
+        if len(offsets) != count:
+            return
+
+        self.offsets = offsets
+        self.searched_to = searched_to
+        self.inode = inode
+
+    def write_index(self, first_new: int):
+        """
+        Appends the offsets from first_new onwards to the index file and then updates its header,
+        so an index that was cut short by a crash only looks like an older one.
+        """
+
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+
+        new_offsets = self.offsets[first_new:]
+        if sys.byteorder != "little":
+            new_offsets.byteswap()
+
+        # Rewrite the whole file if it does not hold exactly the offsets before first_new
+        expected_size = FORWARD_INDEX_HEADER.size + first_new * self.offsets.itemsize
+        rewrite = first_new == 0 or not self.index_path.exists() or self.index_path.stat().st_size < expected_size
+
+        if rewrite:
+            first_new = 0
+            new_offsets = array("Q", self.offsets)
+            if sys.byteorder != "little":
+                new_offsets.byteswap()
+
+        with self.index_path.open("wb" if rewrite else "r+b") as f:
+            if rewrite:
+                # Not counted until the header below is written
+                f.write(FORWARD_INDEX_HEADER.pack(FORWARD_INDEX_MAGIC, self.inode, 0, 0))
+            f.seek(FORWARD_INDEX_HEADER.size + first_new * self.offsets.itemsize)
+            f.write(new_offsets.tobytes())
+            f.truncate()
+            f.seek(0)
+            f.write(FORWARD_INDEX_HEADER.pack(FORWARD_INDEX_MAGIC, self.inode, self.searched_to, len(self.offsets)))
+
+    def refresh(self) -> int:
+        """
+        Maps the file again if it has grown, finds the messages in the new part and returns how
+        many were found. A file that was replaced or truncated is indexed again from the start.
+        """
+
+        stat = self.path.stat()
+
+        if stat.st_ino != self.inode or stat.st_size < self.searched_to:
+            self.offsets = array("Q")
+            self.searched_to = 0
+            self.inode = stat.st_ino
+
+        if stat.st_size == self.size and self.mapped is not None:
+            return 0
+
+        self.unmap()
+        self.size = stat.st_size
+        if self.size == 0:
+            return 0
+
+        with self.path.open("rb") as f:
+            self.mapped = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+
+        self.format = "v2" if self.mapped[:len(FORWARD_V2_MAGIC)] == FORWARD_V2_MAGIC else "text"
+
+        # A file that was truncated and has grown back past the old size since has the same inode
+        # and a bigger size; the last known message would most likely not start where it used to
+        if self.offsets and self.format == "text":
+            last = self.offsets[-1]
+            if self.mapped[last:last + len(MESSAGE_START)] != MESSAGE_START:
+                self.offsets = array("Q")
+                self.searched_to = 0
+
+        first_new = len(self.offsets)
+        if self.format == "v2":
+            offsets, self.searched_to = find_v2_records(self.mapped, self.searched_to, self.size)
+        else:
+            offsets, self.searched_to = find_message_starts(self.mapped, self.searched_to, self.size)
+        self.offsets.extend(offsets)
+
+        if self.save_index and (offsets or first_new == 0):
+            try:
+                self.write_index(first_new)
+            except OSError as e:
+                print(f"Could not save the index of {self.path} to {self.index_path}: {e}", file=sys.stderr)
+                self.save_index = False
+
+        return len(offsets)
+
+    def message_bounds(self, number: int) -> tuple:
+        """
+        Returns (start, end) of message number in the file. Negative numbers count from the end.
+        The last message ends at the end of the file. In a v2 file, this is the text part of the
+        record, after the header and the addresses.
+        """
+
+        if number < 0:
+            number += len(self.offsets)
+        if not 0 <= number < len(self.offsets):
+            raise IndexError(f"{self.path} has {len(self.offsets)} message(s), not {number + 1}")
+
+        start = self.offsets[number]
+
+        if self.format == "v2":
+            length, _, _, recipient_count, _ = FORWARD_V2_RECORD.unpack_from(self.mapped, start)
+            end = start + FORWARD_V2_RECORD.size + length
+            start += FORWARD_V2_RECORD.size
+            # Skip the sender and the recipients, one per line
+            for _ in range(recipient_count + 1):
+                start = self.mapped.find(b"\n", start, end) + 1
+            return start, end
+
+        end = self.offsets[number + 1] if number + 1 < len(self.offsets) else self.size
+        return start, end
+
+    def message(self, number: int) -> memoryview:
+        """
+        Returns message number as a memoryview of the mapped file, without copying it. The text of
+        a compressed v2 record is decompressed on its own, and the view is of that copy.
+        """
+
+        start, end = self.message_bounds(number)
+        view = memoryview(self.mapped)[start:end]
+
+        if self.format == "v2":
+            flags = FORWARD_V2_RECORD.unpack_from(self.mapped, self.offsets[number])[2]
+            if flags & ~FORWARD_FLAG_DELETED:
+                return memoryview(decompress_forward_text(flags, view))
+
+        return view
+
+    def message_text(self, number: int) -> str:
+        """
+        Returns message number decoded as text.
+        """
+
+        return str(self.message(number), "utf-8", errors="replace")
+
+    def messages(self, start: int = 0, stop: int = None):
+        """
+        Yields messages start through stop - 1 (all of them by default) as memoryview slices, one
+        at a time.
+        """
+
+        stop = len(self.offsets) if stop is None else min(stop, len(self.offsets))
+        view = memoryview(self.mapped) if self.mapped is not None else None
+
+        for number in range(start, stop):
+            if self.format == "v2":
+                yield self.message(number)
+                continue
+
+            message_start = self.offsets[number]
+            message_end = self.offsets[number + 1] if number + 1 < len(self.offsets) else self.size
+            yield view[message_start:message_end]
+
+    def unmap(self):
+        """
+        Unmaps the file. If memoryview slices of it are still around, the mapping stays until
+        they are gone.
+        """
+
+        if self.mapped is None:
+            return
+
+        try:
+            self.mapped.close()
+        except BufferError:
+            pass
+
+        self.mapped = None
+
+    def close(self):
+        self.unmap()
+
+
+def get_command_line_arguments():
+    """
+    Handles the forward file and what to show from it.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Index the messages of a forward file and read them by number")
+
+    arg_parser.add_argument("forward_file", action="store", type=Path, help="Forward file to index, e.g. forward/cs.unc.edu")
+    arg_parser.add_argument("--message", action="store", type=int, default=None, metavar="N",
+                            help="Print message N (counting from 0; negative numbers count from the end)")
+    arg_parser.add_argument("--rebuild", action="store_true", help="Ignore the saved index and search the whole file again")
+    arg_parser.add_argument("--no-save", action="store_true", help="Do not write the index file")
+
+    return arg_parser.parse_args()
+
+
+def main():
+    """
+    Indexes the forward file, says how long it took and optionally prints one message.
+    """
+
+    args = get_command_line_arguments()
+
+    if not args.forward_file.is_file():
+        print(f"The forward file {args.forward_file} does not exist.")
+        sys.exit(1)
+
+    if args.rebuild:
+        get_index_path(args.forward_file).unlink(missing_ok=True)
+
+    start = time.perf_counter()
+    with ForwardFile(args.forward_file, save_index=not args.no_save) as forward_file:
+        seconds = time.perf_counter() - start
+        print(f"{args.forward_file}: {len(forward_file)} message(s) in {forward_file.size / 1_000_000:.1f} MB, "
+              f"indexed in {seconds * 1000:.1f}ms", file=sys.stderr)
+
+        if args.message is not None:
+            try:
+                sys.stdout.write(forward_file.message_text(args.message))
+            except IndexError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+ForwardFileBench.py
+Times SMTP2.py turning a large forward file (1,000,000 messages by default) into SMTP commands.
+The responses it expects are generated along with the forward file and piped in all at once, so
+the time is spent in SMTP2.py and not waiting for a server. SMTP2.py is also timed with a
+--responses script instead of stdin, and another copy of SMTP2.py (an older version, for example)
+can be timed on the same files for comparison.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SMTP2_PATH = Path(__file__).resolve().parent / "SMTP2.py"
+
+
+def generate_forward_file(forward_path: Path, responses_path: Path, count: int, body_lines: int):
+    """
+    Writes count messages to forward_path and, to responses_path, the responses SMTP2.py needs to
+    send all of them: 250 for MAIL FROM and every RCPT TO, 354 for DATA and 250 for the end of the
+    message. Every third message has a second recipient.
+    """
+
+    with forward_path.open("w", encoding="utf-8", newline="\n") as forward_file, \
+         responses_path.open("w", encoding="utf-8", newline="\n") as responses_file:
+        for i in range(count):
+            recipients = [f"user{i}@host{i % 97}.example.com"]
+            if i % 3 == 0:
+                recipients.append(f"copy{i}@host{i % 89}.example.org")
+
+            forward_file.write(f"From: <sender{i % 1000}@example.edu>\n")
+            forward_file.writelines(f"To: <{recipient}>\n" for recipient in recipients)
+            forward_file.write(f"Subject: message {i}\n\n")
+            forward_file.writelines(f"Line {line} of the body of message {i}.\n" for line in range(body_lines))
+
+            responses_file.write("250 OK\n" * (1 + len(recipients)) + "354 Start mail input\n250 OK\n")
+
+
+def write_response_script(script_path: Path):
+    """
+    Writes a response script for SMTP2.py --responses that accepts every command.
+    """
+
+    with script_path.open("w", encoding="utf-8") as f:
+        f.write("MAIL: 250 OK\nRCPT: 250 OK\nDATA: 354 Start mail input\n.: 250 OK\n")
+
+
+def time_script(script: Path, forward_path: Path, responses_path: Path, extra_arguments: list = None) -> dict:
+    """
+    Runs script on the forward file with the responses on stdin and its output thrown away, and
+    returns how long it took and how much memory it used.
+    """
+
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    with responses_path.open("rb") as responses_file, open(os.devnull, "wb") as devnull:
+        completed = subprocess.run([sys.executable, str(script), str(forward_path)] + (extra_arguments or []),
+                                   stdin=responses_file, stdout=devnull, stderr=devnull)
+    seconds = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        "script": str(script),
+        "exit_code": completed.returncode,
+        "seconds": seconds,
+        "cpu_seconds": (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+        # ru_maxrss is the largest child so far, so this is only exact for the first run
+        "max_rss_mb": after.ru_maxrss / 1024,
+    }
+
+
+def get_command_line_arguments():
+    """
+    Handles the size of the forward file and which scripts to time.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Throughput benchmark for SMTP2.py on a large forward file")
+
+    arg_parser.add_argument("--messages", action="store", type=int, default=1_000_000,
+                            help="Number of messages in the generated forward file")
+    arg_parser.add_argument("--body-lines", action="store", type=int, default=3, help="Lines of body per message")
+    arg_parser.add_argument("--baseline", action="store", type=Path, default=None,
+                            help="Also time this copy of SMTP2.py on the same files")
+    arg_parser.add_argument("--no-scripted", action="store_true",
+                            help="Do not also time SMTP2.py --responses with a script that accepts everything")
+    arg_parser.add_argument("--keep", action="store", type=Path, default=None,
+                            help="Write the forward file and responses into this folder and keep them")
+    arg_parser.add_argument("--save", action="store", type=Path, default=None, help="Write the results to this file as JSON")
+
+    return arg_parser.parse_args()
+
+
+def main():
+    """
+    Generates the files, times each script and prints messages per second.
+    """
+
+    args = get_command_line_arguments()
+
+    with tempfile.TemporaryDirectory() as work_folder:
+        folder = args.keep or Path(work_folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        forward_path = folder / "forward.txt"
+        responses_path = folder / "responses.txt"
+
+        generate_forward_file(forward_path, responses_path, args.messages, args.body_lines)
+        print(f"Generated {args.messages} message(s), {forward_path.stat().st_size / 1_000_000:.1f} MB", file=sys.stderr)
+
+        script_path = folder / "responses.script"
+        write_response_script(script_path)
+
+        # name: (script, extra arguments)
+        scripts = {"SMTP2.py": (SMTP2_PATH, [])}
+        if not args.no_scripted:
+            scripts["scripted"] = (SMTP2_PATH, ["--responses", str(script_path)])
+        if args.baseline:
+            scripts["baseline"] = (args.baseline, [])
+
+        results = {}
+        for name, (script, extra_arguments) in scripts.items():
+            result = time_script(script, forward_path, responses_path, extra_arguments)
+            result["messages_per_second"] = args.messages / result["seconds"]
+            results[name] = result
+            print(f"  {name:<10} {result['seconds']:>8.1f}s  {result['messages_per_second']:>10.0f} messages/s  "
+                  f"exit={result['exit_code']}", file=sys.stderr)
+
+    if args.save:
+        with args.save.open("w", encoding="utf-8") as f:
+            json.dump({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "messages": args.messages,
+                       "body_lines": args.body_lines, "results": results}, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+ImportMail.py
+Loads existing mail into the forward folder without going through SMTP: mbox files, or forward
+files in either format. The "From:" and "To:" headers of every message are checked with the same
+grammar the forward files are read with (Parser.forwardfile_match_from_address() and
+forwardfile_match_to_address()), and each message is appended to the forward file of every
+domain it is addressed to by SMTPServer.append_to_forward_file(), the same code the server
+delivers with, so formats, compression and rotation work the same way.
+
+The input is split into ranges at message boundaries. A pool of processes reads and checks the
+ranges; the main process writes the messages of each range, grouped by domain, with one write per
+domain, in the order of the input. With --mail-index, the main process also adds each message to
+the index of delivered mail (MailIndexer, as Server.py --mail-index does).
+"""
+
+import argparse
+import hashlib
+import mmap
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from email.utils import getaddresses, parsedate_to_datetime
+from pathlib import Path
+from Server import FORWARD_COMPRESSORS, FORWARD_FORMATS, FORWARD_V2_MAGIC, FORWARD_V2_RECORD, MAIL_INDEX_FOLDER_NAME, ForwardSegments, \
+    MailIndexer, Parser, SMTPServer
+from Client import read_forward_v2_records
+from ForwardFile import find_message_starts, is_message_start
+
+INPUT_FORMATS = ["auto", "mbox", "forward"]
+
+MESSAGE_STARTS = {"mbox": b"From ", "forward": b"From: "}
+"""
+What the first line of every message starts with, by input format.
+"""
+
+ADDRESS_CACHE_SIZE = 1 << 16
+"""
+Addresses whose check against the grammar each process remembers.
+"""
+
+RANGE_BYTES = 16 << 20
+"""
+Size of the ranges the input is split into (--chunk-bytes).
+"""
+
+
+def get_input_format(path: Path) -> str:
+    """
+    Returns "v2" for a v2 forward file, "forward" for a text forward file and "mbox" for an mbox
+    file, based on its first bytes.
+    """
+
+    with path.open("rb") as f:
+        start = f.read(len(FORWARD_V2_MAGIC))
+
+    if start == FORWARD_V2_MAGIC:
+        return "v2"
+    return "forward" if start.startswith(MESSAGE_STARTS["forward"]) else "mbox"
+
+
+def get_input_ranges(path: Path, input_format: str, chunk_bytes: int) -> list:
+    """
+    Returns (start, end) byte ranges that cover the input, each starting at the beginning of a
+    message and about chunk_bytes long.
+    """
+
+    size = path.stat().st_size
+    starts = [len(FORWARD_V2_MAGIC) if input_format == "v2" else 0]
+    if size - starts[0] <= chunk_bytes:
+        return [(starts[0], size)]
+
+    with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if input_format == "v2":
+            # Follow the record lengths and cut at the first record past each chunk
+            position = starts[0]
+            while position + FORWARD_V2_RECORD.size <= size:
+                if position - starts[-1] >= chunk_bytes:
+                    starts.append(position)
+                position += FORWARD_V2_RECORD.size + FORWARD_V2_RECORD.unpack_from(data, position)[0]
+        else:
+            pattern = b"\n" + MESSAGE_STARTS[input_format]
+            position = data.find(pattern, starts[-1] + chunk_bytes)
+            while position != -1:
+                # In a forward file, a "From: " line in a body does not start a message
+                if input_format == "forward" and not is_message_start(data[position + 1:data.find(b"\n", position + 1) + 1]):
+                    position = data.find(pattern, position + 1)
+                    continue
+                starts.append(position + 1)
+                position = data.find(pattern, starts[-1] + chunk_bytes)
+
+    return list(zip(starts, starts[1:] + [size]))
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def check_address(address: str, line_start: str) -> tuple|None:
+    """
+    Checks one address with the forward file grammar, as a "From: <address>" line or a
+    "To: <address>" line, and returns (address, domain), or None if it does not match. The
+    grammar is the slow part of an import, and most mail comes from and goes to the same
+    addresses again and again, so the answers are kept.
+    """
+
+    parser = Parser(f"{line_start} <{address}>\n")
+    matched = parser.forwardfile_match_from_address() if line_start == "From:" else parser.forwardfile_match_to_address()
+    return (parser.get_email_address(), parser.get_email_domain()) if matched else None
+
+
+def check_addresses(sender: str, recipients: list) -> tuple|None:
+    """
+    Checks a sender and recipients with the forward file grammar and returns
+    (sender, [(recipient, domain), ...]), or None if any of them does not match.
+    """
+
+    checked_sender = check_address(sender, "From:")
+    checked = [check_address(recipient, "To:") for recipient in recipients]
+
+    if checked_sender is None or not checked or None in checked:
+        return None
+    return checked_sender[0], checked
+
+
+def read_forward_text_messages(data: bytes):
+    """
+    Yields (sender, recipients, text, timestamp) for each message of part of a text forward file.
+    Messages start at the "From: <address>" lines that ForwardFile.find_message_starts() accepts,
+    so a "From:" line in a body stays in its message. The addresses are taken from the "From:"
+    line and the "To:" lines (with one or more comma-separated addresses each) at the top of the
+    message.
+    """
+
+    now = time.time()
+    # A last line without a newline is left out of the search, but is still part of the last message
+    starts, _ = find_message_starts(data, 0, len(data))
+
+    for start, end in zip(starts, starts[1:] + [len(data)]):
+        message = data[start:end].decode("utf-8", errors="replace")
+        sender = ""
+        recipients = []
+        for line in message.split("\n"):
+            if line.startswith("From:") and not sender:
+                sender = line[len("From:"):].strip().strip("<>")
+            elif line.startswith("To:"):
+                recipients.extend(address.strip().strip("<>") for address in line[len("To:"):].split(","))
+            else:
+                break
+        yield sender, recipients, message, now
+
+
+def get_mbox_headers(lines: list) -> tuple:
+    """
+    Returns ({header name in lowercase: [values]}, index of the first line of the body) for the
+    lines of an mbox message after its "From " line. Folded header lines are joined.
+    """
+
+    headers = {}
+    name = None
+
+    for number, line in enumerate(lines):
+        if not line:
+            return headers, number + 1
+        if line[0] in " \t" and name is not None:
+            headers[name][-1] += " " + line.strip()
+        elif ":" in line:
+            name, value = line.split(":", 1)
+            name = name.strip().lower()
+            headers.setdefault(name, []).append(value.strip())
+
+    return headers, len(lines)
+
+
+def read_mbox_messages(text: str):
+    """
+    Yields (sender, recipients, text, timestamp) for each message of part of an mbox file, with
+    the text in the forward file format: "From:", one "To:" line per recipient (from To: and Cc:),
+    "Subject:", a blank line and the body, with the ">From " quoting of mbox taken out.
+    """
+
+    text = text.replace("\r\n", "\n")
+    starts = [0] if text.startswith("From ") else []
+    position = text.find("\nFrom ")
+    while position != -1:
+        starts.append(position + 1)
+        position = text.find("\nFrom ", position + 1)
+
+    for start, end in zip(starts, starts[1:] + [len(text)]):
+        lines = text[start:end].split("\n")
+        headers, body_start = get_mbox_headers(lines[1:])
+        body = lines[1 + body_start:]
+        # The message ends with the blank line that comes before the next "From " line
+        while body and not body[-1]:
+            body.pop()
+
+        senders = getaddresses(headers.get("from", []))
+        sender = senders[0][1] if senders else ""
+        recipients = [address for _, address in getaddresses(headers.get("to", []) + headers.get("cc", [])) if address]
+
+        try:
+            timestamp = parsedate_to_datetime(headers["date"][0]).timestamp()
+        except (KeyError, IndexError, TypeError, ValueError):
+            timestamp = time.time()
+
+        subject = headers.get("subject", [""])[0]
+        forward_lines = [f"From: <{sender}>"] + [f"To: <{recipient}>" for recipient in recipients]
+        if subject:
+            forward_lines.append(f"Subject: {subject}")
+        forward_lines.append("")
+        forward_lines += (line[1:] if line.startswith(">") and line.lstrip(">").startswith("From ") else line for line in body)
+
+        yield sender, recipients, "\n".join(forward_lines) + "\n", timestamp
+
+
+def read_input_range(path: Path, input_format: str, start: int, end: int) -> dict:
+    """
+    Reads and checks the messages in path[start:end], and returns them grouped by domain, and once
+    each in the order of the input, along with the counts. Runs in a worker process.
+    """
+
+    with path.open("rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    if input_format == "v2":
+        messages = ((sender, recipients, text, timestamp)
+                    for _, _, timestamp, _, sender, recipients, _, text in read_forward_v2_records(data))
+    elif input_format == "forward":
+        messages = read_forward_text_messages(data)
+    else:
+        messages = read_mbox_messages(data.decode("utf-8", errors="replace"))
+
+    domains = {}
+    accepted = []
+    rejected = []
+
+    for sender, recipients, text, timestamp in messages:
+        checked = check_addresses(sender, recipients)
+        if checked is None:
+            rejected.append(text)
+            continue
+
+        sender, checked = checked
+        message = (sender, [address for address, _ in checked], text, hashlib.sha256(text.encode()).digest(), timestamp)
+        # One copy per domain, even if the message has more than one recipient there
+        for domain in dict.fromkeys(domain for _, domain in checked):
+            domains.setdefault(domain, []).append(message)
+        accepted.append(message)
+
+    return {"domains": domains, "accepted": accepted, "rejected": rejected, "bytes": end - start}
+
+
+def import_mail(paths: list, writer: SMTPServer, forward_folder: Path, input_format: str, jobs: int, chunk_bytes: int,
+                rejects_file=None, indexer: MailIndexer|None = None) -> dict:
+    """
+    Imports every message of the files in paths into forward_folder through writer, and adds it
+    to indexer if there is one, and returns the counts and times. At most two ranges per process
+    are read ahead of the one being written, so memory does not grow with the size of the input.
+    """
+
+    started = time.perf_counter()
+    counts = {"files": len(paths), "ranges": 0, "accepted": 0, "rejected": 0, "bytes": 0, "writes": 0, "write_seconds": 0.0,
+              "index_seconds": 0.0}
+    domains = set()
+
+    work = []
+    for path in paths:
+        file_format = get_input_format(path) if input_format == "auto" else input_format
+        if file_format == "forward" and get_input_format(path) == "v2":
+            file_format = "v2"
+        work += [(path, file_format, start, end) for start, end in get_input_ranges(path, file_format, chunk_bytes)]
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        work_left = iter(work)
+
+        while True:
+            while len(pending) < 2 * jobs:
+                item = next(work_left, None)
+                if item is None:
+                    break
+                pending.append(executor.submit(read_input_range, *item))
+            if not pending:
+                break
+
+            # The oldest range first, so the messages are written in the order of the input
+            result = pending.popleft().result()
+
+            write_start = time.perf_counter()
+            records = {}
+            locations = {} if indexer is not None else None
+            for domain, messages in result["domains"].items():
+                writer.append_to_forward_file(forward_folder, domain, messages, records, locations)
+                counts["writes"] += 1
+                domains.add(domain)
+            counts["write_seconds"] += time.perf_counter() - write_start
+
+            # Once per message, not once per domain it was written to
+            if indexer is not None:
+                index_start = time.perf_counter()
+                for message in result["accepted"]:
+                    sender, recipients, text, body_hash, timestamp = message
+                    indexer.add(timestamp, sender, recipients, text, body_hash, locations[id(message)])
+                counts["index_seconds"] += time.perf_counter() - index_start
+
+            if rejects_file is not None:
+                rejects_file.writelines(result["rejected"])
+
+            counts["ranges"] += 1
+            counts["accepted"] += len(result["accepted"])
+            counts["rejected"] += len(result["rejected"])
+            counts["bytes"] += result["bytes"]
+
+    counts["domains"] = len(domains)
+    counts["seconds"] = time.perf_counter() - started
+    counts["messages_per_second"] = (counts["accepted"] + counts["rejected"]) / counts["seconds"] if counts["seconds"] else 0.0
+    return counts
+
+
+def get_command_line_arguments():
+    """
+    Handles the input files and the same forward file options as Server.py.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Import mbox or forward files into the forward folder without SMTP")
+
+    arg_parser.add_argument("inputs", action="store", type=Path, nargs="+", help="mbox or forward files to import")
+    arg_parser.add_argument("--input-format", action="store", choices=INPUT_FORMATS, default="auto",
+                            help="Format of the input (default: from the first bytes of each file)")
+    arg_parser.add_argument("--forward-folder", action="store", type=Path, default=Path("forward"),
+                            help="Folder to write the forward files to (default: ./forward)")
+    arg_parser.add_argument("--jobs", action="store", type=int, default=0, help="Processes that read the input (default: one per core)")
+    arg_parser.add_argument("--chunk-bytes", action="store", type=int, default=RANGE_BYTES,
+                            help="Size of the ranges the input is split into (default 16 MB)")
+    arg_parser.add_argument("--rejects", action="store", type=Path, default=None,
+                            help="Write the messages whose headers do not match the grammar to this file")
+    arg_parser.add_argument("--forward-format", action="store", choices=FORWARD_FORMATS, default="text",
+                            help="Format of new forward files, as for Server.py")
+    arg_parser.add_argument("--forward-compression", action="store", choices=list(FORWARD_COMPRESSORS), default="",
+                            help="Compression of v2 forward files, as for Server.py")
+    arg_parser.add_argument("--compression-level", action="store", type=int, default=None, help="As for Server.py")
+    arg_parser.add_argument("--rotate-bytes", action="store", type=int, default=0, help="As for Server.py")
+    arg_parser.add_argument("--mail-index", action="store_true",
+                            help="Also add the imported messages to the index of delivered mail in <forward folder>/.mailindex")
+    arg_parser.add_argument("--index-flush-messages", action="store", type=int, default=100_000,
+                            help="With --mail-index, messages to collect in memory before writing a segment")
+    arg_parser.add_argument("--debug", action="store_true", help="Print what the writer and the rotation do")
+
+    args = arg_parser.parse_args()
+
+    if args.forward_compression and args.forward_format != "v2":
+        arg_parser.error("--forward-compression needs --forward-format v2; text forward files are never compressed")
+
+    if args.chunk_bytes < 1 or args.jobs < 0 or args.rotate_bytes < 0:
+        arg_parser.error("--chunk-bytes must be positive, and --jobs and --rotate-bytes cannot be negative")
+
+    if args.index_flush_messages < 1:
+        arg_parser.error("--index-flush-messages must be positive")
+
+    return args
+
+
+def main():
+    """
+    Imports the files and prints the throughput.
+    """
+
+    args = get_command_line_arguments()
+
+    for path in args.inputs:
+        if not path.is_file():
+            print(f"The input file {path} does not exist.")
+            sys.exit(1)
+
+    args.forward_folder.mkdir(parents=True, exist_ok=True)
+
+    # The server's writer, without a connection
+    writer = SMTPServer(args.debug)
+    writer.forward_format = args.forward_format
+    writer.forward_compression = args.forward_compression
+    writer.forward_compression_level = args.compression_level
+    if args.rotate_bytes:
+        writer.forward_segments = ForwardSegments(args.forward_folder, args.rotate_bytes, debug_mode=args.debug)
+
+    # Added to from this process, like MailIndex.py --add, so the server cannot be writing to it
+    indexer = None
+    if args.mail_index:
+        try:
+            indexer = MailIndexer(args.forward_folder / MAIL_INDEX_FOLDER_NAME, args.index_flush_messages, debug_mode=args.debug)
+        except (OSError, ValueError) as e:
+            print(f"Could not open the mail index: {e}")
+            sys.exit(1)
+
+    rejects_file = args.rejects.open("w", encoding="utf-8") if args.rejects else None
+    try:
+        counts = import_mail(args.inputs, writer, args.forward_folder, args.input_format, args.jobs or os.cpu_count() or 1,
+                             args.chunk_bytes, rejects_file, indexer)
+    finally:
+        if rejects_file is not None:
+            rejects_file.close()
+        if indexer is not None:
+            indexer.stop()
+
+    indexing = f", {counts['index_seconds']:.1f}s indexing" if indexer is not None else ""
+    print(f"Imported {counts['accepted']} message(s) into {counts['domains']} domain(s) with {counts['writes']} write(s), "
+          f"rejected {counts['rejected']}: {counts['bytes'] / 1_000_000:.1f} MB in {counts['seconds']:.1f}s, "
+          f"{counts['messages_per_second']:.0f} messages/s, {counts['bytes'] / 1_000_000 / max(counts['seconds'], 1e-9):.1f} MB/s "
+          f"({counts['write_seconds']:.1f}s writing{indexing})")
+
+
+if __name__ == "__main__":
+    main()
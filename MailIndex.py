@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+MailIndex.py
+Searches the index of delivered mail that Server.py --mail-index keeps in forward/.mailindex, by
+sender, recipient, words of the subject and keywords anywhere in the message, and adds existing
+forward files to it.
+
+Every condition has to match. Each term is found with a binary search in each segment of the
+index, and the postings of the rarest term are checked against the others with binary searches
+too, so a search does not go through the messages at all. The newest messages are printed first,
+each with the forward file (or the segment it has been rotated to) and the offset it is at.
+"""
+
+import argparse
+import hashlib
+import mmap
+import os
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from Client import FORWARD_V2_MAGIC, get_forward_file_format, read_forward_v2_records
+from ConvertForwardFile import get_message_addresses
+from ForwardFile import ForwardFile
+from Server import MAIL_INDEX_FOLDER_NAME, MAIL_INDEX_WORD, SEGMENTS_FOLDER_NAME, MailIndexer, MailIndexSegment, read_mail_index_manifest
+
+
+class MailIndexReader:
+    """
+    The segments of the mail index as the manifest lists them when it is opened.
+    """
+
+    def __init__(self, folder: Path):
+        # A merge that finishes between reading the manifest and opening its segments removes
+        # some of them, so the manifest is read again
+        for attempt in range(3):
+            manifest = read_mail_index_manifest(folder)
+            try:
+                self.segments = [MailIndexSegment(folder / entry["name"]) for entry in manifest["segments"]]
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+        self.firsts = [segment.first_number for segment in self.segments]
+
+    def find(self, term: str) -> list:
+        """
+        Returns the postings of term in each segment, oldest segment first.
+        """
+
+        return [postings for postings in (segment.find(term) for segment in self.segments) if postings]
+
+    def search(self, terms: list) -> array:
+        """
+        Returns the numbers of the messages that have every one of terms, newest first.
+        """
+
+        if not terms:
+            return []
+
+        found = sorted((self.find(term) for term in terms), key=lambda lists: sum(len(postings) for postings in lists))
+
+        matches = array("I")
+        if len(found) == 1:
+            for postings in found[0]:
+                matches.extend(postings)
+            matches.reverse()
+            return matches
+
+        for postings in found[0]:
+            for number in postings:
+                if all(contains(lists, number) for lists in found[1:]):
+                    matches.append(number)
+
+        matches.reverse()
+        return matches
+
+    def get_message(self, number: int) -> tuple:
+        """
+        Returns (timestamp, sender, recipients, subject, SHA-256 of the text, locations) of message
+        number, where locations are the "file:inode:offset" lines of its description.
+        """
+
+        segment = self.segments[bisect_right(self.firsts, number) - 1]
+        timestamp, description = segment.get_message(number)
+        sender, recipients, subject, body_hash, *locations = description.decode("utf-8", errors="replace").split("\n")[:-1]
+        return timestamp, sender, recipients.split(","), subject, body_hash, locations
+
+    def close(self):
+        """
+        Unmaps every segment.
+        """
+
+        for segment in self.segments:
+            segment.close()
+
+
+def contains(lists: list, number: int) -> bool:
+    """
+    Returns whether number is in one of the sorted arrays in lists.
+    """
+
+    for postings in lists:
+        position = bisect_left(postings, number)
+        if position < len(postings) and postings[position] == number:
+            return True
+
+    return False
+
+
+def find_location(forward_folder: Path, location: str) -> str:
+    """
+    Returns where a message is now, as "path @ offset", from a location in the index. A forward
+    file that has been rotated since is found among the segments of its domain by its inode; one
+    that has been compacted since has a new inode, and the offset no longer holds.
+    """
+
+    name, inode, offset = location.rsplit(":", 2)
+    path = forward_folder / name
+
+    try:
+        if path.stat().st_ino == int(inode):
+            return f"{path} @ {offset}"
+    except FileNotFoundError:
+        pass
+
+    segment_folder = forward_folder / SEGMENTS_FOLDER_NAME / path.name
+    if segment_folder.is_dir():
+        for entry in os.scandir(segment_folder):
+            if entry.inode() == int(inode) and not entry.name.startswith("."):
+                return f"{entry.path} @ {offset}"
+        return f"{segment_folder} (compacted since it was written to {name} @ {offset})"
+
+    return f"{path} @ {offset} (the file has been replaced since)"
+
+
+def get_location_name(forward_folder: Path, path: Path) -> str:
+    """
+    Returns the name a file is given in the locations of the index: its name in forward_folder,
+    or its full path if it is somewhere else.
+    """
+
+    path = path.resolve()
+    return path.name if path.parent == forward_folder.resolve() else str(path)
+
+
+def get_search_terms(args) -> list:
+    """
+    Returns the index terms for the conditions on the command line.
+    """
+
+    terms = [f"from:{args.sender.casefold()}"] if args.sender else []
+    terms += [f"to:{address.casefold()}" for address in args.recipient]
+    terms += [f"subject:{word}" for word in MAIL_INDEX_WORD.findall(" ".join(args.subject).casefold())]
+    terms += MAIL_INDEX_WORD.findall(" ".join(args.keywords).casefold())
+    return terms
+
+
+def read_forward_file(path: Path, name: str):
+    """
+    Yields (timestamp, sender, recipients, text, SHA-256 of the text, locations) for each message
+    of a forward file in either format, where name is what the file is called in the locations.
+    The text format does not say when a message was accepted, so the time the file was last
+    written to is used.
+    """
+
+    stat = path.stat()
+
+    if get_forward_file_format(path) == "v2":
+        with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset, _, timestamp, _, sender, recipients, body_hash, text in read_forward_v2_records(data, len(FORWARD_V2_MAGIC)):
+                yield timestamp, sender, recipients, text, body_hash, [f"{name}:{stat.st_ino}:{offset}"]
+        return
+
+    with ForwardFile(path) as forward_file:
+        for offset, message in zip(forward_file.offsets, forward_file.messages()):
+            text = bytes(message).decode("utf-8", errors="replace")
+            sender, recipients = get_message_addresses(text)
+            yield stat.st_mtime, sender, recipients, text, hashlib.sha256(text.encode()).digest(), [f"{name}:{stat.st_ino}:{offset}"]
+
+
+def add_forward_files(folder: Path, paths: list, flush_messages: int) -> int:
+    """
+    Adds every message of the forward files in paths to the mail index in folder and returns how
+    many there were. The server cannot be writing to the same index at the same time.
+    """
+
+    indexer = MailIndexer(folder, flush_messages)
+    count = 0
+
+    try:
+        for path in paths:
+            for message in read_forward_file(path, get_location_name(folder.parent, path)):
+                indexer.add(*message)
+                count += 1
+    finally:
+        indexer.stop()
+
+    return count
+
+
+def get_command_line_arguments():
+    """
+    Handles the search conditions, or the forward files to add.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Search the index of delivered mail (Server.py --mail-index)")
+
+    arg_parser.add_argument("keywords", action="store", nargs="*", help="Words that have to be in the message")
+    arg_parser.add_argument("--from", dest="sender", action="store", default=None, help="Address the message is from")
+    arg_parser.add_argument("--to", dest="recipient", action="append", default=[], help="Address the message is to (can be given more than once)")
+    arg_parser.add_argument("--subject", action="append", default=[], help="Words that have to be in the subject")
+    arg_parser.add_argument("--limit", action="store", type=int, default=20, help="Most messages to print (default 20)")
+    arg_parser.add_argument("--forward-folder", action="store", type=Path, default=Path("forward"),
+                            help="The server's forward folder (default: ./forward)")
+    arg_parser.add_argument("--add", action="store", type=Path, nargs="+", default=None, metavar="FILE",
+                            help="Add the messages of these forward files to the index instead of searching")
+    arg_parser.add_argument("--flush-messages", action="store", type=int, default=100_000,
+                            help="With --add, messages to collect in memory before writing a segment")
+
+    args = arg_parser.parse_args()
+
+    if not args.add and not (args.keywords or args.sender or args.recipient or args.subject):
+        arg_parser.error("give at least one of keywords, --from, --to and --subject, or --add")
+
+    return args
+
+
+def main():
+    """
+    Adds forward files to the index, or searches it and prints the messages it finds.
+    """
+
+    args = get_command_line_arguments()
+    folder = args.forward_folder / MAIL_INDEX_FOLDER_NAME
+
+    if args.add:
+        start = time.perf_counter()
+        try:
+            count = add_forward_files(folder, args.add, args.flush_messages)
+        except (OSError, ValueError) as e:
+            print(f"Could not add to the mail index: {e}")
+            sys.exit(1)
+        seconds = time.perf_counter() - start
+        print(f"Indexed {count} message(s) in {seconds:.1f}s ({count / max(seconds, 1e-9):.0f} messages/s)")
+        return
+
+    if not folder.is_dir():
+        print(f"There is no mail index in {args.forward_folder}; start Server.py with --mail-index.")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    reader = MailIndexReader(folder)
+    matches = reader.search(get_search_terms(args))
+    results = [reader.get_message(number) for number in matches[:args.limit]]
+    milliseconds = (time.perf_counter() - start) * 1000
+    reader.close()
+
+    for timestamp, sender, recipients, subject, body_hash, locations in results:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)) if timestamp else "-" * 19
+        print(f"{when}  {sender} -> {', '.join(recipients)}  {subject!r}  sha256:{body_hash[:16]}")
+        for location in locations:
+            print(f"    {find_location(args.forward_folder, location)}")
+
+    print(f"{len(matches)} message(s) in {len(reader.segments)} segment(s), {milliseconds:.1f}ms", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
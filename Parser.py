@@ -328,6 +328,16 @@ class Parser:
             self.rewind(start)
             return True
 
+        self.reset()
+        if self.rset_cmd(check_only=True):
+            self.rewind(start)
+            return True
+
+        self.reset()
+        if self.noop_cmd(check_only=True):
+            self.rewind(start)
+            return True
+
         # This means no commands have been identified, which can mean a number of things but not
         # necessarily a problem (depending on the state of the SMTP Server)
         self.rewind(start)
@@ -532,7 +542,7 @@ class Parser:
         """
 
         start = self.position
-        codes = ["220", "221", "250", "354", "500", "501", "503"]
+        codes = ["220", "221", "250", "354", "500", "501", "503", "550"]
 
         for code in codes:
             if self.match_chars(code):
@@ -741,9 +751,11 @@ class Parser:
 
         <data-cmd> ::= "DATA" <nullspace> <CRLF>
         <quit-cmd> ::= "QUIT" <nullspace> <CRLF>
+        <rset-cmd> ::= "RSET" <nullspace> <CRLF>
+        <noop-cmd> ::= "NOOP" <nullspace> <CRLF>
         """
 
-        allowed_cmds = ["QUIT", "DATA"]
+        allowed_cmds = ["QUIT", "DATA", "RSET", "NOOP"]
 
         if not cmd_name or not isinstance(cmd_name, str) or not cmd_name in allowed_cmds:
             raise ValueError(f"word_only_commands(); must specify a valid command string literal ({','.join(allowed_cmds)})")
@@ -794,6 +806,28 @@ class Parser:
         DebugMode.print(self.debug_mode, "reached data_cmd()")
         return self.word_only_commands("DATA", check_only=check_only)
 
+    def rset_cmd(self, check_only: bool = False) -> bool:
+        """
+        The <rset-cmd> non-terminal handles the "RSET" command, which abandons the current email
+        message without closing the connection.
+
+        <rset-cmd> ::= "RSET" <nullspace> <CRLF>
+        """
+
+        DebugMode.print(self.debug_mode, "reached rset_cmd()")
+        return self.word_only_commands("RSET", check_only=check_only)
+
+    def noop_cmd(self, check_only: bool = False) -> bool:
+        """
+        The <noop-cmd> non-terminal handles the "NOOP" command, which does nothing other than get
+        a 250 from the server. Useful for checking that a connection is still alive.
+
+        <noop-cmd> ::= "NOOP" <nullspace> <CRLF>
+        """
+
+        DebugMode.print(self.debug_mode, "reached noop_cmd()")
+        return self.word_only_commands("NOOP", check_only=check_only)
+
     def data_read_msg_line(self):
         """
         Handles the reading of mail input lines after a successful DATA command.
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+ParserBench.py
+Microbenchmarks for the entry points of the Parser class. "run" times every case in the corpus
+and can save the results as a baseline; "compare" times them again and flags any case that got
+slower than the baseline by more than a threshold.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import timeit
+from pathlib import Path
+from Parser import Parser, ParserError
+
+DEFAULT_BASELINE = Path(__file__).parent / "parser_baseline.json"
+"""
+The committed baseline. Timings depend on the machine, so regenerate it with "run --save" on the
+machine the comparison will happen on before trusting small differences.
+"""
+
+
+def long_domain(labels: int) -> str:
+    """
+    Returns a domain with the given number of labels, like "d0.d1.d2.example".
+    """
+
+    return ".".join(f"d{i}" for i in range(labels)) + ".example"
+
+
+def build_corpus() -> dict:
+    """
+    Returns {case name: (Parser method name, input string)}. Each case creates a new Parser for
+    the input and calls the method once, which is how the server and client use the parser.
+    """
+
+    many_addresses = ",".join(f"user{i}@host{i}.unc.edu" for i in range(50))
+    body_line = "The quick brown fox jumps over the lazy dog. " * 22
+    big_body = (body_line + "\n") * 64
+
+    return {
+        "mail_from_cmd/short": ("mail_from_cmd", "MAIL FROM: <jeffay@cs.unc.edu>\n"),
+        "mail_from_cmd/long_domain": ("mail_from_cmd", f"MAIL FROM: <jeffay@{long_domain(40)}>\n"),
+        "mail_from_cmd/long_local_part": ("mail_from_cmd", f"MAIL FROM: <{'x' * 200}@cs.unc.edu>\n"),
+        "mail_from_cmd/malformed_path": ("mail_from_cmd", "MAIL FROM: <jeffay@cs.unc.edu\n"),
+        "mail_from_cmd/unrecognized": ("mail_from_cmd", "MAIL  FROM: <jeffay@cs.unc.edu>\n"),
+        "rcpt_to_cmd/short": ("rcpt_to_cmd", "RCPT TO: <bob@cs.unc.edu>\n"),
+        "rcpt_to_cmd/long_domain": ("rcpt_to_cmd", f"RCPT TO: <bob@{long_domain(40)}>\n"),
+        "rcpt_to_cmd/malformed_domain": ("rcpt_to_cmd", "RCPT TO: <bob@cs.unc.>\n"),
+        "match_helo_msg/short": ("match_helo_msg", "HELO comp431-1sp26.cs.unc.edu\n"),
+        "match_helo_msg/long_domain": ("match_helo_msg", f"HELO {long_domain(40)}\n"),
+        "match_helo_msg/malformed": ("match_helo_msg", "HELO cs..unc.edu\n"),
+        "mailboxes/one": ("mailboxes", "jeffay@cs.unc.edu"),
+        "mailboxes/fifty_recipients": ("mailboxes", many_addresses),
+        "mailboxes/malformed_last": ("mailboxes", many_addresses + ",bad@"),
+        "data_read_msg_line/short": ("data_read_msg_line", "Hey Bob, do you really think we should use SMTP?\n"),
+        "data_read_msg_line/long_line": ("data_read_msg_line", body_line + "\n"),
+        "data_read_msg_line/big_body": ("data_read_msg_line", big_body),
+        "data_read_msg_line/non_printable": ("data_read_msg_line", "bad \x01 character\n"),
+        "match_response_code/250": ("match_response_code", "250 OK\n"),
+        "match_response_code/long_text": ("match_response_code", "250 " + "x" * 500 + "\n"),
+        "match_response_code/malformed": ("match_response_code", "25O OK\n"),
+        "check_for_commands/mail_from": ("check_for_commands", "MAIL FROM: <jeffay@cs.unc.edu>\n"),
+        "check_for_commands/quit": ("check_for_commands", "QUIT\n"),
+        "check_for_commands/unrecognized": ("check_for_commands", "HELLO there\n"),
+    }
+
+
+def make_case(method_name: str, input_string: str):
+    """
+    Returns a function that parses input_string with a new Parser. ParserError is part of the
+    normal result for malformed input, so it is caught instead of ending the benchmark.
+    """
+
+    def case():
+        parser = Parser(input_string)
+        try:
+            getattr(parser, method_name)()
+        except ParserError:
+            pass
+
+    return case
+
+
+def time_case(case, repeat: int, min_time: float) -> dict:
+    """
+    Times case() with timeit. The number of calls per repetition is increased (1, 2, 5, 10, 20,
+    ...) until one repetition takes at least min_time seconds, then the repetitions are taken.
+    Returns a statistical summary of the time per call in microseconds.
+    """
+
+    timer = timeit.Timer(case)
+
+    number = 1
+    multipliers = [2, 2.5, 2]
+    i = 0
+    while timer.timeit(number) < min_time:
+        number = int(number * multipliers[i % len(multipliers)])
+        i += 1
+
+    per_call_us = [total / number * 1_000_000 for total in timer.repeat(repeat=repeat, number=number)]
+
+    return {
+        "number": number,
+        "repeat": repeat,
+        "min_us": min(per_call_us),
+        "median_us": statistics.median(per_call_us),
+        "mean_us": statistics.fmean(per_call_us),
+        "stdev_us": statistics.stdev(per_call_us) if len(per_call_us) > 1 else 0.0,
+    }
+
+
+def run_benchmarks(name_filter: str, repeat: int, min_time: float) -> dict:
+    """
+    Times every case in the corpus whose name contains name_filter.
+    """
+
+    results = {}
+
+    for name, (method_name, input_string) in build_corpus().items():
+        if name_filter and name_filter not in name:
+            continue
+
+        results[name] = time_case(make_case(method_name, input_string), repeat, min_time)
+        summary = results[name]
+        print(f"{name:<36} median={summary['median_us']:>10.2f}us  min={summary['min_us']:>10.2f}us  "
+              f"stdev={summary['stdev_us']:>8.2f}us  ({summary['repeat']}x{summary['number']})", file=sys.stderr)
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cases": results,
+    }
+
+
+def compare_results(baseline: dict, current: dict, threshold: float) -> list:
+    """
+    Prints the fastest repetition of every case next to its baseline and returns the names of the
+    cases that got slower by more than threshold (0.20 means 20%). The minimum is used instead of
+    the median because, as the timeit documentation points out, the slower repetitions are mostly
+    caused by other processes and not by the code being timed.
+    """
+
+    regressions = []
+
+    for name, summary in current["cases"].items():
+        if name not in baseline["cases"]:
+            print(f"{name:<36} (not in baseline)")
+            continue
+
+        before = baseline["cases"][name]["min_us"]
+        after = summary["min_us"]
+        change = (after - before) / before if before else 0.0
+
+        flag = ""
+        if change > threshold:
+            flag = "REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "faster"
+
+        print(f"{name:<36} {before:>10.2f}us -> {after:>10.2f}us  {change:>+8.1%}  {flag}")
+
+    return regressions
+
+
+def get_command_line_arguments():
+    """
+    Handles the "run" and "compare" commands and their options.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Microbenchmarks for the Parser class")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Time every case and optionally save the results as a baseline")
+    run_parser.add_argument("--save", action="store", type=Path, default=None,
+                            help=f"Write the results to this file (the committed baseline is {DEFAULT_BASELINE.name})")
+
+    compare_parser = subparsers.add_parser("compare", help="Time every case and compare with a baseline")
+    compare_parser.add_argument("--baseline", action="store", type=Path, default=DEFAULT_BASELINE,
+                                help="Baseline file to compare with")
+    compare_parser.add_argument("--threshold", action="store", type=float, default=0.20,
+                                help="Flag cases whose fastest repetition is slower than the baseline by more than this fraction")
+
+    for sub in [run_parser, compare_parser]:
+        sub.add_argument("--filter", action="store", default="", help="Only run cases whose name contains this text")
+        sub.add_argument("--repeat", action="store", type=int, default=7, help="Number of timed repetitions per case")
+        sub.add_argument("--min-time", action="store", type=float, default=0.05,
+                         help="Minimum number of seconds for one repetition")
+
+    return arg_parser.parse_args()
+
+
+def main():
+    """
+    Runs the benchmarks and either saves them or compares them with the baseline.
+    """
+
+    args = get_command_line_arguments()
+
+    if args.command == "compare" and not args.baseline.exists():
+        print(f"The baseline file {args.baseline} does not exist; create it with 'run --save'.")
+        sys.exit(1)
+
+    current = run_benchmarks(args.filter, args.repeat, args.min_time)
+
+    if args.command == "run":
+        if args.save:
+            with args.save.open("w", encoding="utf-8") as f:
+                json.dump(current, f, indent=2)
+                f.write("\n")
+        return
+
+    with args.baseline.open("r", encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    regressions = compare_results(baseline, current, args.threshold)
+
+    if regressions:
+        print(f"{len(regressions)} case(s) slower than the baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,706 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+Relay.py
+Forwards the mail that Server.py has accepted. Server.py only appends each message to
+forward/<domain>; this reads what is new in those files and sends it on to the next-hop SMTP
+server for the domain, taken from a static routing table. Each destination has its own delivery
+workers and pooled connections, and failed deliveries are tried again with exponential backoff.
+
+When Server.py rotates forward/<domain> into forward/.segments/<domain>/, the relay finishes the
+file it was reading in its segment, then any newer segments, before it starts on the new
+forward/<domain>. It keeps the inode of the file along with the offset so it can tell.
+"""
+
+import argparse
+import heapq
+import io
+import json
+import os
+import random
+import signal
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse
+from Client import SMTPConnectionPool, DomainRouter, DebugMode, read_forward_lines_messages, get_address_domain, \
+    parse_route, parse_target, describe_target, read_forward_v2_records, FORWARD_V2_MAGIC, FORWARD_FLAG_DELETED
+from Server import RELAY_FOLDER_NAME, RELAY_OFFSETS_NAME, SEGMENTS_FOLDER_NAME, SEGMENT_MANIFEST_NAME
+
+
+def get_subject_and_body(text: str) -> tuple:
+    """
+    Returns (subject, body_lines) for the text of a message in a forward file, the same way
+    read_forward_lines_messages() reads them: "From:" and "To:" header lines are skipped, and the
+    blank line after the headers is not part of the body. The text does not need a "From:" line.
+    """
+
+    lines = text.split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+
+    subject = ""
+    for number, line in enumerate(lines):
+        if line.startswith("From:") or line.startswith("To:"):
+            continue
+        if line.startswith("Subject:"):
+            subject = line[len("Subject:"):].strip()
+            continue
+        return subject, lines[number + 1:] if line == "" else lines[number:]
+
+    return subject, []
+
+
+class SpoolBatch:
+    """
+    The messages read from one forward file (or segment) in one scan. The relay only remembers
+    that it has read up to end, {"inode": ..., "offset": ...}, once every message of this batch
+    (and of the batches before it) is finished, so a message that was read but not yet delivered
+    is read again after a restart.
+    """
+
+    __slots__ = ("domain", "end", "remaining")
+
+    def __init__(self, domain: str, end: dict, remaining: int):
+        self.domain = domain
+        self.end = end
+        self.remaining = remaining
+
+
+class RelayItem:
+    """
+    One message waiting to be delivered to one destination, with the recipients at its domain.
+    """
+
+    __slots__ = ("batch", "message", "enqueued_at", "attempts", "last_error")
+
+    def __init__(self, batch: SpoolBatch, message: tuple):
+        self.batch = batch
+        self.message = message
+        self.enqueued_at = time.time()
+        self.attempts = 0
+        self.last_error = ""
+
+
+class Relay:
+    """
+    Reads new messages from the forward files, queues them per destination (target), and runs
+    workers_per_target delivery workers for each destination. A message the destination rejects is
+    written to the failed file right away; a message that cannot be delivered because of a
+    connection problem is tried again after a delay, up to max_attempts times.
+    """
+
+    def __init__(self, forward_folder: Path, router: DomainRouter, workers_per_target: int = 1,
+                 max_attempts: int = 8, backoff_base: float = 1.0, backoff_max: float = 300.0,
+                 idle_seconds: float = 5.0, debug_mode: bool = False):
+        self.forward_folder = forward_folder
+        self.router = router
+        self.workers_per_target = workers_per_target
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.debug_mode = debug_mode
+
+        self.relay_folder = forward_folder / RELAY_FOLDER_NAME
+        self.relay_folder.mkdir(parents=True, exist_ok=True)
+        self.offsets_path = self.relay_folder / RELAY_OFFSETS_NAME
+        self.failed_path = self.relay_folder / "failed.jsonl"
+
+        self.offsets = json.loads(self.offsets_path.read_text(encoding="utf-8")) if self.offsets_path.exists() else {}
+        """
+        domain -> {"inode": ..., "offset": ...}: the forward file or segment of domain the relay
+        has got to, and how many bytes of it have been relayed (or given up on). Server.py's
+        compactor reads this too (see RELAY_OFFSETS_NAME).
+        """
+
+        # An offset saved before the relay knew about segments is an offset in forward/<domain>
+        for domain, offset in self.offsets.items():
+            if not isinstance(offset, dict):
+                self.offsets[domain] = {"inode": None, "offset": offset}
+
+        self.read_offsets = dict(self.offsets)
+        """
+        domain -> the same for what has been read and queued. Ahead of self.offsets while
+        messages are waiting to be delivered.
+        """
+
+        self.last_sizes = {}
+        """
+        domain -> (inode, size) of forward/<domain> at the previous scan. A file is only read once
+        its size has stayed the same for one scan, so that a message Server.py is still writing is
+        not read half-finished. Segments are never written to again, so they are read right away.
+        """
+
+        self.batches = {}
+        """
+        domain -> SpoolBatch objects that are not finished yet, oldest first.
+        """
+
+        # Server.py handles one connection at a time, so idle sessions are closed quickly and
+        # checked with NOOP if they have been idle for a second
+        self.pool = SMTPConnectionPool(size=workers_per_target, max_idle_seconds=idle_seconds,
+                                       check_idle_seconds=1.0, retries=0, debug_mode=debug_mode)
+
+        self.queues = {}
+        """
+        target -> heap of (time the item can be tried, sequence number, RelayItem).
+        """
+
+        self.in_flight = {}
+        """
+        target -> the RelayItem objects being delivered right now.
+        """
+
+        self.condition = threading.Condition()
+        self.sequence = 0
+        self.unrouted_domains = set()
+
+        self.started_at = time.time()
+        self.messages_read = 0
+        self.messages_delivered = 0
+        self.messages_rejected = 0
+        self.messages_failed = 0
+        self.retries = 0
+
+        self.recent_deliveries = deque()
+        """
+        time.monotonic() of every delivery in the last minute, for the delivery rate.
+        """
+
+    def backoff_seconds(self, attempts: int) -> float:
+        """
+        Returns how long to wait before the next attempt: a random time between 0 and
+        backoff_base * 2^(attempts - 1), capped at backoff_max. The randomness ("full jitter")
+        keeps the messages that failed together from all being tried again at the same moment.
+        """
+
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1)))
+
+    def get_domains(self) -> list:
+        """
+        Returns every domain with a forward file or rotated segments.
+        """
+
+        domains = {path.name for path in self.forward_folder.iterdir() if path.is_file() and not path.name.startswith(".")}
+
+        segments_folder = self.forward_folder / SEGMENTS_FOLDER_NAME
+        if segments_folder.is_dir():
+            domains.update(path.name for path in segments_folder.iterdir() if path.is_dir())
+
+        return sorted(domains)
+
+    def get_sources(self, domain: str) -> list|None:
+        """
+        Returns (path, inode, size, sealed) for each file of domain in the order its messages
+        were written: the segments the manifest lists, then forward/<domain> (not sealed) if
+        there is one. Returns None if the compactor replaced a segment while they were listed.
+        """
+
+        # The forward file is looked at before the manifest: if it is rotated in between, it
+        # shows up in both, and the manifest is right
+        forward_path = self.forward_folder / domain
+        try:
+            stat = forward_path.stat()
+            current = (forward_path, stat.st_ino, stat.st_size, False)
+        except FileNotFoundError:
+            current = None
+
+        folder = self.forward_folder / SEGMENTS_FOLDER_NAME / domain
+        try:
+            manifest = json.loads((folder / SEGMENT_MANIFEST_NAME).read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            manifest = {"segments": []}
+
+        sources = []
+        for segment in manifest["segments"]:
+            try:
+                stat = (folder / segment["name"]).stat()
+            except FileNotFoundError:
+                return None
+            sources.append((folder / segment["name"], stat.st_ino, stat.st_size, True))
+
+        if current is not None and current[1] not in [source[1] for source in sources]:
+            sources.append(current)
+
+        return sources
+
+    def get_start(self, domain: str, sources: list) -> tuple:
+        """
+        Returns (number of the source, offset in it) that the relay reads domain from next.
+        """
+
+        position = self.read_offsets.get(domain)
+        inodes = [source[1] for source in sources]
+
+        if position is None:
+            return 0, 0
+
+        if position["inode"] in inodes:
+            number = inodes.index(position["inode"])
+        elif position["inode"] is None and sources and not sources[-1][3]:
+            # An offset from an older relay is in the forward file
+            number = len(sources) - 1
+        else:
+            # The file is gone, which the compactor does not do to a file the relay is still
+            # reading; the offset means nothing in any other file
+            if position["inode"] is not None:
+                print(f"The file {domain} was relayed from is gone; going on with {self.forward_folder / domain}")
+            self.read_offsets[domain] = {"inode": None, "offset": 0}
+            return (len(sources) - 1 if sources and not sources[-1][3] else len(sources)), 0
+
+        # The file was replaced by a smaller one; start over
+        offset = position["offset"] if position["offset"] <= sources[number][2] else 0
+        return number, offset
+
+    def scan_spool(self):
+        """
+        Reads the messages that were added to each forward file (and its segments) since the last
+        scan and queues the ones whose domain has a route.
+        """
+
+        for domain in self.get_domains():
+            target = self.router.get_domain_target(domain)
+            if target is None:
+                if domain not in self.unrouted_domains:
+                    print(f"No route for {domain}; its messages stay in {self.forward_folder / domain}")
+                    self.unrouted_domains.add(domain)
+                continue
+
+            # The route may have been added by reloading the routes file
+            self.unrouted_domains.discard(domain)
+
+            sources = self.get_sources(domain)
+            if sources is None:
+                continue
+
+            number, offset = self.get_start(domain, sources)
+
+            for path, inode, size, sealed in sources[number:]:
+                if not sealed:
+                    previous_size = self.last_sizes.get(domain)
+                    self.last_sizes[domain] = (inode, size)
+
+                    # Nothing new, or the file is still growing
+                    if size == offset or (inode, size) != previous_size:
+                        break
+
+                if size > offset:
+                    file_messages = self.read_messages(path, inode, offset, size)
+                    if file_messages is None:
+                        # Rotated since it was looked at; the next scan finds it in its segment
+                        break
+                    file_messages, end_offset = file_messages
+                    self.queue_messages(domain, target, file_messages, {"inode": inode, "offset": end_offset})
+
+                    DebugMode.print(self.debug_mode, f"read {len(file_messages)} message(s) for {domain} from {path} ({offset}-{end_offset}); sending to {describe_target(target)}", DebugMode.INFO)
+
+                    # A record that is cut short is left for the next scan
+                    if end_offset < size:
+                        break
+
+                offset = 0
+
+    def read_messages(self, path: Path, inode: int, offset: int, size: int) -> tuple|None:
+        """
+        Returns (messages, next_offset) for the messages of path between offset and size, or None
+        if path is not the file with inode any more.
+        """
+
+        try:
+            f = path.open("rb")
+        except FileNotFoundError:
+            return None
+
+        with f:
+            if os.fstat(f.fileno()).st_ino != inode:
+                return None
+
+            if f.read(len(FORWARD_V2_MAGIC)) == FORWARD_V2_MAGIC:
+                return self.read_v2_messages(f, offset, size)
+
+            f.seek(offset)
+            text = f.read(size - offset).decode("utf-8", errors="replace")
+
+        return list(read_forward_lines_messages(io.StringIO(text), self.debug_mode)), size
+
+    def queue_messages(self, domain: str, target: tuple, file_messages: list, end: dict):
+        """
+        Queues the messages read from a file of domain for target, as one SpoolBatch that ends at
+        end. A message with no recipient at domain is written to the failed file rather than left
+        out, so nothing is skipped without a trace when the offset moves past it.
+        """
+
+        messages = []
+        unaddressed = []
+        for from_address, to_addresses, subject, body_lines in file_messages:
+            # The To: line has every recipient of the message, not only the ones at this domain
+            recipients = [address for address in to_addresses if get_address_domain(address, self.debug_mode) == domain]
+            if recipients:
+                messages.append((from_address, recipients, subject, body_lines))
+            else:
+                unaddressed.append((from_address, to_addresses, subject, body_lines))
+
+        self.read_offsets[domain] = end
+        batch = SpoolBatch(domain, end, len(messages))
+        self.batches.setdefault(domain, deque()).append(batch)
+
+        for message in unaddressed:
+            self.write_failed(target, RelayItem(batch, message), f"no recipient at {domain}")
+
+        for message in messages:
+            self.enqueue(target, RelayItem(batch, message), 0.0)
+
+        with self.condition:
+            self.messages_read += len(messages)
+
+        # A batch with no messages in it is finished right away
+        self.finish(batch, 0)
+
+    def read_v2_messages(self, f, offset: int, size: int) -> tuple:
+        """
+        Returns (messages, next_offset) for the records of an open v2 forward file between offset
+        and size. The sender and recipients are the ones stored in the record, not the headers in
+        its text. Deleted records are skipped, and a record that is cut short is left for the next
+        scan, which starts at next_offset.
+        """
+
+        offset = max(offset, len(FORWARD_V2_MAGIC))
+        messages = []
+
+        f.seek(offset)
+        data = f.read(size - offset)
+
+        next_offset = offset
+        for _, record_end, _, flags, sender, recipients, _, text in read_forward_v2_records(data, include_deleted=True):
+            next_offset = offset + record_end
+            if not flags & FORWARD_FLAG_DELETED:
+                messages.append((sender, recipients, *get_subject_and_body(text)))
+
+        return messages, next_offset
+
+    def enqueue(self, target: tuple, item: RelayItem, delay: float):
+        """
+        Queues item for target, to be tried after delay seconds. Starts the workers for target the
+        first time it is used.
+        """
+
+        with self.condition:
+            if target not in self.queues:
+                self.queues[target] = []
+                self.in_flight[target] = set()
+                for _ in range(self.workers_per_target):
+                    threading.Thread(target=self.deliver_forever, args=(target,), name=f"relay-{describe_target(target)}", daemon=True).start()
+
+            self.sequence += 1
+            heapq.heappush(self.queues[target], (time.monotonic() + delay, self.sequence, item))
+            self.condition.notify_all()
+
+    def take(self, target: tuple) -> RelayItem:
+        """
+        Waits until an item for target can be tried and returns it.
+        """
+
+        with self.condition:
+            while True:
+                queue = self.queues[target]
+                now = time.monotonic()
+
+                if queue and queue[0][0] <= now:
+                    item = heapq.heappop(queue)[2]
+                    self.in_flight[target].add(item)
+                    return item
+
+                self.condition.wait(queue[0][0] - now if queue else None)
+
+    def finish(self, batch: SpoolBatch, count: int = 1):
+        """
+        Marks count messages of batch as finished (delivered or given up on) and saves the new
+        offset for the domain once every batch before it is finished too.
+        """
+
+        with self.condition:
+            batch.remaining -= count
+            batches = self.batches[batch.domain]
+
+            if not batches or batches[0].remaining > 0:
+                return
+
+            while batches and batches[0].remaining <= 0:
+                self.offsets[batch.domain] = batches.popleft().end
+
+            # Written to a temporary file first so that a crash cannot leave half a file behind
+            temporary_path = self.offsets_path.with_suffix(".tmp")
+            temporary_path.write_text(json.dumps(self.offsets, indent=2), encoding="utf-8")
+            os.replace(temporary_path, self.offsets_path)
+
+    def write_failed(self, target: tuple, item: RelayItem, reason: str):
+        """
+        Appends a message that will not be delivered to the failed file, as a JSON line that
+        Client.py --batch can send again.
+        """
+
+        from_address, to_addresses, subject, body_lines = item.message
+        record = {"from": from_address, "to": to_addresses, "subject": subject, "body": body_lines,
+                  "domain": item.batch.domain, "target": describe_target(target), "attempts": item.attempts, "reason": reason}
+
+        with self.condition:
+            with self.failed_path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+        print(f"Gave up on a message for {', '.join(to_addresses)} after {item.attempts} attempt(s): {reason}")
+
+    def deliver_forever(self, target: tuple):
+        """
+        One delivery worker for target: takes items from its queue and sends them one at a time
+        over a pooled session.
+        """
+
+        while True:
+            item = self.take(target)
+            item.attempts += 1
+
+            try:
+                sent, rejected, _ = self.pool.send(*target, [item.message])
+                error = "" if sent or rejected else "the session ended before the message was finished"
+            except (SystemExit, OSError, ValueError) as e:
+                sent = rejected = 0
+                error = str(e) or type(e).__name__
+
+            with self.condition:
+                self.in_flight[target].discard(item)
+
+                if sent:
+                    self.messages_delivered += 1
+                    self.recent_deliveries.append(time.monotonic())
+                elif rejected:
+                    self.messages_rejected += 1
+                elif item.attempts >= self.max_attempts:
+                    self.messages_failed += 1
+                else:
+                    self.retries += 1
+
+            if sent:
+                self.finish(item.batch)
+            elif rejected:
+                self.write_failed(target, item, "rejected by the server")
+                self.finish(item.batch)
+            elif item.attempts >= self.max_attempts:
+                self.write_failed(target, item, error)
+                self.finish(item.batch)
+            else:
+                item.last_error = error
+                delay = self.backoff_seconds(item.attempts)
+                DebugMode.print(self.debug_mode, f"attempt {item.attempts} to {describe_target(target)} failed ({error}); trying again in {delay:.2f}s", DebugMode.WARN)
+                self.enqueue(target, item, delay)
+
+    def to_dict(self) -> dict:
+        """
+        Returns the queue depth, the age of the oldest queued message and the delivery rate,
+        overall and for each destination.
+        """
+
+        with self.condition:
+            now = time.time()
+
+            one_minute_ago = time.monotonic() - 60
+            while self.recent_deliveries and self.recent_deliveries[0] < one_minute_ago:
+                self.recent_deliveries.popleft()
+
+            targets = {}
+            for target, queue in self.queues.items():
+                items = [entry[2] for entry in queue] + list(self.in_flight[target])
+                targets[describe_target(target)] = {
+                    "queued": len(queue),
+                    "in_flight": len(self.in_flight[target]),
+                    "retrying": sum(1 for entry in queue if entry[2].attempts),
+                    "oldest_age_s": max((now - item.enqueued_at for item in items), default=0.0),
+                }
+
+            uptime = now - self.started_at
+
+            return {
+                "uptime_s": uptime,
+                "queued": sum(stats["queued"] + stats["in_flight"] for stats in targets.values()),
+                "oldest_age_s": max((stats["oldest_age_s"] for stats in targets.values()), default=0.0),
+                "messages_read": self.messages_read,
+                "messages_delivered": self.messages_delivered,
+                "messages_rejected": self.messages_rejected,
+                "messages_failed": self.messages_failed,
+                "retries": self.retries,
+                "delivered_per_second_1m": len(self.recent_deliveries) / 60,
+                "delivered_per_second": self.messages_delivered / uptime if uptime > 0 else 0.0,
+                "unrouted_domains": sorted(self.unrouted_domains),
+                "targets": targets,
+                "pool": self.pool.to_dict(),
+            }
+
+    def to_text(self) -> str:
+        """
+        Returns the same numbers as to_dict() as plain "name value" lines.
+        """
+
+        stats = self.to_dict()
+        lines = [f"relay_{name} {stats[name]}" for name in ["queued", "oldest_age_s", "messages_read", "messages_delivered",
+                                                            "messages_rejected", "messages_failed", "retries", "delivered_per_second_1m"]]
+
+        for target, target_stats in stats["targets"].items():
+            for name, value in target_stats.items():
+                lines.append(f'relay_target_{name}{{target="{target}"}} {value}')
+
+        return "\n".join(lines) + "\n"
+
+
+class RelayStatsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the relay's metrics: /stats as JSON and /metrics as plain text.
+    """
+
+    relay = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path in ["/stats", "/stats.json"]:
+            body = json.dumps(self.relay.to_dict(), indent=2).encode()
+            content_type = "application/json"
+        elif url.path == "/metrics":
+            body = self.relay.to_text().encode()
+            content_type = "text/plain; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stats_server(relay: Relay, port: int) -> ThreadingHTTPServer:
+    """
+    Starts serving the metrics of relay on 127.0.0.1:port from a background thread.
+    """
+
+    handler_class = type("BoundRelayStatsRequestHandler", (RelayStatsRequestHandler,), {"relay": relay})
+    stats_server = ThreadingHTTPServer(("127.0.0.1", port), handler_class)
+
+    threading.Thread(target=stats_server.serve_forever, name="stats-server", daemon=True).start()
+
+    DebugMode.print(relay.debug_mode, f"serving stats on http://127.0.0.1:{port}/stats and /metrics", DebugMode.INFO)
+    return stats_server
+
+
+def install_routes_reload(router: DomainRouter):
+    """
+    SIGHUP reads the routes file again in a background thread. Messages that are already queued
+    keep the destination they were queued for.
+    """
+
+    def reload():
+        try:
+            router.reload()
+        except (OSError, ValueError) as e:
+            print(f"Could not reload the routes; keeping the old ones: {e}")
+            return
+
+        DebugMode.print(router.debug_mode, f"reloaded {router.routes_file}: {router.table.size} route(s)", DebugMode.SUCCESS)
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=reload, name="reload-routes", daemon=True).start())
+
+
+def get_command_line_arguments():
+    """
+    Handles the forward folder, the routing table, and the retry and worker settings.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Sends the messages in Server.py's forward files on to next-hop SMTP servers")
+
+    arg_parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="Enable additional logging that is helpful for debugging without modifying code."
+    )
+
+    arg_parser.add_argument("forward_folder", action="store", type=Path, nargs="?", default=Path("forward"),
+                            help="The forward folder written by Server.py (default ./forward)")
+    arg_parser.add_argument("--route", action="append", default=[], metavar="DOMAIN=ADDRESS", type=parse_route,
+                            help="Send mail for DOMAIN to ADDRESS (host:port or unix:/path); repeat for more domains")
+    arg_parser.add_argument("--routes-file", action="store", type=Path, default=None,
+                            help='File of "pattern address" lines (e.g. "*.unc.edu localhost:12957"); reloaded on SIGHUP')
+    arg_parser.add_argument("--default", action="store", default=None, metavar="ADDRESS", type=parse_target,
+                            help="Send mail for domains without a --route here; otherwise it stays in the forward folder")
+    arg_parser.add_argument("--workers", action="store", type=int, default=1,
+                            help="Delivery workers (and pooled connections) per destination (keep at 1 for Server.py)")
+    arg_parser.add_argument("--max-attempts", action="store", type=int, default=8,
+                            help="Give up on a message after this many failed attempts")
+    arg_parser.add_argument("--backoff-base", action="store", type=float, default=1.0,
+                            help="Seconds to wait (at most) after the first failed attempt; doubles after each one")
+    arg_parser.add_argument("--backoff-max", action="store", type=float, default=300.0,
+                            help="Longest wait between attempts, in seconds")
+    arg_parser.add_argument("--interval", action="store", type=float, default=1.0,
+                            help="Seconds between scans of the forward folder")
+    arg_parser.add_argument("--idle-seconds", action="store", type=float, default=5.0,
+                            help="Close a connection after this many seconds without a message")
+    arg_parser.add_argument("--stats-port", action="store", type=int, default=0,
+                            help="Serve /stats and /metrics on this port on 127.0.0.1")
+
+    args = arg_parser.parse_args()
+
+    if not args.route and not args.routes_file and args.default is None:
+        arg_parser.error("at least one of --route, --routes-file or --default is required")
+
+    if args.workers < 1 or args.max_attempts < 1:
+        arg_parser.error("--workers and --max-attempts must be at least 1")
+
+    return args
+
+
+def main():
+    """
+    Scans the forward folder every --interval seconds until interrupted.
+    """
+
+    args = get_command_line_arguments()
+
+    if not args.forward_folder.is_dir():
+        print(f"The forward folder {args.forward_folder} does not exist.")
+        raise SystemExit(1)
+
+    try:
+        router = DomainRouter(dict(args.route), args.default, args.debug, args.routes_file)
+    except (OSError, ValueError) as e:
+        print(f"Could not read the routes: {e}")
+        raise SystemExit(1)
+
+    if args.routes_file:
+        install_routes_reload(router)
+
+    relay = Relay(args.forward_folder, router, args.workers, args.max_attempts, args.backoff_base,
+                  args.backoff_max, args.idle_seconds, args.debug)
+
+    if args.stats_port:
+        start_stats_server(relay, args.stats_port)
+
+    try:
+        while True:
+            relay.scan_spool()
+            relay.pool.close_idle()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        stats = relay.to_dict()
+        print(f"Stopping; {stats['messages_delivered']} message(s) delivered, {stats['messages_rejected']} rejected, "
+              f"{stats['messages_failed']} failed, {stats['queued']} still queued (they are read again next time).")
+    finally:
+        relay.pool.close_all()
+
+
+if __name__ == "__main__":
+    main()
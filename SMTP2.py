@@ -5,10 +5,20 @@ Patrick Lewis for COMP 431 Spring 2026
 HW3: Even More Baby-steps Towards the Construction of an SMTP Server (The Final Step!)
 """
 
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 from pathlib import Path
+from Client import FORWARD_V2_MAGIC, get_forward_file_format, read_forward_v2_records
+from ForwardFile import ForwardFile
 import argparse
+import glob
+import io
+import mmap
 import os
 import sys
+import time
 
 # Source - https://stackoverflow.com/a/287944
 # Posted by joeld, modified by community. See post 'Timeline' for change history
@@ -125,6 +135,17 @@ class Parser:
         prevent changing the output for grading.
         """
 
+    def load(self, input_string: str) -> bool:
+        """
+        Points the parser at a new input string, as if it had just been created for it. This lets
+        one parser be reused for every line of a forward file instead of creating a new one for
+        each line.
+        """
+
+        self.input_string = input_string
+        self.OUT_OF_BOUNDS = len(input_string)
+        return self.reset()
+
     def set_command_parsed(self):
         """
         Sets the command_parsed flag.
@@ -1247,11 +1268,23 @@ class SMTPClientSide:
     """
     EXPECTING_DATA_END = 3
 
-    def __init__(self, debug_mode: bool = False):
+    def __init__(self, debug_mode: bool = False, output=None, error_output=None):
         self.state = self.EXPECTING_MAIL_FROM
         self.parser = None
         self.debug_mode = debug_mode
         self.generated_cmd = ""
+
+        self.output = output if output is not None else sys.stdout
+        """
+        Where the SMTP commands (and the body lines) are written. This can be a buffered writer:
+        it is only flushed by flush(), right before a response is read.
+        """
+
+        self.error_output = error_output if error_output is not None else sys.stderr
+        """
+        Where the responses are echoed. Flushed together with output.
+        """
+
         self.input_line = ""
         """
         This is the current line from the forward file. This will be useful
@@ -1303,17 +1336,17 @@ class SMTPClientSide:
 
         # STATE == 0
         if self.state == self.EXPECTING_MAIL_FROM:
-            print(self.parser.generate_mail_from_cmd())
+            self.write_line(self.parser.generate_mail_from_cmd())
             return True
 
         if self.state == self.EXPECTING_RCPT_TO:
-            print(self.parser.generate_rcpt_to_cmd())
+            self.write_line(self.parser.generate_rcpt_to_cmd())
             return True
 
         if self.state == self.EXPECTING_RCPT_TO_OR_DATA:
             if self.parser.forwardfile_match_to_address():
                 self.generated_cmd = "RCPT TO"
-                print(self.parser.generate_rcpt_to_cmd())
+                self.write_line(self.parser.generate_rcpt_to_cmd())
                 return True
 
             # If we made it here, that means that the text is NOT "To: <emailaddress>"
@@ -1322,25 +1355,41 @@ class SMTPClientSide:
             # 1. Send the "DATA" command
             # 2. Prompt the user for an SMTP response
             self.generated_cmd = "DATA"
-            print(self.parser.generate_data_cmd())
+            self.write_line(self.parser.generate_data_cmd())
             return True
 
         if self.state == self.EXPECTING_DATA_END:
             if self.parser.forwardfile_match_from_address():
                 self.generated_cmd = "MAIL FROM"
-                print(self.parser.generate_data_end_cmd())
+                self.write_line(self.parser.generate_data_end_cmd())
                 return True
 
             if end_of_file:
-                print(self.parser.generate_data_end_cmd())
+                self.write_line(self.parser.generate_data_end_cmd())
                 return True
 
             # If we are here, that means the we are reading lines in the forward
             # file that are part of the body of the email message.
-            print(self.parser.get_input_line())
+            self.write_line(self.parser.get_input_line())
 
         return False
 
+    def write_line(self, text: str):
+        """
+        Writes one line of output (an SMTP command or a line of the body) without flushing.
+        """
+
+        self.output.write(text + "\n")
+
+    def flush(self):
+        """
+        Flushes everything written so far. This has to happen before waiting for a response, or
+        whoever plays the server would never see the command it is supposed to answer.
+        """
+
+        self.output.flush()
+        self.error_output.flush()
+
     def print_to_stderr(self, text: str):
         """
         Prints the specified text to standard error (without using the print() function).
@@ -1350,8 +1399,7 @@ class SMTPClientSide:
         if self.debug_mode:
             text = f"{bcolors.FAIL}{text}{bcolors.ENDC}"
 
-        sys.stderr.write(text)
-        sys.stderr.flush()
+        self.error_output.write(text)
 
     def debug_print(self, text: str):
         if not self.debug_mode:
@@ -1478,9 +1526,111 @@ class SMTPClientSide:
         to stderr, just with the extra step of quitting.
         """
 
-        print("QUIT")
+        self.write_line("QUIT")
+        self.flush()
         sys.exit(0)
 
+PARALLEL_CHUNK_BYTES = 16 << 20
+"""
+In parallel mode, forward files bigger than this are split into ranges of about this size (at
+message boundaries), so that one big file can keep more than one process busy.
+"""
+
+ACCEPT_ALL_RESPONSES = {
+    "MAIL": "250 OK\n",
+    "RCPT": "250 OK\n",
+    "DATA": "354 Start mail input; end with <CRLF>.<CRLF>\n",
+    ".": "250 OK\n",
+}
+"""
+The responses of a server that accepts everything, for each command SMTP2.py sends.
+"""
+
+class ScriptedResponses:
+    """
+    Stands in for standard input when there is nobody to play the server. The responses in
+    ordered are given first, one per command; after that, each command gets the default
+    response for it ("MAIL", "RCPT", "DATA" or "."). A command without a default gets an empty
+    response, which is what the end of standard input looks like, so SMTP2.py quits.
+
+    It also counts what it answered, which is how the parallel mode knows how many messages a
+    forward file has.
+    """
+
+    def __init__(self, client_side: SMTPClientSide, ordered: list = None, defaults: dict = None):
+        self.client_side = client_side
+        self.ordered = ordered or []
+        self.defaults = ACCEPT_ALL_RESPONSES if defaults is None else defaults
+        self.position = 0
+        self.commands = 0
+        self.messages = 0
+
+        self.last_response = ""
+        """
+        The response readline() gave last.
+        """
+
+    def get_command(self) -> str:
+        """
+        Returns which command client_side just wrote, based on its state.
+        """
+
+        state = self.client_side.get_state()
+
+        if state == SMTPClientSide.EXPECTING_MAIL_FROM:
+            return "MAIL"
+
+        if state == SMTPClientSide.EXPECTING_RCPT_TO_OR_DATA and self.client_side.get_generated_cmd() == "DATA":
+            return "DATA"
+
+        if state in [SMTPClientSide.EXPECTING_RCPT_TO, SMTPClientSide.EXPECTING_RCPT_TO_OR_DATA]:
+            return "RCPT"
+
+        return "."
+
+    def readline(self) -> str:
+        """
+        Returns the response to the command that client_side just wrote.
+        """
+
+        command = self.get_command()
+        self.commands += 1
+        if command == "MAIL":
+            self.messages += 1
+
+        if self.position < len(self.ordered):
+            self.position += 1
+            self.last_response = self.ordered[self.position - 1]
+        else:
+            self.last_response = self.defaults.get(command, "")
+
+        return self.last_response
+
+def read_response_script(path: Path) -> tuple:
+    """
+    Reads a response script and returns (ordered, defaults) for ScriptedResponses. A line like
+    "DATA: 354 Go ahead" sets the default response for a command (MAIL, RCPT, DATA or .), and any
+    other line is the next response in order. Blank lines and lines that start with "#" are
+    skipped.
+    """
+
+    ordered = []
+    defaults = {}
+
+    with path.open(mode="r", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+
+            command, separator, response = line.partition(":")
+            if separator and command.strip() in ACCEPT_ALL_RESPONSES:
+                defaults[command.strip()] = response.strip() + "\n"
+            else:
+                ordered.append(line + "\n")
+
+    return ordered, defaults
+
 def get_command_line_arguments():
     """
     Handles command line arguments for the forward file and debug mode.
@@ -1498,13 +1648,94 @@ def get_command_line_arguments():
     # Add an argument for reading the forward file
     arg_parser.add_argument(
         "input_file",
-        help="Path to the forward file",
+        help="Path to the forward file, or a folder or glob pattern (in quotes) of forward files to go through in parallel",
         type=Path
     )
 
-    return arg_parser.parse_args()
+    # Going through many forward files (or one big one) at once
+    arg_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=0,
+        help="Number of processes for a folder, glob or single big file (default: one per core). "
+             "Every command gets the response a server that accepts everything would send, or the "
+             "default from --responses."
+    )
+    arg_parser.add_argument(
+        "--chunk-bytes",
+        type=int,
+        default=PARALLEL_CHUNK_BYTES,
+        help="Forward files bigger than this are split between processes at message boundaries"
+    )
+    arg_parser.add_argument(
+        "--summary-only",
+        action="store_true",
+        help="In parallel mode, only print the counts and not the transcripts"
+    )
 
-def process_line(client_side: SMTPClientSide, line: str, end_of_file: bool = False, debug_mode: bool = False) -> SMTPClientSide:
+    # Responses from a file instead of from stdin
+    arg_parser.add_argument(
+        "--responses",
+        type=Path,
+        default=None,
+        help="Script of server responses to use instead of stdin: lines like 'DATA: 354 Go ahead' set "
+             "the default for MAIL, RCPT, DATA or '.', and other lines are used in order first"
+    )
+
+    args = arg_parser.parse_args()
+
+    args.response_script = None
+    if args.responses:
+        try:
+            args.response_script = read_response_script(args.responses)
+        except OSError as e:
+            arg_parser.error(f"could not read --responses: {e}")
+
+        # The order of the responses would depend on how the files are split up
+        if args.response_script[0] and (args.jobs or not args.input_file.is_file()):
+            arg_parser.error("responses in order only work with a single forward file and without --jobs; use defaults")
+
+    return args
+
+FORWARD_FILE_BUFFER_SIZE = 1 << 20
+"""
+Bytes read from the forward file at a time, and bytes of output collected before they are written
+(unless a response is needed first).
+"""
+
+
+def get_v2_text_lines(data, start: int):
+    """
+    Yields the lines of the message text of each record of a v2 forward file (see Server.py
+    --forward-format) in data, from start, where a record begins. A v2 file then goes through the
+    same way as the text file it was converted from.
+    """
+
+    for *_, text in read_forward_v2_records(data, start):
+        yield from io.StringIO(text, newline="\n")
+
+
+def read_forward_lines(forward_file: Path):
+    """
+    Yields (line, end_of_file) for every line of the forward file, then ("", True) once the end of
+    the file is reached. Only one buffer of the file is in memory at a time.
+    """
+
+    if get_forward_file_format(forward_file) == "v2":
+        with forward_file.open(mode="rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for line in get_v2_text_lines(data, len(FORWARD_V2_MAGIC)):
+                yield line, False
+    else:
+        with forward_file.open(mode='r', newline='\n', buffering=FORWARD_FILE_BUFFER_SIZE) as f:
+            for line in f:
+                yield line, False
+
+    # One last time after we have reached EOF
+    yield "", True
+
+
+def process_forward_lines(client_side: SMTPClientSide, lines, responses, debug_mode: bool = False,
+                          flush_before_response: bool = True) -> SMTPClientSide:
     """
     The heavy lifting of the state machine is handled here.
 
@@ -1518,44 +1749,220 @@ def process_line(client_side: SMTPClientSide, line: str, end_of_file: bool = Fal
     command for ending the email body.
     7) If the end of file is reached and 250 has been provided, echo it and then send the QUIT
     command.
+
+    lines yields (line, end_of_file) pairs (see read_forward_lines()) and responses is read one
+    line at a time; the output is flushed before each one unless flush_before_response is False
+    (the responses come from a ScriptedResponses). A line that has to be evaluated again goes back to the front of the work
+    queue instead of being handled by a recursive call, and the same two Parser objects are
+    reused for every line.
     """
 
-    if debug_mode:
-        sys.stdout.write(f"ff line: {bcolors.OKCYAN}{line}{bcolors.ENDC}")
-        sys.stdout.flush()
+    forward_parser = Parser("", debug_mode=debug_mode)
+    response_parser = Parser("", debug_mode=debug_mode)
+    work = deque()
 
-    # Create a Parser object to parse this line
-    parser = Parser(line, debug_mode=debug_mode)
+    for item in lines:
+        work.append(item)
 
-    # This time, you do not print out the line from the forward file; you print
-    # the SMTP command as appropriate (could also just be email body text)
-    client_side.set_parser(parser)
+        while work:
+            line, end_of_file = work.popleft()
 
-    # Based on the current line, evaluate the state and print accordingly
-    prompt_for_response = client_side.evaluate_state(end_of_file)
+            if debug_mode:
+                client_side.output.write(f"ff line: {bcolors.OKCYAN}{line}{bcolors.ENDC}")
 
-    if not prompt_for_response:
-        if debug_mode:
-            print(f"No SMTP response requested for state '{client_side.get_state()}'")
-        return client_side
+            # This time, you do not print out the line from the forward file; you print
+            # the SMTP command as appropriate (could also just be email body text)
+            forward_parser.load(line)
+            client_side.set_parser(forward_parser)
 
-    # After printing the appropriate line, prompt the user for the response that would
-    # be normally sent from an SMTP server
-    response = sys.stdin.readline()
+            # Based on the current line, evaluate the state and print accordingly
+            if not client_side.evaluate_state(end_of_file):
+                if debug_mode:
+                    client_side.debug_print(f"No SMTP response requested for state '{client_side.get_state()}'")
+                continue
 
-    # Evaluate the response and act accordingly
-    parser = Parser(response, debug_mode=debug_mode)
-    client_side.set_parser(parser)
+            # After printing the appropriate line, prompt the user for the response that would
+            # be normally sent from an SMTP server. They have to be able to see the command first.
+            if flush_before_response:
+                client_side.flush()
+            response_parser.load(responses.readline())
+            client_side.set_parser(response_parser)
 
-    # If this returns True, then recursively call this function.
-    # This will evaluate the line again with a new state!
-    if client_side.evaluate_response(end_of_file):
-        if debug_mode:
-            print(f"{bcolors.WARNING}About to process line {line} again...{bcolors.ENDC}")
-        return process_line(client_side, line, end_of_file, debug_mode)
+            # If this returns True, evaluate the line again with the new state
+            if client_side.evaluate_response(end_of_file):
+                if debug_mode:
+                    client_side.debug_print(f"{bcolors.WARNING}About to process line {line} again...{bcolors.ENDC}")
+                work.appendleft((line, end_of_file))
 
     return client_side
 
+
+def process_line(client_side: SMTPClientSide, line: str, end_of_file: bool = False, debug_mode: bool = False) -> SMTPClientSide:
+    """
+    Processes a single line of the forward file, reading responses from standard input. See
+    process_forward_lines().
+    """
+
+    return process_forward_lines(client_side, [(line, end_of_file)], sys.stdin, debug_mode)
+
+
+def get_forward_paths(input_path: Path) -> list:
+    """
+    Returns the forward files to go through, sorted: the file itself, the files in a folder
+    (skipping hidden ones such as forward/.index), or the files that match a glob pattern.
+    """
+
+    if input_path.is_file():
+        return [input_path]
+
+    if input_path.is_dir():
+        paths = input_path.iterdir()
+    else:
+        paths = (Path(name) for name in glob.glob(str(input_path)))
+
+    return sorted(path for path in paths if path.is_file() and not path.name.startswith("."))
+
+
+def get_forward_ranges(path: Path, chunk_bytes: int) -> list:
+    """
+    Returns (start, end) byte ranges that cover the forward file, each starting at the beginning
+    of a message and about chunk_bytes long. The message offsets come from the index kept by
+    ForwardFile, so finding them does not mean reading the file line by line, and only include
+    "From:" lines the grammar accepts, so a range never starts at a "From:" line in a body.
+    """
+
+    size = path.stat().st_size
+    if size <= chunk_bytes:
+        return [(0, size)]
+
+    with ForwardFile(path) as forward_file:
+        offsets = forward_file.offsets
+        size = forward_file.size
+
+    ranges = []
+    start = 0
+    while start < size:
+        # The first message that starts at least chunk_bytes later ends this range
+        number = bisect_left(offsets, start + chunk_bytes)
+        end = offsets[number] if number < len(offsets) else size
+        ranges.append((start, end))
+        start = end
+
+    return ranges
+
+
+def process_forward_range(path: Path, start: int, end: int, last: bool, keep_transcript: bool, defaults: dict,
+                          debug_mode: bool) -> dict:
+    """
+    Goes through bytes start to end of a forward file in a worker process, answering every command
+    with the default responses of ScriptedResponses, and returns the counts and the transcript (the commands with the
+    responses after them, as they would appear on stdout and stderr). Only the last range of a
+    file keeps its QUIT, so the transcripts of the ranges add up to the transcript of the file,
+    unless a response made the client quit before the end of the range, or a line raised a
+    ParserError ("stopped"), in which case a serial run would have stopped there too.
+    """
+
+    started = time.perf_counter()
+
+    with path.open(mode="rb") as f:
+        file_format = "v2" if f.read(len(FORWARD_V2_MAGIC)) == FORWARD_V2_MAGIC else "text"
+        f.seek(start)
+        data = f.read(end - start)
+
+    if file_format == "v2":
+        # Ranges start at a record, except the first, which starts with the magic
+        text_lines = get_v2_text_lines(data, len(FORWARD_V2_MAGIC) if start == 0 else 0)
+    else:
+        text_lines = io.StringIO(data.decode("utf-8", errors="replace"), newline="\n")
+
+    transcript = io.StringIO() if keep_transcript else open(os.devnull, mode="w", encoding="utf-8")
+    client_side = SMTPClientSide(debug_mode, output=transcript, error_output=transcript)
+    responses = ScriptedResponses(client_side, defaults=defaults)
+
+    lines = chain(((line, False) for line in text_lines), [("", True)])
+
+    stopped = False
+    try:
+        process_forward_lines(client_side, lines, responses, debug_mode, flush_before_response=False)
+    except ParserError as pe:
+        # The same as main(): the error is written and the file goes no further
+        client_side.write_line(str(pe))
+        stopped = True
+    except SystemExit:
+        # QUIT was written. At the end of the range, that is after the last "." was accepted;
+        # anything else means the client gave up because of a response
+        last_response = Parser(responses.last_response, debug_mode=debug_mode)
+        stopped = client_side.get_state() != SMTPClientSide.EXPECTING_DATA_END or not last_response.match_response_code() \
+            or last_response.get_smtp_response_code() != "250"
+
+    transcript_text = ""
+    if keep_transcript:
+        transcript_text = transcript.getvalue()
+        if not last and not stopped and transcript_text.endswith("QUIT\n"):
+            transcript_text = transcript_text[:-len("QUIT\n")]
+    transcript.close()
+
+    return {
+        "path": str(path),
+        "start": start,
+        "end": end,
+        "messages": responses.messages,
+        "commands": responses.commands,
+        "stopped": stopped,
+        "seconds": time.perf_counter() - started,
+        "transcript": transcript_text,
+    }
+
+
+def process_forward_files(paths: list, jobs: int, chunk_bytes: int, keep_transcript: bool, debug_mode: bool, output=None,
+                          defaults: dict = None) -> dict:
+    """
+    Goes through the forward files in parallel and writes their transcripts to output, one file
+    after the other in the order of paths, so the output does not depend on which process
+    finished first. Once a range of a file stops early because of a response, the ranges after it
+    are left out, the same as a serial run would never get to them. Returns {path: counts} along
+    with the totals.
+    """
+
+    output = output if output is not None else sys.stdout
+    started = time.perf_counter()
+
+    work = []
+    for path in paths:
+        ranges = get_forward_ranges(path, chunk_bytes)
+        for number, (start, end) in enumerate(ranges):
+            work.append((path, start, end, number == len(ranges) - 1, keep_transcript, defaults, debug_mode))
+
+    files = {str(path): {"messages": 0, "commands": 0, "bytes": 0, "ranges": 0, "stopped": False} for path in paths}
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # map() returns the results in the order of work, whatever order they finish in
+        for result in executor.map(process_forward_range, *zip(*work)) if work else []:
+            counts = files[result["path"]]
+            if counts["stopped"]:
+                continue
+
+            counts["stopped"] = result["stopped"]
+            counts["messages"] += result["messages"]
+            counts["commands"] += result["commands"]
+            counts["bytes"] += result["end"] - result["start"]
+            counts["ranges"] += 1
+            output.write(result["transcript"])
+
+    output.flush()
+    seconds = time.perf_counter() - started
+    messages = sum(counts["messages"] for counts in files.values())
+
+    return {
+        "files": files,
+        "ranges": len(work),
+        "jobs": jobs,
+        "messages": messages,
+        "seconds": seconds,
+        "messages_per_second": messages / seconds if seconds else 0.0,
+    }
+
+
 def main():
     """
     Reads and loops through a well-formatted forward file.
@@ -1568,14 +1975,50 @@ def main():
     if debug_mode:
         print("Debug mode enabled for this script.")
 
-    if not forward_file or not forward_file.exists():
-        if debug_mode:
-            print(f"The forward file {forward_file} does not exist.")
+    # A folder, a glob pattern or --jobs goes through the files in parallel, with no stdin
+    if args.jobs or not forward_file.is_file():
+        forward_paths = get_forward_paths(forward_file)
+        if not forward_paths:
+            if debug_mode:
+                print(f"The forward file {forward_file} does not exist.")
+            return
+
+        jobs = args.jobs or os.cpu_count() or 1
+        output = open(sys.stdout.fileno(), mode="w", encoding="utf-8", newline="\n",
+                      buffering=FORWARD_FILE_BUFFER_SIZE, closefd=False)
+        defaults = args.response_script[1] if args.response_script else None
+        summary = process_forward_files(forward_paths, jobs, args.chunk_bytes, not args.summary_only, debug_mode, output, defaults)
+
+        for path, counts in summary["files"].items():
+            sys.stderr.write(f"{path}: {counts['messages']} message(s), {counts['commands']} command(s), "
+                             f"{counts['ranges']} range(s){', stopped by a response' if counts['stopped'] else ''}\n")
+        sys.stderr.write(f"{len(summary['files'])} file(s), {summary['messages']} message(s) in {summary['ranges']} range(s) "
+                         f"on {summary['jobs']} process(es): {summary['seconds']:.1f}s, "
+                         f"{summary['messages_per_second']:.0f} messages/s\n")
         return
 
+    # Without debug mode, nothing else writes to stdout, so the commands can be collected in a
+    # bigger buffer than sys.stdout has and only written when a response is needed
+    output = sys.stdout
+    error_output = sys.stderr
+    if not debug_mode:
+        output = open(sys.stdout.fileno(), mode="w", encoding="utf-8", newline="\n",
+                      buffering=FORWARD_FILE_BUFFER_SIZE, closefd=False)
+
+        # With a response script, nobody is waiting to see each command, so the echoed responses
+        # can be buffered as well
+        if args.response_script:
+            error_output = open(sys.stderr.fileno(), mode="w", encoding="utf-8", newline="\n",
+                                buffering=FORWARD_FILE_BUFFER_SIZE, closefd=False)
+
     # To parse the forward file, we also need something like a state machine, especially since
     # a forward file can contain more than one email.
-    client_side = SMTPClientSide(debug_mode)
+    client_side = SMTPClientSide(debug_mode, output=output, error_output=error_output)
+
+    responses = sys.stdin
+    if args.response_script:
+        ordered, defaults = args.response_script
+        responses = ScriptedResponses(client_side, ordered, defaults)
 
     # Thinking:
     # read forward file one line at a time
@@ -1592,16 +2035,11 @@ def main():
 
     try:
 
-        with forward_file.open(mode='r', newline='\n') as f:
-
-            # Loop through each line of the file
-            for line in f:
-
-                # process the line, keep up with the result
-                client_side = process_line(client_side, line, False, debug_mode)
-
-            # One last time after we have reached EOF
-            client_side = process_line(client_side, "", True, debug_mode)
+        # Responses are read through sys.stdin's own buffer, so responses that are piped in ahead
+        # of time do not cost a read each. Scripted responses are ready right away, so there is
+        # no need to flush before each one.
+        client_side = process_forward_lines(client_side, read_forward_lines(forward_file), responses, debug_mode,
+                                            flush_before_response=responses is sys.stdin)
 
     except EOFError:
         # Ctrl+D (Unix) or end-of-file from a pipe
@@ -1617,13 +2055,15 @@ def main():
         # occurrs, the write up says "upon receipt of any erroneous SMTP message you should
         # reset your state machine and return to the state of waiting for a valid MAIL FROM
         # message".
-        print(pe)
+        client_side.write_line(str(pe))
         # server.reset()
         # continue
     except Exception as e:
         # print(f"An unexpected error occurred: {e}")
         # break
         pass
+    finally:
+        client_side.flush()
 
 if __name__ == "__main__":
     main()
@@ -8,9 +8,32 @@ Port number for your server is 800 + the last 4 digits of your PID.
 """
 
 import argparse
+import codecs
+import fcntl
+import hashlib
+import heapq
+import json
+import lzma
+import mmap
+import os
+import queue
+import re
+import selectors
+import shutil
+import signal
 import socket
+import struct
 import sys
+import threading
+import time
+import tracemalloc
+import zlib
+from array import array
+from collections import OrderedDict
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import parse_qs, urlparse
 # from Parser import Parser, ParserError, DebugMode, socket_is_connected, socket_send_msg, get_hostname, close_socket
 
 def socket_is_connected(connection_socket: socket.socket, debug_mode: bool = False) -> bool:
@@ -336,6 +359,16 @@ class Parser:
             self.rewind(start)
             return True
 
+        self.reset()
+        if self.rset_cmd(check_only=True):
+            self.rewind(start)
+            return True
+
+        self.reset()
+        if self.noop_cmd(check_only=True):
+            self.rewind(start)
+            return True
+
         # This means no commands have been identified, which can mean a number of things but not
         # necessarily a problem (depending on the state of the SMTP Server)
         self.rewind(start)
@@ -540,7 +573,7 @@ class Parser:
         """
 
         start = self.position
-        codes = ["220", "221", "250", "354", "500", "501", "503"]
+        codes = ["220", "221", "250", "354", "500", "501", "503", "550"]
 
         for code in codes:
             if self.match_chars(code):
@@ -749,9 +782,11 @@ class Parser:
 
         <data-cmd> ::= "DATA" <nullspace> <CRLF>
         <quit-cmd> ::= "QUIT" <nullspace> <CRLF>
+        <rset-cmd> ::= "RSET" <nullspace> <CRLF>
+        <noop-cmd> ::= "NOOP" <nullspace> <CRLF>
         """
 
-        allowed_cmds = ["QUIT", "DATA"]
+        allowed_cmds = ["QUIT", "DATA", "RSET", "NOOP"]
 
         if not cmd_name or not isinstance(cmd_name, str) or not cmd_name in allowed_cmds:
             raise ValueError(f"word_only_commands(); must specify a valid command string literal ({','.join(allowed_cmds)})")
@@ -802,6 +837,28 @@ class Parser:
         DebugMode.print(self.debug_mode, "reached data_cmd()")
         return self.word_only_commands("DATA", check_only=check_only)
 
+    def rset_cmd(self, check_only: bool = False) -> bool:
+        """
+        The <rset-cmd> non-terminal handles the "RSET" command, which abandons the current email
+        message without closing the connection.
+
+        <rset-cmd> ::= "RSET" <nullspace> <CRLF>
+        """
+
+        DebugMode.print(self.debug_mode, "reached rset_cmd()")
+        return self.word_only_commands("RSET", check_only=check_only)
+
+    def noop_cmd(self, check_only: bool = False) -> bool:
+        """
+        The <noop-cmd> non-terminal handles the "NOOP" command, which does nothing other than get
+        a 250 from the server. Useful for checking that a connection is still alive.
+
+        <noop-cmd> ::= "NOOP" <nullspace> <CRLF>
+        """
+
+        DebugMode.print(self.debug_mode, "reached noop_cmd()")
+        return self.word_only_commands("NOOP", check_only=check_only)
+
     def data_read_msg_line(self):
         """
         Handles the reading of mail input lines after a successful DATA command.
@@ -1321,482 +1378,2946 @@ class Parser:
         return self.char_in_set(special_chars)
 
 
-class SMTPServer:
-    """
-    Class that will operate like a state machine to keep track of what command
-    is being handled next.
+class StackSampler:
     """
+    A low-overhead sampling profiler. When started, a background thread looks at the stack of
+    every other thread (sys._current_frames()) a number of times per second, and when it is done
+    writes the counts in the "collapsed stack" format that flamegraph tools read:
 
-    EXPECTING_CONNECTION = 0
-    EXPECTING_HELO = 1
-    EXPECTING_MAIL_FROM = 2
-    EXPECTING_RCPT_TO = 3
-    EXPECTING_RCPT_TO_OR_DATA = 4
-    EXPECTING_DATA_END = 5
-    EXPECTING_QUIT = 6
+        thread;outer_function;...;inner_function count
+    """
 
-    def __init__(self, debug_mode: bool = False):
-        self.state = self.EXPECTING_CONNECTION
-        self.to_email_addresses = []
-        self.to_domains = set()
-        self.email_text = []
-        self.parser = None
+    def __init__(self, output_folder: Path, rate: int = 100, seconds: float = 10.0, debug_mode: bool = False):
+        self.output_folder = output_folder
+        self.rate = rate
+        self.seconds = seconds
         self.debug_mode = debug_mode
-        self.connection_socket = None
+        self.thread = None
 
-    def set_parser(self, current_parser: Parser):
+    def is_running(self) -> bool:
         """
-        By the time the parser is set, the line has already been read. That means,
-        what we do is check the current state and act accordingly.
+        Returns True while samples are being taken.
         """
-        self.parser = current_parser
 
-        if not isinstance(current_parser, Parser):
-            raise ValueError("parser must be an instance of Parser class.")
+        return self.thread is not None and self.thread.is_alive()
 
-    def set_socket(self, connection_socket: socket.socket):
+    def start(self, seconds: float = 0.0) -> Path|None:
         """
-        Docstring for set_socket
-
-        :param self: Description
-        :param connection_socket: Description
-        :type connection_socket: socket
+        Starts sampling in the background and returns the file the results will be written to, or
+        None if sampling is already running. This is safe to call from a signal handler.
         """
 
-        self.connection_socket = connection_socket
+        if self.is_running():
+            return None
 
-        if not socket_is_connected(connection_socket, self.debug_mode):
-            raise ValueError("connection_socket must be an instance of the socket class.")
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+        output_path = self.output_folder / f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded"
 
-    def add_text_to_email_body(self, text: str):
+        self.thread = threading.Thread(target=self.sample, args=(seconds or self.seconds, output_path), name="stack-sampler", daemon=True)
+        self.thread.start()
+        return output_path
+
+    def sample(self, seconds: float, output_path: Path):
+        """
+        Takes samples until the time is up, then writes them to output_path.
         """
-        Add the input string without the trailing newline character to the list of lines that
-        will be appended to the message if the message parses correctly.
 
-        Note to self: .strip() is too greedy and will remove trailing and leading spaces and tabs,
-        changing the original content of each line passed to the parser.
+        interval = 1.0 / self.rate
+        own_thread_id = threading.get_ident()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        counts = {}
 
-        Another note to self: if this function is called, just do it; do not try to prevent an
-        empty string from being sent to the email message.
-        """
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
 
-        self.email_text.append(text)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_qualname} ({Path(code.co_filename).name})")
+                    frame = frame.f_back
 
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
 
-    def evaluate_state(self):
+            time.sleep(interval)
+
+        with output_path.open("w", encoding="utf-8") as f:
+            for key, count in sorted(counts.items()):
+                f.write(f"{key} {count}\n")
+
+        DebugMode.print(self.debug_mode, f"stack samples written to {output_path}", DebugMode.SUCCESS)
+
+
+class MemorySnapshotter:
+    """
+    Compares tracemalloc snapshots to find the lines that allocated the most memory in between.
+    The first call only starts tracemalloc, since tracing slows down every allocation; each call
+    after that writes the top allocators since the previous call.
+    """
+
+    def __init__(self, output_folder: Path, top: int = 25, debug_mode: bool = False):
+        self.output_folder = output_folder
+        self.top = top
+        self.debug_mode = debug_mode
+        self.previous_snapshot = None
+
+    def take_snapshot(self) -> Path|None:
         """
-        Determines what should happen
+        Takes a snapshot and writes the difference from the previous one. Returns the file that was
+        written, or None if this was the first snapshot.
         """
 
-        DebugMode.print(self.debug_mode, "About to check whether the parser object is valid...")
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.previous_snapshot = tracemalloc.take_snapshot()
+            DebugMode.print(self.debug_mode, "tracemalloc started; send SIGUSR2 again for the top allocators", DebugMode.INFO)
+            return None
 
-        if not isinstance(self.parser, Parser):
-            raise ValueError("parser must be an instance of Parser class.")
+        snapshot = tracemalloc.take_snapshot()
+        differences = snapshot.compare_to(self.previous_snapshot, "lineno")
+        self.previous_snapshot = snapshot
 
-        DebugMode.print(self.debug_mode, "About to check whether the socket object is valid...")
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+        output_path = self.output_folder / f"tracemalloc-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.txt"
 
-        if not self.connection_socket or not socket_is_connected(self.connection_socket, self.debug_mode):
-            raise ValueError("connection_socket must be an instance of the socket class.")
+        with output_path.open("w", encoding="utf-8") as f:
+            for difference in differences[:self.top]:
+                f.write(f"{difference}\n")
 
-        # Syntax errors in the message name (type 500 errors) should take precedence over all other
-        # errors.
-        # Out-of-order (type 503 errors) should take precedence over parameter/argument errors
-        # (type 501 errors). This means that we can no longer throw a 501 error until we have
-        # verified that the command is in the correct sequence.
+        DebugMode.print(self.debug_mode, f"top allocators written to {output_path}", DebugMode.SUCCESS)
+        return output_path
 
-        DebugMode.print(self.debug_mode, f"evaluate_state(server): state: {self.state}")
 
-        if self.state == self.EXPECTING_CONNECTION:
-            if not socket_send_msg(self.connection_socket, f"220 {get_hostname()}", self.debug_mode):
-                print("Failed to send initial 220 message to client upon establishing a connection.")
-                return self.reset()
-            return self.advance()
+def install_profiling_signals(stack_sampler: StackSampler, memory_snapshotter: MemorySnapshotter):
+    """
+    SIGUSR1 starts the stack sampler and SIGUSR2 takes a tracemalloc snapshot. The handlers run on
+    the main thread in between socket calls, so they only start the work (sampling runs in its
+    own thread).
+    """
 
-        if self.state == self.EXPECTING_HELO:
-            if not self.parser.match_helo_msg():
-                raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: stack_sampler.start())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: memory_snapshotter.take_snapshot())
 
-            client_domain = self.parser.get_domain_from_helo()
-            if not socket_send_msg(self.connection_socket, f"250 Hello {client_domain} pleased to meet you", self.debug_mode):
-                print('Failed to send 250 Hello message to client. Closing connection.')
-                close_socket(self.connection_socket)
-            return self.advance()
 
-        # We need to know if any command is recognized to be ready for 503 errors
-        # We do not check for errors until after the SMTP "speaks" first.
-        recognized_command = self.command_id_errors()
+class LatencyHistogram:
+    """
+    Counts how many durations fall into each of a fixed set of buckets. The buckets never change,
+    so recording a duration is a binary search and a list increment, cheap enough to leave on all
+    the time.
+    """
 
-        # STATE == 0
-        if self.state == self.EXPECTING_MAIL_FROM:
-            # if the command fails, that means a type 501 error occurred.
-            if not self.parser.mail_from_cmd():
-                raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
+    BUCKET_BOUNDS_NS = (
+        1_000, 2_000, 5_000, 10_000, 20_000, 50_000, 100_000, 200_000, 500_000,
+        1_000_000, 2_000_000, 5_000_000, 10_000_000, 50_000_000, 100_000_000, 1_000_000_000,
+    )
+    """
+    Upper bound of each bucket in nanoseconds (1us to 1s). Anything slower goes in one last
+    bucket with no upper bound.
+    """
 
-            # If we made it here, the command was fully parsed successfully
-            # Add the "From: <reverse-path>" line to the list of email text lines
-            # self.add_text_to_email_body(self.parser.get_from_line_for_email())
+    __slots__ = ("counts", "count", "total_ns", "max_ns")
 
-            if not socket_send_msg(self.connection_socket, f"250 OK", self.debug_mode):
-                print('Failed to send 250 OK to client. Closing connection.')
-                close_socket(self.connection_socket)
-            return self.advance()
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKET_BOUNDS_NS) + 1)
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
 
-        if self.state == self.EXPECTING_RCPT_TO or \
-            (self.state == self.EXPECTING_RCPT_TO_OR_DATA and recognized_command == "RCPT TO"):
-            # if the command fails, that means a type 501 error occurred.
-            if not self.parser.rcpt_to_cmd():
-                raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
+    def observe(self, elapsed_ns: int):
+        """
+        Records one duration, in nanoseconds.
+        """
 
-            # If we made it here, the command was fully parsed successfully
-            # Add the "To: <forward-path>" line to the list of email text lines
-            # self.add_text_to_email_body(self.parser.get_to_line_for_email())
+        self.counts[bisect_left(self.BUCKET_BOUNDS_NS, elapsed_ns)] += 1
+        self.count += 1
+        self.total_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
 
-            # This is not used in HW4, domain is
-            # self.to_email_addresses.append(self.parser.get_email_address())
-            self.to_domains.add(self.parser.get_email_domain())
+    def to_dict(self) -> dict:
+        """
+        Returns the histogram with each bucket labeled by its upper bound in microseconds.
+        """
 
-            # Only advance if this is the first time we are seeing a To: address
-            if self.state == self.EXPECTING_RCPT_TO:
-                self.advance()
+        buckets = {str(bound // 1000): count for bound, count in zip(self.BUCKET_BOUNDS_NS, self.counts)}
+        buckets["+Inf"] = self.counts[-1]
 
-            # Send the client a 250
-            if not socket_send_msg(self.connection_socket, f"250 OK", self.debug_mode):
-                print('Failed to send 250 OK to client. Closing connection.')
-                close_socket(self.connection_socket)
-            return
+        return {
+            "count": self.count,
+            "mean_us": self.total_ns / self.count / 1000 if self.count else 0.0,
+            "max_us": self.max_ns / 1000,
+            "buckets_us": buckets,
+        }
 
-        if self.state == self.EXPECTING_RCPT_TO_OR_DATA:
-            # This means that the recognized command must be "DATA", but we'll check anyway
-            if recognized_command == "DATA" and not self.parser.data_cmd():
-                raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
 
-            # If we made it here, the command was fully parsed successfully
-            # Advance so that we can start reading the message
-            if not socket_send_msg(self.connection_socket, f"354 Start mail input; end with <CRLF>.<CRLF>", self.debug_mode):
-                print('Failed to send 354 message to client. Closing connection.')
-                close_socket(self.connection_socket)
-            return self.advance()
+class ServerMetrics:
+    """
+    Counters and latency histograms for the SMTP server. Everything is updated from the thread
+    that handles connections and only read by the stats server. Plain numbers and the fixed lists
+    of the histograms can be read while they change; errors_by_code can gain a key, which would
+    break a loop over it on the stats thread, so it is only used under errors_lock.
+    """
 
-        if self.state == self.EXPECTING_DATA_END:
-            # This is different because any text that does not create an error that is parsed
-            # here is considered valid until the ending comes.
-            DebugMode.print(self.debug_mode, "About to check for end of data...")
-            if self.parser.data_end_cmd():
-                DebugMode.print(self.debug_mode, "End of message confirmed. About to process the email message...")
-                self.process_email_message()
-                # Send the client a 250
-                if not socket_send_msg(self.connection_socket, f"250 OK", self.debug_mode):
-                    print('Failed to send 250 OK to client. Closing connection.')
-                    close_socket(self.connection_socket)
-                return self.advance()
-
-            # if an error occurs while reading a line meant for the body of the message, then
-            # throw an error. According to the writeup, "we'll assume that 'text' is limited to
-            # printable text, whitespace, and newlines".
-            DebugMode.print(self.debug_mode, "Checking for whether this is a valid line of text for the body of the email...")
-            if not self.parser.data_read_msg_line():
-                DebugMode.print(self.debug_mode, f"This line is not valid for the body of the email: {self.parser.get_input_line()}")
-                raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
-
-            DebugMode.print(self.debug_mode, f"About to add this line to the email body: {self.parser.get_input_line()}")
-            self.add_text_to_email_body(self.parser.get_input_line())
-            # Make sure not to advance here, this was almost a mistake that was done right in HW3
-            return False
+    def __init__(self, transition_keys):
+        self.connections = 0
+        self.messages = 0
+        self.recipients = 0
+        self.bytes_received = 0
+        self.message_bytes = 0
+        self.slow_sessions = 0
+        self.errors_by_code = {}
+        self.errors_lock = threading.Lock()
 
-        if self.state == self.EXPECTING_QUIT:
-            DebugMode.print(self.debug_mode, "About to check for QUIT command...")
+        self.transitions = {key: LatencyHistogram() for key in transition_keys}
+        """
+        One histogram per entry in SMTPServer.TRANSITIONS, created up front so that recording a
+        duration never has to create anything.
+        """
 
-            # It is possible to encounter another MAIL FROM command at this stage.
-            if self.parser.mail_from_cmd(check_only=True):
-                self.state = self.EXPECTING_MAIL_FROM
-                return self.evaluate_state()
+        self.process_email_message = LatencyHistogram()
 
-            if not self.parser.quit_cmd(check_only=True):
-                raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
+    def count_error(self, error_no: int):
+        """
+        Counts an error reply sent to the client, by reply code.
+        """
 
-            # Otherwise, we can send a message to the client and close the connection and return
-            # to its initial state
-            socket_send_msg(self.connection_socket, f"221 {get_hostname()} closing connection", self.debug_mode)
-            close_socket(self.connection_socket)
-            self.reset()
+        with self.errors_lock:
+            self.errors_by_code[error_no] = self.errors_by_code.get(error_no, 0) + 1
 
-    def command_id_errors(self) -> str:
+    def to_dict(self, state_names: dict) -> dict:
         """
-        If no command is recognized, then that results in a 500 error.
-        If an unexpected command is recognized based on the current state, that results in a 503.
-        Return the recognized command. This is helpful for when a state represents an option,
-        RCPT TO or DATA.
+        Returns every counter and histogram in a form that can be written as JSON.
         """
 
-        if self.state not in [self.EXPECTING_MAIL_FROM, self.EXPECTING_RCPT_TO, self.EXPECTING_RCPT_TO_OR_DATA, self.EXPECTING_QUIT]:
-            return ""
+        with self.errors_lock:
+            errors_by_code = dict(self.errors_by_code)
 
-        if not isinstance(self.parser, Parser):
-            raise ValueError("parser must be an instance of Parser class.")
+        return {
+            "connections": self.connections,
+            "messages": self.messages,
+            "recipients": self.recipients,
+            "bytes_received": self.bytes_received,
+            "message_bytes": self.message_bytes,
+            "slow_sessions": self.slow_sessions,
+            "errors_by_code": {str(code): count for code, count in errors_by_code.items()},
+            "transitions": {
+                f"{state_names.get(state, state)} {command}": histogram.to_dict()
+                for (state, command), histogram in self.transitions.items() if histogram.count
+            },
+            "process_email_message": self.process_email_message.to_dict(),
+        }
 
-        any_command_recognized = self.parser.check_for_commands()
-        recognized_command = self.parser.get_command_name()
+    def to_text(self, state_names: dict) -> str:
+        """
+        Returns the same numbers as to_dict() as plain "name value" lines. As in Prometheus, the
+        le="<bound>" line of a histogram counts every duration up to that bound, so the counts add
+        up from bucket to bucket and le="+Inf" is the total.
+        """
 
-        if self.debug_mode:
-            print(f"line: {self.parser.input_string.strip()}, state: {self.state}, recognized_command: {recognized_command}")
+        stats = self.to_dict(state_names)
+        lines = [f"smtp_{name} {stats[name]}" for name in ["connections", "messages", "recipients", "bytes_received", "message_bytes", "slow_sessions"]]
+        lines += [f'smtp_errors{{code="{code}"}} {count}' for code, count in stats["errors_by_code"].items()]
 
-        if not any_command_recognized or not recognized_command:
-            raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
+        histograms = [(f'smtp_transition_latency_us{{transition="{name}"', histogram) for name, histogram in stats["transitions"].items()]
+        histograms.append(("smtp_process_email_message_latency_us{", stats["process_email_message"]))
 
-        if self.state == self.EXPECTING_MAIL_FROM and recognized_command != "MAIL FROM":
-            raise ParserError(ParserError.BAD_SEQUENCE_OF_COMMANDS)
+        for prefix, histogram in histograms:
+            separator = "," if prefix.endswith('"') else ""
+            cumulative = 0
+            for bound, count in histogram["buckets_us"].items():
+                cumulative += count
+                lines.append(f'{prefix}{separator}le="{bound}"}} {cumulative}')
+            lines.append(f"{prefix}{separator}stat=\"count\"}} {histogram['count']}")
+            lines.append(f"{prefix}{separator}stat=\"mean\"}} {histogram['mean_us']:.3f}")
+            lines.append(f"{prefix}{separator}stat=\"max\"}} {histogram['max_us']:.3f}")
 
-        if self.state == self.EXPECTING_RCPT_TO and recognized_command != "RCPT TO":
-            raise ParserError(ParserError.BAD_SEQUENCE_OF_COMMANDS)
+        return "\n".join(lines) + "\n"
 
-        if self.state == self.EXPECTING_RCPT_TO_OR_DATA and recognized_command not in ["RCPT TO", "DATA"]:
-            raise ParserError(ParserError.BAD_SEQUENCE_OF_COMMANDS)
 
-        if self.state == self.EXPECTING_QUIT and recognized_command != "QUIT":
-            raise ParserError(ParserError.BAD_SEQUENCE_OF_COMMANDS)
+class SessionTimeline:
+    """
+    Timestamps of the state changes of one SMTP session (accept, 220, HELO, MAIL, each RCPT,
+    DATA, end-of-data, delivered, QUIT), kept in a ring buffer that is allocated once and reused
+    for every connection. Along with each timestamp, the running totals of the time spent waiting
+    on the network and writing to disk are saved, so each phase can be split into network wait,
+    disk, and everything else ("parse": parsing, handlers and sending replies).
+    """
 
-        return recognized_command
+    EVENT_NAMES = ("accept", "220", "HELO", "MAIL", "RCPT", "DATA", "end-of-data", "delivered", "RSET", "NOOP", "QUIT")
 
-    def reset(self):
-        """
-        Resets the SMTP server state machine to expect a new email.
-        """
+    EVENTS = {name: number for number, name in enumerate(EVENT_NAMES)}
+    """
+    Event name -> the small number stored in the ring buffer.
+    """
 
-        if self.state  < self.EXPECTING_MAIL_FROM:
-            self.state = self.EXPECTING_CONNECTION
-        else:
-            self.state = self.EXPECTING_MAIL_FROM  # self.EXPECTING_CONNECTION
+    __slots__ = ("capacity", "events", "times_ns", "network_totals_ns", "disk_totals_ns",
+                 "count", "network_ns", "disk_ns", "slow_threshold_ns", "slowest_phase_ns")
 
-        self.to_email_addresses = []
-        self.to_domains = set()
-        self.email_text = []
+    def __init__(self, capacity: int = 64, slow_threshold_ns: int = 0):
+        self.capacity = capacity
+        self.events = bytearray(capacity)
+        self.times_ns = array("q", bytes(8 * capacity))
+        self.network_totals_ns = array("q", bytes(8 * capacity))
+        self.disk_totals_ns = array("q", bytes(8 * capacity))
 
-        DebugMode.print(self.debug_mode, "SERVER state machine has been reset.", DebugMode.ERROR)
+        self.slow_threshold_ns = slow_threshold_ns
+        """
+        A session with a phase longer than this is slow. 0 turns the check off.
+        """
 
-    def advance(self):
+        self.start(0)
+
+    def start(self, now_ns: int):
         """
-        Advances the state of the SMTP server by 1. If a message is completed,
-        then it starts over and waits for the next one.
+        Forgets the previous session and records the "accept" event of a new one.
         """
-        if self.state != self.EXPECTING_QUIT:
-            self.state += 1
-            return
 
-        self.reset()
+        self.count = 0
+        self.network_ns = 0
+        self.disk_ns = 0
+        self.slowest_phase_ns = 0
+        self.record("accept", now_ns)
 
-    def create_folder(self, folder_name: str) -> Path:
+    def record(self, event_name: str, now_ns: int = 0):
         """
-        Create a folder with the specified name in the same location as this
-        Python script.
+        Records that event_name happened now. Once the buffer is full, the oldest events are
+        overwritten, so a long session only keeps its last few messages.
         """
 
-        if not folder_name:
-            raise ValueError("create_folder(); must specify a folder name")
+        now_ns = now_ns or time.perf_counter_ns()
+        slot = self.count % self.capacity
 
-        # This is the folder that this Python script lives in.
-        # I got this wrong the first time; this should be in the "current working directory" (p. 6)
-        current_folder = Path.cwd()
-        # This is the "forward" folder I want to create
-        new_folder = current_folder / folder_name
+        if self.count:
+            phase_ns = now_ns - self.times_ns[(self.count - 1) % self.capacity]
+            if phase_ns > self.slowest_phase_ns:
+                self.slowest_phase_ns = phase_ns
 
-        # it's okay if the folder already exists
-        new_folder.mkdir(exist_ok=True)
+        self.events[slot] = self.EVENTS[event_name]
+        self.times_ns[slot] = now_ns
+        self.network_totals_ns[slot] = self.network_ns
+        self.disk_totals_ns[slot] = self.disk_ns
+        self.count += 1
 
-        return new_folder
+    def is_slow(self) -> bool:
+        """
+        Returns True if the slow check is on and any phase so far took longer than the threshold.
+        """
 
-    def process_email_message(self):
+        return 0 < self.slow_threshold_ns < self.slowest_phase_ns
+
+    def to_dict(self) -> dict:
         """
-        Takes the lines that make up the email message and appends them to the mailbox files in
-        the "forward" folder for each recipient of the current message (to_email_addresses).
+        Returns the phases still in the buffer, each with its duration and breakdown in
+        milliseconds. A phase is named after the event that ends it.
         """
 
-        # 1. Get the text of the message
-        email_complete_text = "\n".join(self.email_text) + "\n"
+        first = max(0, self.count - self.capacity)
+        phases = []
 
-        # 2. Create the "folder" folder
-        forward_folder = self.create_folder("forward")
+        for i in range(first + 1, self.count):
+            slot, previous = i % self.capacity, (i - 1) % self.capacity
+            total_ns = self.times_ns[slot] - self.times_ns[previous]
+            network_ns = self.network_totals_ns[slot] - self.network_totals_ns[previous]
+            disk_ns = self.disk_totals_ns[slot] - self.disk_totals_ns[previous]
 
-        # 3. For each recipient of the latest email message, append the text
-        # of the email to a file with the email address as the name.
-        for domain in self.to_domains:
-            forward_path = forward_folder / domain
+            phases.append({
+                "event": self.EVENT_NAMES[self.events[slot]],
+                "ms": total_ns / 1_000_000,
+                "network_ms": network_ns / 1_000_000,
+                "parse_ms": (total_ns - network_ns - disk_ns) / 1_000_000,
+                "disk_ms": disk_ns / 1_000_000,
+                "slow": total_ns > self.slow_threshold_ns > 0,
+            })
 
-            with forward_path.open("a", encoding="utf-8") as f:
-                f.write(email_complete_text)
+        return {
+            "events": self.count,
+            "dropped_events": first,
+            "total_ms": (self.times_ns[(self.count - 1) % self.capacity] - self.times_ns[first % self.capacity]) / 1_000_000,
+            "phases": phases,
+        }
 
 
-def get_command_line_arguments():
+class StatsRequestHandler(BaseHTTPRequestHandler):
     """
-    Handles command line arguments for the forward file and debug mode.
+    Serves the server's metrics: /stats as JSON and /metrics as plain text. /profile?seconds=N
+    starts the stack sampler, the same as sending SIGUSR1.
     """
 
-    arg_parser = argparse.ArgumentParser(description="HW4: Building an SMTP Client/Server System Using Sockets")
-    # https://docs.python.org/3/library/argparse.html#argparse.ArgumentParser.add_argument
-    arg_parser.add_argument(
-        "--debug",
-        # https://docs.python.org/3/library/argparse.html#action
-        action="store_true",
-        help="Enable additional logging that is helpful for debugging without modifying code."
-    )
+    smtp_server = None
+    stack_sampler = None
+
+    def do_GET(self):
+        state_names = self.smtp_server.STATE_NAMES
+        url = urlparse(self.path)
+
+        if url.path == "/profile" and self.stack_sampler is not None:
+            try:
+                seconds = float(parse_qs(url.query).get("seconds", ["0"])[0])
+            except ValueError:
+                seconds = -1.0
+            # nan fails every comparison, so it is rejected along with negative numbers
+            if not 0 <= seconds < float("inf"):
+                self.send_error(400, "seconds has to be a number of seconds")
+                return
+            output_path = self.stack_sampler.start(seconds)
+            body = (f"sampling; results will be written to {output_path}\n" if output_path else "already sampling\n").encode()
+            content_type = "text/plain; charset=utf-8"
+        elif url.path in ["/stats", "/stats.json"]:
+            stats = self.smtp_server.metrics.to_dict(state_names)
+            if self.smtp_server.recipient_index is not None:
+                stats["recipient_index"] = self.smtp_server.recipient_index.to_dict()
+            if self.smtp_server.forward_segments is not None:
+                stats["forward_segments"] = self.smtp_server.forward_segments.to_dict()
+            if self.smtp_server.duplicate_cache is not None:
+                stats["duplicate_cache"] = self.smtp_server.duplicate_cache.to_dict()
+            if self.smtp_server.mail_indexer is not None:
+                stats["mail_index"] = self.smtp_server.mail_indexer.to_dict()
+            body = json.dumps(stats, indent=2).encode()
+            content_type = "application/json"
+        elif url.path == "/metrics":
+            text = self.smtp_server.metrics.to_text(state_names)
+            if self.smtp_server.duplicate_cache is not None:
+                text += "".join(f"smtp_duplicate_cache_{name} {value}\n" for name, value in self.smtp_server.duplicate_cache.to_dict().items())
+            body = text.encode()
+            content_type = "text/plain; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
 
-    # Add an argument for reading the forward file
-    arg_parser.add_argument(
-        "port_number",
-        # https://docs.python.org/3/library/argparse.html#action
-        # 'store' - This just stores the argument's value. This is the default action.
-        action="store",
-        help="Incoming port number for connecting to the SMTP server",
-        # https://docs.python.org/3/library/argparse.html#type
-        # TODO: Make sure setting this does not create issues; the default is to store this value
-        # as a "simple string"
-        type=int
-    )
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-    return arg_parser.parse_args()
+    def log_message(self, format, *args):
+        # Requests for stats should not show up in the server's output
+        pass
 
 
-def main():
+def start_stats_server(smtp_server, port: int, stack_sampler: StackSampler|None = None, debug_mode: bool = False) -> ThreadingHTTPServer:
     """
-    This code starts here.
+    Starts serving the metrics of smtp_server on 127.0.0.1:port from a background thread. Only
+    the loopback address is used so that the stats are not reachable from other hosts.
     """
 
-    # TODO: Print the hostname, delete this
-    # print(f"220 {get_hostname()}")
+    handler_class = type("BoundStatsRequestHandler", (StatsRequestHandler,), {"smtp_server": smtp_server, "stack_sampler": stack_sampler})
+    stats_server = ThreadingHTTPServer(("127.0.0.1", port), handler_class)
 
-    args = get_command_line_arguments()
-    debug_mode = args.debug
-    # 8000 + 4956 = 12956
-    server_port = args.port_number
+    threading.Thread(target=stats_server.serve_forever, name="stats-server", daemon=True).start()
 
-    # This is the maximum amount of data, in bytes, that can be received or sent via the socket.
-    bufsize = 1024
+    DebugMode.print(debug_mode, f"serving stats on http://127.0.0.1:{port}/stats and /metrics", DebugMode.INFO)
+    return stats_server
 
-    # Create an instance of the SMTPServer state machine
-    smtp_server = SMTPServer(debug_mode)
 
-    # https://docs.python.org/3.12/library/socket.html#socket.AF_INET
-    # https://docs.python.org/3.12/library/socket.html#socket.SOCK_STREAM
-    # SOCK_STREAM represents a socket type, one of the two the official documentation lists as
-    # useful
-    # By following the first example from the documentation here, it looks like you should use
-    # "with" statements to properly close resources when they are done.
-    # https://docs.python.org/3.12/library/socket.html#example
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+class DomainTableNode:
+    """
+    One label of a DomainTable, such as "unc" in "cs.unc.edu".
+    """
 
-        # The documentation provides a way to reuse a local socket in the TIME_WAIT state without
-        # waiting for its natural timeout to expire
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    __slots__ = ("children", "exact", "wildcard")
 
-        # if debug_mode:
-        #     server_socket.settimeout(4.0)
+    def __init__(self):
+        self.children = None
+        """
+        label -> DomainTableNode for the label to the left of this one; None until there is one,
+        since most nodes are leaves.
+        """
 
-        connection_socket = None
-        addr = None
+        self.exact = None
+        """
+        The value for the domain that ends at this label, from a pattern like "unc.edu".
+        """
 
-        try:
+        self.wildcard = None
+        """
+        The value for every domain below this one, from a pattern like "*.unc.edu".
+        """
 
-            DebugMode.print(debug_mode, "about to call .bind() to create the server_socket...")
 
-            # https://docs.python.org/3.12/library/socket.html#socket.socket.bind
-            # This takes one parameter that is a 2-element tuple
-            server_socket.bind(('', server_port))
+class DomainTable:
+    """
+    Maps domain patterns to values. "unc.edu" only matches that domain, "*.unc.edu" matches every
+    domain that ends with ".unc.edu", and "*" matches every domain; the most specific pattern wins.
+    The patterns are kept in a trie of their labels from right to left ("edu", then "unc", ...),
+    so a lookup costs one dictionary lookup per label of the domain, no matter how many patterns
+    there are.
+    """
 
-            DebugMode.print(debug_mode, "called server_socket.bind()")
+    def __init__(self):
+        self.root = DomainTableNode()
+        self.size = 0
 
-            # https://docs.python.org/3.12/library/socket.html#socket.socket.listen
-            # The parameter specifies the number of unaccepted connections that the system will allow
-            # before refusing new connections. This can help prevent multiple sockets and issues.
-            server_socket.listen(1)
+    def add(self, pattern: str, value):
+        """
+        Adds a pattern, or replaces the value of one that is already in the table.
+        """
 
-            DebugMode.print(debug_mode, "called server_socket.listen(1)...")
+        pattern = pattern.strip().casefold()
+        is_wildcard = pattern == "*" or pattern.startswith("*.")
+        labels = [] if pattern == "*" else pattern.removeprefix("*.").split(".")
 
-            # This outer
-            while True:
-                # TODO: What is "addr" for?
-                # .accept() returns a tuple where the first element is a socket object
-                # the second element is a return address
-                # What is the difference between connection_socket and server_socket? It seems that
-                # connection_socket represents an actual socket object when the client connects and is
-                # spawned from the server_socket object.
+        if any(not label or "*" in label for label in labels) or not (labels or is_wildcard):
+            raise ValueError(f"not a domain pattern: '{pattern}'")
 
-                DebugMode.print(debug_mode, "about to create a new connection socket and listen for connections...", DebugMode.INFO)
+        node = self.root
+        for label in reversed(labels):
+            if node.children is None:
+                node.children = {}
 
-                connection_socket, addr = server_socket.accept()
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = DomainTableNode()
+            node = child
 
-                with connection_socket:
+        if (node.wildcard if is_wildcard else node.exact) is None:
+            self.size += 1
 
-                    # if debug_mode:
-                    #     connection_socket.settimeout(4.0)
+        if is_wildcard:
+            node.wildcard = value
+        else:
+            node.exact = value
 
-                    DebugMode.print(debug_mode, f"socket_server.accept() received a new connection. addr: {addr}")
+    def lookup(self, domain: str, default=None):
+        """
+        Returns the value of the most specific pattern that matches domain, or default.
+        """
 
-                    smtp_server.reset()
+        labels = domain.casefold().split(".")
+        node = self.root
+        best = node.wildcard
 
-                    parser = Parser("", debug_mode)
+        for i in range(len(labels) - 1, -1, -1):
+            if node.children is None:
+                break
 
-                    smtp_server.set_parser(parser)
-                    smtp_server.set_socket(connection_socket)
+            node = node.children.get(labels[i])
+            if node is None:
+                break
 
-                    # Send a greeting message to the newly connected client
-                    smtp_server.evaluate_state()
+            if i == 0:
+                if node.exact is not None:
+                    return node.exact
+            elif node.wildcard is not None:
+                # "*.unc.edu" matches "cs.unc.edu" but not "unc.edu" itself
+                best = node.wildcard
 
-                    DebugMode.print(debug_mode, "should have sent an initial message to the client by now...")
+        return default if best is None else best
 
-                    try:
 
-                        # This might be better than while True
-                        while socket_is_connected(connection_socket):
+def load_domain_table(path: Path, parse_value=str) -> DomainTable:
+    """
+    Reads a DomainTable from a file with one "pattern value" pair per line, such as
+    "*.unc.edu reject". Blank lines and lines that start with "#" are skipped. parse_value
+    converts each value (and can raise ValueError).
+    """
 
-                            # https://docs.python.org/3.12/library/socket.html#socket.socket.recv
-                            # The parameter is the maximum amount of data to be received at once
-                            # TODO: A returned empty bytes object indicates that the client has
-                            # disconnected. I think I should watch for that and break.
+    table = DomainTable()
 
-                            bytes_recv = connection_socket.recv(bufsize)
+    with path.open(mode="r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
 
-                            # If 0 bytes are received, that indicates that the client has sent anything yet.
-                            if len(bytes_recv) == 0:
-                                # DebugMode.print(debug_mode, "0 bytes was received from the client. closing the socket.", DebugMode.WARN)
-                                continue
+            fields = line.split()
 
-                            if bytes_recv is None:
-                                DebugMode.print(debug_mode, "0 bytes was received from the client. closing the socket.", DebugMode.WARN)
-                                break
+            try:
+                if len(fields) != 2:
+                    raise ValueError(f"expected 'pattern value': '{line}'")
+                table.add(fields[0], parse_value(fields[1]))
+            except ValueError as e:
+                raise ValueError(f"{path}, line {line_no}: {e}") from e
 
-                            # Reaching this point means we have data from the client
-                            sentence = bytes_recv.decode()
+    return table
 
-                            # 2026-03-22: I think it is possible that the client could send more
-                            # than one line at a time, so we should compensate for that possibility.
-                            # However, it is normal after .split() for Python to create an empty
-                            # string token at the end, so we have to account for that apparently.
-                            # This fix is actually a big deal.
 
-                            lines = sentence.split("\n")
+REJECT_POLICY = "reject"
+"""
+The --domain-table value that makes the server refuse recipients at a domain with a 550 at RCPT
+TO. Any other value (such as "accept", or a next-hop address for Relay.py) accepts them.
+"""
 
-                            DebugMode.print(debug_mode, f"data received: {sentence}", DebugMode.WARN)
-                            DebugMode.print(debug_mode, f"# of lines received: {len(lines)}", DebugMode.WARN)
 
+RECIPIENT_INDEX_MAGIC = b"RCPTIDX1"
 
-                            for i, line in enumerate(lines):
-                                is_last_token = (i == len(lines) - 1)
-                                # Make sure it is:
-                                # The last token
-                                # Is empty
-                                # And the string actually ends with "\n"
-                                # If all three are true, only then can we truly discard it
-                                if is_last_token and line == "" and sentence.endswith("\n"):
-                                    continue
+RECIPIENT_INDEX_HEADER = struct.Struct("<8sQQIQ")
+"""
+magic, number of addresses, Bloom filter size in bits, number of Bloom hashes, number of buckets.
+The Bloom filter comes right after the header, then (buckets + 1) bucket offsets, then the
+addresses. See BuildRecipientIndex.py for how the file is written.
+"""
 
-                                fixed_line = line
-                                if not line.endswith("\n"):
-                                    fixed_line += "\n"
 
-                                DebugMode.print(debug_mode, f"line of sentence: {fixed_line}", DebugMode.WARN)
-                                parser = Parser(fixed_line, debug_mode)
-                                smtp_server.set_parser(parser)
-                                smtp_server.set_socket(connection_socket)
-                                smtp_server.evaluate_state()
+def get_recipient_hashes(address: str) -> tuple:
+    """
+    Returns the two 64-bit hashes of an address that the recipient index uses, both for the Bloom
+    filter (h1 + i * h2) and to pick a bucket (h1). Addresses are casefolded first.
+    """
+
+    h1, h2 = struct.unpack("<QQ", hashlib.blake2b(address.strip().casefold().encode(), digest_size=16).digest())
+    # An even step could cycle through only some of the bits
+    return h1, h2 | 1
+
+
+class RecipientIndex:
+    """
+    Answers whether an address is on the recipient allowlist without reading the whole list into
+    memory. The file is memory-mapped; the Bloom filter at the start answers "no" for almost every
+    unknown address after a few bit checks, and only the addresses the filter lets through are
+    looked up in their bucket of the exact list to rule out false positives. The operating system
+    keeps the parts of the file that are used often in memory.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+        with path.open("rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < RECIPIENT_INDEX_HEADER.size or self.map[:len(RECIPIENT_INDEX_MAGIC)] != RECIPIENT_INDEX_MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a recipient index")
+
+        _, self.count, self.bloom_bits, self.bloom_hashes, self.buckets = RECIPIENT_INDEX_HEADER.unpack_from(self.map, 0)
+
+        self.bloom_start = RECIPIENT_INDEX_HEADER.size
+        self.offsets_start = self.bloom_start + (self.bloom_bits + 7) // 8
+        self.data_start = self.offsets_start + 8 * (self.buckets + 1)
+
+        if len(self.map) < self.data_start:
+            self.map.close()
+            raise ValueError(f"{path} is cut short")
+
+        self.lookups = 0
+        self.bloom_negatives = 0
+        self.false_positives = 0
+
+    def contains(self, address: str) -> bool:
+        """
+        Returns True if address is on the list.
+        """
+
+        self.lookups += 1
+        h1, h2 = get_recipient_hashes(address)
+
+        for i in range(self.bloom_hashes):
+            bit = (h1 + i * h2) % self.bloom_bits
+            if not self.map[self.bloom_start + (bit >> 3)] & (1 << (bit & 7)):
+                self.bloom_negatives += 1
+                return False
+
+        # Each bucket is its addresses, one per line
+        start, end = struct.unpack_from("<QQ", self.map, self.offsets_start + 8 * (h1 % self.buckets))
+        bucket = self.map[self.data_start + start:self.data_start + end]
+
+        if b"\n" + address.strip().casefold().encode() + b"\n" in b"\n" + bucket:
+            return True
+
+        self.false_positives += 1
+        return False
+
+    def to_dict(self) -> dict:
+        """
+        Returns the size of the list and how lookups have been answered.
+        """
+
+        return {
+            "addresses": self.count,
+            "lookups": self.lookups,
+            "bloom_negatives": self.bloom_negatives,
+            "false_positives": self.false_positives,
+        }
+
+
+def install_reload_signal(smtp_server, domain_table_path: Path|None, recipient_index_path: Path|None, debug_mode: bool = False):
+    """
+    SIGHUP reads the domain table and the recipient index again in a background thread and then
+    puts each new one in place with one assignment, so a session never sees one that is only
+    partly loaded. If a file cannot be read, the old one is kept. The old recipient index is not
+    closed, since a session may still be using it; it is unmapped once nothing refers to it.
+    """
+
+    def reload():
+        start = time.perf_counter()
+
+        if domain_table_path:
+            try:
+                smtp_server.domain_table = load_domain_table(domain_table_path)
+            except (OSError, ValueError) as e:
+                print(f"Could not reload the domain table; keeping the old one: {e}")
+
+        if recipient_index_path:
+            try:
+                smtp_server.recipient_index = RecipientIndex(recipient_index_path)
+            except (OSError, ValueError) as e:
+                print(f"Could not reload the recipient index; keeping the old one: {e}")
+
+        DebugMode.print(debug_mode, f"reloaded in {time.perf_counter() - start:.3f}s", DebugMode.SUCCESS)
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=reload, name="reload", daemon=True).start())
+
+
+FORWARD_FORMATS = ["text", "v2"]
+"""
+Formats a forward file can be written in (--forward-format). A file that already exists keeps the
+format it was started with.
+"""
+
+FORWARD_V2_MAGIC = b"SMTPFWD2"
+"""
+The first bytes of a forward file in the v2 format. A file that does not start with them is in the
+text format.
+"""
+
+FORWARD_V2_RECORD = struct.Struct("<IdHH32s")
+"""
+Header of each message in a v2 forward file: length of the rest of the record, when the message
+was accepted (seconds since the epoch), flags, number of recipients and the SHA-256 of the message
+text. The rest of the record is the sender and then each recipient on a line of its own, followed
+by the message text exactly as the text format has it. A reader that does not need a message skips
+it with one seek of the length.
+"""
+
+FORWARD_FLAG_DELETED = 1
+"""
+Flag of a message that has been deleted but is still in the file. Readers skip it.
+"""
+
+FORWARD_FLAG_ZLIB = 2
+FORWARD_FLAG_LZMA = 4
+"""
+Flags of a message whose text is compressed with zlib or lzma. Each message is compressed on its
+own, so appending one stays cheap and any message can still be read without the others.
+"""
+
+FORWARD_COMPRESSORS = {
+    "zlib": (FORWARD_FLAG_ZLIB, lambda data, level: zlib.compress(data, level)),
+    "lzma": (FORWARD_FLAG_LZMA, lambda data, level: lzma.compress(data, preset=level)),
+}
+"""
+--forward-compression name -> (flag, function(data, level) that compresses data).
+"""
+
+DEFAULT_COMPRESSION_LEVELS = {"zlib": 6, "lzma": 1}
+
+
+def encode_forward_record(sender: str, recipients: list, text: str, timestamp: float, flags: int = 0,
+                          compression: str = "", level: int = None, body_hash: bytes = None) -> bytes:
+    """
+    Returns one message as a record of a v2 forward file, with its text compressed if compression
+    names one of FORWARD_COMPRESSORS and that makes it smaller. The hash is of the text itself;
+    body_hash can be given if it is already known.
+    """
+
+    text_bytes = text.encode()
+    if body_hash is None:
+        body_hash = hashlib.sha256(text_bytes).digest()
+
+    if compression:
+        flag, compress = FORWARD_COMPRESSORS[compression]
+        compressed = compress(text_bytes, DEFAULT_COMPRESSION_LEVELS[compression] if level is None else level)
+        if len(compressed) < len(text_bytes):
+            text_bytes = compressed
+            flags |= flag
+
+    addresses = "".join(f"{address}\n" for address in [sender] + recipients).encode()
+    header = FORWARD_V2_RECORD.pack(len(addresses) + len(text_bytes), timestamp, flags, len(recipients), body_hash)
+
+    return header + addresses + text_bytes
+
+
+def get_forward_file_format(path: Path) -> str:
+    """
+    Returns "v2" or "text" for an existing forward file, based on its first bytes.
+    """
+
+    with path.open("rb") as f:
+        return "v2" if f.read(len(FORWARD_V2_MAGIC)) == FORWARD_V2_MAGIC else "text"
+
+
+SEGMENTS_FOLDER_NAME = ".segments"
+"""
+Folder in "forward" that the rotated segments of each forward file are moved to, one folder per
+domain: forward/.segments/<domain>/<domain>.000001 and so on, oldest first.
+"""
+
+SEGMENT_MANIFEST_NAME = ".manifest"
+"""
+JSON file in each segment folder that lists its segments in order. A segment file that is not in
+the manifest is not part of the forward file yet (or any more).
+"""
+
+DEFAULT_SEGMENT_BYTES = 64 << 20
+"""
+Size that small segments are merged up to when only --rotate-seconds is given.
+"""
+
+RELAY_FOLDER_NAME = ".relay"
+"""
+Where Relay.py keeps its own files inside the forward folder. Forward files are named after
+domains, which cannot start with ".", so this never collides with one.
+"""
+
+RELAY_OFFSETS_NAME = "offsets.json"
+"""
+File in the relay folder with how far Relay.py has relayed each domain: {domain: {"inode": ...,
+"offset": ...}}, the inode of the forward file or segment it is in and the byte offset in it.
+The compactor leaves that segment and the ones after it alone, since the relay still has to read
+them and an offset is only good for the file it was taken in.
+"""
+
+
+def count_forward_segment(path: Path) -> tuple:
+    """
+    Returns (messages, deleted messages, bytes of deleted messages) of a forward file. Only v2
+    files can have deleted messages.
+    """
+
+    messages = deleted = deleted_bytes = 0
+
+    with path.open("rb") as f:
+        if f.seek(0, 2) == 0:
+            return 0, 0, 0
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(FORWARD_V2_MAGIC)] == FORWARD_V2_MAGIC:
+                position = len(FORWARD_V2_MAGIC)
+                while position + FORWARD_V2_RECORD.size <= len(data):
+                    length, _, flags, _, _ = FORWARD_V2_RECORD.unpack_from(data, position)
+                    record_end = position + FORWARD_V2_RECORD.size + length
+                    if flags & FORWARD_FLAG_DELETED:
+                        deleted += 1
+                        deleted_bytes += record_end - position
+                    else:
+                        messages += 1
+                    position = record_end
+            else:
+                messages = int(data[:len(b"From: ")] == b"From: ")
+                position = data.find(b"\nFrom: ")
+                while position != -1:
+                    messages += 1
+                    position = data.find(b"\nFrom: ", position + 1)
+
+    return messages, deleted, deleted_bytes
+
+
+def merge_forward_segments(paths: list, output_path: Path, file_format: str) -> tuple:
+    """
+    Writes the messages of the segments in paths, in order, to output_path, leaving out deleted
+    messages, and returns (messages kept, messages dropped). All of the segments have to be in
+    file_format.
+    """
+
+    kept = dropped = 0
+
+    with output_path.open("wb") as output:
+        if file_format == "v2":
+            output.write(FORWARD_V2_MAGIC)
+
+        for path in paths:
+            with path.open("rb") as f:
+                if file_format != "v2":
+                    shutil.copyfileobj(f, output, 1 << 20)
+                    continue
+
+                if f.seek(0, 2) <= len(FORWARD_V2_MAGIC):
+                    continue
+
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    # Runs of records that are not deleted are copied with one write each
+                    position = run_start = len(FORWARD_V2_MAGIC)
+                    while position + FORWARD_V2_RECORD.size <= len(data):
+                        length, _, flags, _, _ = FORWARD_V2_RECORD.unpack_from(data, position)
+                        record_end = position + FORWARD_V2_RECORD.size + length
+                        if flags & FORWARD_FLAG_DELETED:
+                            output.write(data[run_start:position])
+                            run_start = record_end
+                            dropped += 1
+                        else:
+                            kept += 1
+                        position = record_end
+                    output.write(data[run_start:position])
+
+    if file_format != "v2":
+        kept = count_forward_segment(output_path)[0]
+
+    return kept, dropped
+
+
+class ForwardSegments:
+    """
+    Rotation of the forward files into segments, and a compactor that merges small segments and
+    drops deleted messages in the background.
+
+    Once forward/<domain> is --rotate-bytes long or --rotate-seconds old, the writer renames it to
+    the next segment in forward/.segments/<domain>/ and adds it to the manifest; the next message
+    starts a new forward/<domain>. A rename is atomic and does not copy anything, so deliveries
+    only wait for it and the manifest write. Segments are never written to again except by the
+    compactor, which writes a merged segment under a new name, swaps it into the manifest and
+    only then removes the segments it replaced.
+
+    Two lock files keep everything that changes a manifest apart, including CompactForwardFiles.py
+    in another process: .manifest.lock is held only while a manifest is read and written again,
+    and .compact.lock for a whole compaction, so a rotation never waits for a merge.
+    """
+
+    def __init__(self, forward_folder: Path, rotate_bytes: int = 0, rotate_seconds: float = 0.0, debug_mode: bool = False):
+        self.forward_folder = forward_folder
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.debug_mode = debug_mode
+
+        self.target_bytes = rotate_bytes or DEFAULT_SEGMENT_BYTES
+        """
+        Segments are merged as long as the merged segment stays under this size.
+        """
+
+        self.active_since = {}
+        """
+        Domain -> when this process first wrote to its current forward file, for --rotate-seconds.
+        """
+
+        self.thread = None
+        self.stopping = threading.Event()
+
+        self.rotations = 0
+        self.compactions = 0
+        self.segments_merged = 0
+        self.messages_dropped = 0
+        self.bytes_reclaimed = 0
+
+    def get_segment_folder(self, domain: str) -> Path:
+        """
+        Returns the folder the segments of domain are kept in.
+        """
+
+        return self.forward_folder / SEGMENTS_FOLDER_NAME / domain
+
+    def read_manifest(self, folder: Path) -> dict:
+        """
+        Returns the manifest of a segment folder, or an empty one if there is none yet.
+        """
+
+        try:
+            with (folder / SEGMENT_MANIFEST_NAME).open("r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"domain": folder.name, "next_sequence": 1, "segments": []}
+
+    def write_manifest(self, folder: Path, manifest: dict):
+        """
+        Replaces the manifest of a segment folder in one step, so a reader sees the old one or the
+        new one and never part of either.
+        """
+
+        temporary_path = folder / f"{SEGMENT_MANIFEST_NAME}.tmp"
+        with temporary_path.open("w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+            f.write("\n")
+        os.replace(temporary_path, folder / SEGMENT_MANIFEST_NAME)
+
+    def lock(self, folder: Path, name: str, blocking: bool = True):
+        """
+        Returns the open lock file folder/name once it is locked, or None if blocking is False and
+        someone else has it. Closing the file unlocks it.
+        """
+
+        lock_file = (folder / name).open("a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def after_write(self, domain: str, size: int):
+        """
+        Called by the writer after each message it appends to forward/<domain>, which is now size
+        bytes long. Rotates the file if it is big or old enough.
+        """
+
+        now = time.time()
+        active_since = self.active_since.setdefault(domain, now)
+
+        if (self.rotate_bytes and size >= self.rotate_bytes) or \
+           (self.rotate_seconds and now - active_since >= self.rotate_seconds):
+            self.rotate(domain)
+
+    def rotate(self, domain: str) -> Path|None:
+        """
+        Moves forward/<domain> to the end of its segments and returns the path of the new segment,
+        or None if there was no file to move.
+        """
+
+        forward_path = self.forward_folder / domain
+        folder = self.get_segment_folder(domain)
+        folder.mkdir(parents=True, exist_ok=True)
+
+        with self.lock(folder, ".manifest.lock"):
+            try:
+                size = forward_path.stat().st_size
+            except FileNotFoundError:
+                return None
+
+            manifest = self.read_manifest(folder)
+            sequence = manifest["next_sequence"]
+            segment_path = folder / f"{domain}.{sequence:06d}"
+
+            os.rename(forward_path, segment_path)
+
+            manifest["next_sequence"] = sequence + 1
+            manifest["segments"].append({
+                "name": segment_path.name,
+                "first": sequence,
+                "last": sequence,
+                "format": get_forward_file_format(segment_path) if size else "text",
+                "bytes": size,
+                "sealed": time.time(),
+                # Filled in by the compactor, which counts the messages in the background
+                "messages": None,
+                "deleted": None,
+                "mtime_ns": None,
+            })
+            self.write_manifest(folder, manifest)
+
+        self.active_since.pop(domain, None)
+        self.rotations += 1
+
+        DebugMode.print(self.debug_mode, f"rotated {forward_path} ({size} bytes) to {segment_path}", DebugMode.INFO)
+        return segment_path
+
+    def get_relayed_segments(self, domain: str, inodes: list) -> int:
+        """
+        Returns how many of the segments of domain, whose inodes are given oldest first, Relay.py
+        is done with. That is all of them if there is no relay, or if it has got to the forward
+        file itself, and none if it has not relayed anything of domain yet.
+        """
+
+        try:
+            with (self.forward_folder / RELAY_FOLDER_NAME / RELAY_OFFSETS_NAME).open("r", encoding="utf-8") as f:
+                position = json.load(f).get(domain)
+        except FileNotFoundError:
+            return len(inodes)
+
+        if position is None:
+            return 0
+
+        # An offset from before the relay knew about segments is an offset in the forward file
+        inode = position.get("inode") if isinstance(position, dict) else None
+        return inodes.index(inode) if inode in inodes else len(inodes)
+
+    def plan_merges(self, segments: list) -> list:
+        """
+        Returns the runs of segments to merge: consecutive segments in the same format that fit in
+        target_bytes together (not counting deleted messages), and any segment with deleted
+        messages on its own.
+        """
+
+        runs = []
+        run = []
+        run_bytes = 0
+
+        for segment in segments:
+            live_bytes = segment["bytes"] - segment.get("deleted_bytes", 0)
+            if run and (segment["format"] != run[0]["format"] or run_bytes + live_bytes > self.target_bytes):
+                runs.append(run)
+                run, run_bytes = [], 0
+            run.append(segment)
+            run_bytes += live_bytes
+        if run:
+            runs.append(run)
+
+        return [run for run in runs if len(run) > 1 or run[0]["deleted"]]
+
+    def compact(self, domain: str) -> int:
+        """
+        Counts the messages of new or changed segments of domain, then merges what plan_merges()
+        says to. Returns the number of merged segments written, or -1 if another compactor is
+        already working on domain.
+        """
+
+        folder = self.get_segment_folder(domain)
+        if not folder.is_dir():
+            return 0
+
+        compact_lock = self.lock(folder, ".compact.lock", blocking=False)
+        if compact_lock is None:
+            return -1
+
+        with compact_lock:
+            with self.lock(folder, ".manifest.lock"):
+                manifest = self.read_manifest(folder)
+                self.remove_unlisted_segments(folder, manifest)
+
+            # Segments were sealed without counting their messages, and a segment that changed
+            # since it was counted had messages marked deleted; both are counted again.
+            counts = {}
+            inodes = []
+            for segment in manifest["segments"]:
+                stat = (folder / segment["name"]).stat()
+                mtime_ns = stat.st_mtime_ns
+                inodes.append(stat.st_ino)
+                if segment["mtime_ns"] != mtime_ns:
+                    messages, deleted, deleted_bytes = count_forward_segment(folder / segment["name"])
+                    counts[segment["name"]] = {"messages": messages, "deleted": deleted, "deleted_bytes": deleted_bytes, "mtime_ns": mtime_ns}
+                    segment.update(counts[segment["name"]])
+
+            # The segment Relay.py is reading and the ones after it keep their files and offsets
+            relayed = self.get_relayed_segments(domain, inodes)
+
+            merged = {}
+            for run in self.plan_merges(manifest["segments"][:relayed]):
+                first, last = run[0]["first"], run[-1]["last"]
+                # A segment on its own is rewritten under its own name; merged segments get a new one
+                name = f"{domain}.{first:06d}-{last:06d}" if len(run) > 1 else run[0]["name"]
+                output_path = folder / name
+                temporary_path = folder / f".{name}.tmp"
+
+                kept, dropped = merge_forward_segments([folder / segment["name"] for segment in run], temporary_path, run[0]["format"])
+                os.replace(temporary_path, output_path)
+
+                merged[run[0]["name"]] = (run, {
+                    "name": name,
+                    "first": first,
+                    "last": last,
+                    "format": run[0]["format"],
+                    "bytes": output_path.stat().st_size,
+                    "sealed": run[-1]["sealed"],
+                    "messages": kept,
+                    "deleted": 0,
+                    "deleted_bytes": 0,
+                    "mtime_ns": output_path.stat().st_mtime_ns,
+                })
+                self.segments_merged += len(run)
+                self.messages_dropped += dropped
+
+            # The writer may have added segments since the manifest was read, so the changes are
+            # made to the manifest as it is now
+            with self.lock(folder, ".manifest.lock"):
+                manifest = self.read_manifest(folder)
+                replaced = set()
+                segments = []
+                for segment in manifest["segments"]:
+                    if segment["name"] in replaced:
+                        continue
+                    if segment["name"] in merged:
+                        run, merged_segment = merged[segment["name"]]
+                        replaced.update(old["name"] for old in run)
+                        segments.append(merged_segment)
+                        self.bytes_reclaimed += sum(old["bytes"] for old in run) - merged_segment["bytes"]
+                    else:
+                        segments.append({**segment, **counts.get(segment["name"], {})})
+                manifest["segments"] = segments
+                self.write_manifest(folder, manifest)
+
+            for run, merged_segment in merged.values():
+                for old in run:
+                    if old["name"] != merged_segment["name"]:
+                        (folder / old["name"]).unlink(missing_ok=True)
+
+        if merged:
+            self.compactions += 1
+            DebugMode.print(self.debug_mode, f"compacted {domain}: {sum(len(run) for run, _ in merged.values())} segment(s) into {len(merged)}", DebugMode.INFO)
+
+        return len(merged)
+
+    def remove_unlisted_segments(self, folder: Path, manifest: dict):
+        """
+        Removes segment files that are not in the manifest: merged segments and temporary files
+        left behind by a compactor that stopped before it updated the manifest.
+        """
+
+        listed = {segment["name"] for segment in manifest["segments"]}
+        for path in folder.iterdir():
+            if path.name.startswith(".") and path.name.endswith(".tmp") and path.name != f"{SEGMENT_MANIFEST_NAME}.tmp":
+                path.unlink(missing_ok=True)
+            elif path.is_file() and not path.name.startswith(".") and path.name not in listed:
+                DebugMode.print(self.debug_mode, f"removing {path}, which is not in the manifest", DebugMode.WARN)
+                path.unlink(missing_ok=True)
+
+    def compact_all(self) -> int:
+        """
+        Compacts the segments of every domain and returns the number of merged segments written.
+        """
+
+        segments_folder = self.forward_folder / SEGMENTS_FOLDER_NAME
+        if not segments_folder.is_dir():
+            return 0
+
+        return sum(max(0, self.compact(folder.name)) for folder in sorted(segments_folder.iterdir()) if folder.is_dir())
+
+    def start(self, interval: float):
+        """
+        Runs compact_all() every interval seconds on a background thread.
+        """
+
+        def run():
+            while not self.stopping.wait(interval):
+                try:
+                    self.compact_all()
+                except (OSError, ValueError) as e:
+                    DebugMode.print(self.debug_mode, f"compaction failed: {e}", DebugMode.ERROR)
+
+        self.thread = threading.Thread(target=run, name="compactor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread and waits for it to finish the pass it is on, if any, so a
+        merge is never cut off between writing the manifest and removing the old segments.
+        """
+
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def to_dict(self) -> dict:
+        """
+        Returns the settings and counters for /stats.
+        """
+
+        return {
+            "rotate_bytes": self.rotate_bytes,
+            "rotate_seconds": self.rotate_seconds,
+            "rotations": self.rotations,
+            "compactions": self.compactions,
+            "segments_merged": self.segments_merged,
+            "messages_dropped": self.messages_dropped,
+            "bytes_reclaimed": self.bytes_reclaimed,
+        }
+
+
+MAIL_INDEX_FOLDER_NAME = ".mailindex"
+"""
+Folder in "forward" with the inverted index of delivered mail (--mail-index): numbered segment
+files and manifest.json, which lists the segments that make up the index, oldest first.
+"""
+
+MAIL_INDEX_MAGIC = b"MAILIDX1"
+MAIL_INDEX_HEADER = struct.Struct("<8sQQQQQQQ")
+"""
+Header of a segment of the mail index: magic, first message number, number of messages, number of
+terms, and where the term text, the term table, the message text and the message table start.
+
+The postings (the message numbers of each term, as little-endian 32-bit integers in increasing
+order) come right after the header. The term table is sorted by term, so a term is found with a
+binary search of the memory-mapped file, and the message table is in message number order, so
+message N of a segment is entry N - first message number. The messages of a segment are
+consecutive, since a merge only ever combines neighbouring segments.
+"""
+
+MAIL_INDEX_TERM = struct.Struct("<QQI")
+"""
+Entry of the term table: offset of the term in the term text, offset of its postings in the file
+and how many there are. A term ends where the next one starts.
+"""
+
+MAIL_INDEX_MESSAGE = struct.Struct("<dQ")
+"""
+Entry of the message table: when the message was accepted and the offset of its description (the
+sender, the recipients, the subject and the SHA-256 of the text, one per line) in the message
+text.
+
+The description ends with a line for each forward file the message was written to, as
+"file:inode:offset": the file (its name in the forward folder, or its full path if it is
+somewhere else), its inode, which a rotation into a segment keeps, and the offset of the message
+(the From: line, or the v2 record) in it. Messages indexed before there were locations have none.
+"""
+
+MAIL_INDEX_WORD = re.compile(r"\w{2,32}")
+"""
+A keyword: 2 to 32 letters, digits or underscores, after casefolding.
+"""
+
+
+def get_mail_terms(sender: str, recipients: list, text: str) -> set:
+    """
+    Returns the terms a message is indexed under: "from:<sender>", "to:<recipient>" for each
+    recipient, "subject:<word>" for each word of its Subject: line, and every word of its text
+    (which includes the headers).
+    """
+
+    terms = set(MAIL_INDEX_WORD.findall(text.casefold()))
+    terms.add(f"from:{sender.casefold()}")
+    terms.update(f"to:{recipient.casefold()}" for recipient in recipients)
+    terms.update(f"subject:{word}" for word in MAIL_INDEX_WORD.findall(get_mail_subject(text).casefold()))
+    return terms
+
+
+def get_mail_subject(text: str) -> str:
+    """
+    Returns the Subject: header of a message in the forward file format, or "" if it has none.
+    """
+
+    for line in text.split("\n", 32):
+        if not line:
+            break
+        if line.startswith("Subject:"):
+            return line[len("Subject:"):].strip()
+
+    return ""
+
+
+def write_mail_index_segment(path: Path, first_number: int, terms, messages) -> tuple:
+    """
+    Writes a segment of the mail index to path and returns (messages, terms) written. terms yields
+    (term as bytes, postings as array("I")) in term order; messages yields (timestamp,
+    description as bytes) in message number order, starting at first_number. Both are written as
+    they come, so a merge never has to hold a whole segment in memory.
+    """
+
+    term_offsets = array("Q")
+    postings_offsets = array("Q")
+    postings_counts = array("I")
+    term_text = bytearray()
+
+    timestamps = array("d")
+    description_offsets = array("Q")
+
+    with path.open("wb") as f:
+        f.write(bytes(MAIL_INDEX_HEADER.size))
+
+        for term, postings in terms:
+            term_offsets.append(len(term_text))
+            postings_offsets.append(f.tell())
+            postings_counts.append(len(postings))
+            term_text += term
+            if sys.byteorder != "little":
+                postings = array("I", postings)
+                postings.byteswap()
+            f.write(postings)
+
+        term_text_offset = f.tell()
+        f.write(term_text)
+        terms_offset = f.tell()
+        for entry in zip(term_offsets, postings_offsets, postings_counts):
+            f.write(MAIL_INDEX_TERM.pack(*entry))
+
+        message_text_offset = f.tell()
+        for timestamp, description in messages:
+            timestamps.append(timestamp)
+            description_offsets.append(f.tell() - message_text_offset)
+            f.write(description)
+
+        messages_offset = f.tell()
+        for entry in zip(timestamps, description_offsets):
+            f.write(MAIL_INDEX_MESSAGE.pack(*entry))
+
+        f.seek(0)
+        f.write(MAIL_INDEX_HEADER.pack(MAIL_INDEX_MAGIC, first_number, len(timestamps), len(term_offsets),
+                                       term_text_offset, terms_offset, message_text_offset, messages_offset))
+
+    return len(timestamps), len(term_offsets)
+
+
+class MailIndexSegment:
+    """
+    One memory-mapped segment of the mail index (see MAIL_INDEX_HEADER).
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+        with path.open("rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.first_number, self.message_count, self.term_count, self.term_text_offset,
+         self.terms_offset, self.message_text_offset, self.messages_offset) = MAIL_INDEX_HEADER.unpack_from(self.data)
+
+        if magic != MAIL_INDEX_MAGIC:
+            self.data.close()
+            raise ValueError(f"{path} is not a segment of the mail index")
+
+    def get_term(self, number: int) -> tuple:
+        """
+        Returns (term as bytes, postings offset, postings count) of entry number of the term table.
+        """
+
+        text_offset, postings_offset, count = MAIL_INDEX_TERM.unpack_from(self.data, self.terms_offset + number * MAIL_INDEX_TERM.size)
+        if number + 1 < self.term_count:
+            text_end = MAIL_INDEX_TERM.unpack_from(self.data, self.terms_offset + (number + 1) * MAIL_INDEX_TERM.size)[0]
+        else:
+            text_end = self.terms_offset - self.term_text_offset
+
+        return self.data[self.term_text_offset + text_offset:self.term_text_offset + text_end], postings_offset, count
+
+    def get_postings(self, offset: int, count: int) -> array:
+        """
+        Returns the count message numbers at offset.
+        """
+
+        postings = array("I", self.data[offset:offset + 4 * count])
+        if sys.byteorder != "little":
+            postings.byteswap()
+        return postings
+
+    def find(self, term: str) -> array:
+        """
+        Returns the numbers of the messages in this segment that have term, in increasing order.
+        """
+
+        term = term.encode()
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_term(middle)[0] < term:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.term_count:
+            found, offset, count = self.get_term(low)
+            if found == term:
+                return self.get_postings(offset, count)
+
+        return array("I")
+
+    def terms(self):
+        """
+        Yields (term as bytes, postings) for every term, in term order.
+        """
+
+        for number in range(self.term_count):
+            term, offset, count = self.get_term(number)
+            yield term, self.get_postings(offset, count)
+
+    def get_message(self, number: int) -> tuple:
+        """
+        Returns (timestamp, description as bytes) of message number (a message number of the
+        whole index, not of this segment).
+        """
+
+        entry = number - self.first_number
+        timestamp, start = MAIL_INDEX_MESSAGE.unpack_from(self.data, self.messages_offset + entry * MAIL_INDEX_MESSAGE.size)
+        if entry + 1 < self.message_count:
+            end = MAIL_INDEX_MESSAGE.unpack_from(self.data, self.messages_offset + (entry + 1) * MAIL_INDEX_MESSAGE.size)[1]
+        else:
+            end = self.messages_offset - self.message_text_offset
+
+        return timestamp, self.data[self.message_text_offset + start:self.message_text_offset + end]
+
+    def messages(self):
+        """
+        Yields (timestamp, description as bytes) of every message, in order.
+        """
+
+        for number in range(self.first_number, self.first_number + self.message_count):
+            yield self.get_message(number)
+
+    def close(self):
+        """
+        Unmaps the segment.
+        """
+
+        self.data.close()
+
+
+def merge_mail_index_segments(segments: list, path: Path) -> tuple:
+    """
+    Writes one segment with everything in segments, which have to be neighbours in message number
+    order, to path. Returns (messages, terms).
+    """
+
+    def merged_terms():
+        # The terms of every segment are already sorted, so they only have to be merged, and the
+        # postings of a term are put together in segment order, which is message number order
+        current, postings = None, array("I")
+        for term, _, segment_postings in heapq.merge(*[((term, number, postings) for term, postings in segment.terms())
+                                                       for number, segment in enumerate(segments)], key=lambda entry: entry[:2]):
+            if term != current:
+                if current is not None:
+                    yield current, postings
+                current, postings = term, array("I")
+            postings.extend(segment_postings)
+        if current is not None:
+            yield current, postings
+
+    return write_mail_index_segment(path, segments[0].first_number, merged_terms(),
+                                    (message for segment in segments for message in segment.messages()))
+
+
+class MailIndexer:
+    """
+    Keeps the inverted index of delivered mail in forward/.mailindex up to date (--mail-index).
+
+    The server hands each message it has written to submit(), which only puts it on a queue; a
+    background thread takes messages off the queue, finds their terms and keeps the postings in
+    memory until flush_messages have been collected (or the queue has been empty for
+    flush_seconds), then writes them as a new segment. Whenever the newest merge_factor segments
+    are at the same level, they are merged into one segment of the next level, so there are only
+    a few segments for each power of merge_factor and every message is rewritten a logarithmic
+    number of times.
+
+    Each change to the index is a new file and a new manifest.json that replaces the old one in
+    one step, so MailIndex.py can search it while it is being written.
+    """
+
+    def __init__(self, folder: Path, flush_messages: int = 10_000, flush_seconds: float = 5.0, merge_factor: int = 8,
+                 queue_size: int = 100_000, debug_mode: bool = False):
+        self.folder = folder
+        self.flush_messages = flush_messages
+        self.flush_seconds = flush_seconds
+        self.merge_factor = merge_factor
+        self.debug_mode = debug_mode
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+        # Only one process can write to an index
+        self.lock_file = (folder / ".lock").open("a")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            raise ValueError(f"another process is already writing to the mail index in {folder}")
+
+        self.manifest = read_mail_index_manifest(folder)
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        """
+        Messages waiting to be indexed. When it is full, a message is left out of the index
+        rather than making the delivery wait.
+        """
+
+        self.postings = {}
+        self.pending = []
+        """
+        The postings (term -> array of message numbers) and (timestamp, description) of the
+        messages indexed since the last flush.
+        """
+
+        self.thread = None
+
+        self.submitted = 0
+        self.dropped = 0
+        self.indexed = 0
+        self.flushes = 0
+        self.merges = 0
+
+    def submit(self, timestamp: float, sender: str, recipients: list, text: str, body_hash: bytes, locations: list = ()):
+        """
+        Queues a message to be indexed. Called on the delivery path, so it never waits.
+        """
+
+        try:
+            self.queue.put_nowait((timestamp, sender, list(recipients), text, body_hash, list(locations)))
+            self.submitted += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def add(self, timestamp: float, sender: str, recipients: list, text: str, body_hash: bytes, locations: list = ()):
+        """
+        Adds a message to the postings in memory, flushing them once there are enough. locations
+        are where it was written, as described at MAIL_INDEX_MESSAGE.
+        """
+
+        number = self.manifest["next_message"] + len(self.pending)
+
+        for term in get_mail_terms(sender, recipients, text):
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array("I")
+            postings.append(number)
+
+        description = "\n".join([sender, ",".join(recipients), get_mail_subject(text), body_hash.hex(), *locations]) + "\n"
+        self.pending.append((timestamp, description.encode()))
+        self.indexed += 1
+
+        if len(self.pending) >= self.flush_messages:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the messages indexed since the last flush as a new segment, then merges segments if
+        there are enough at the same level.
+        """
+
+        if not self.pending:
+            return
+
+        name = f"segment{self.manifest['next_segment']:08d}"
+        temporary_path = self.folder / f".{name}.tmp"
+        terms = ((term.encode(), self.postings[term]) for term in sorted(self.postings, key=str.encode))
+        write_mail_index_segment(temporary_path, self.manifest["next_message"], terms, self.pending)
+        os.replace(temporary_path, self.folder / name)
+
+        self.manifest["segments"].append({"name": name, "first": self.manifest["next_message"], "messages": len(self.pending), "level": 0})
+        self.manifest["next_message"] += len(self.pending)
+        self.manifest["next_segment"] += 1
+        write_mail_index_manifest(self.folder, self.manifest)
+
+        self.postings = {}
+        self.pending = []
+        self.flushes += 1
+
+        while self.merge():
+            pass
+
+    def merge(self) -> bool:
+        """
+        Merges the newest merge_factor segments if they are all at the same level, and returns
+        whether it did.
+        """
+
+        newest = self.manifest["segments"][-self.merge_factor:]
+        if len(newest) < self.merge_factor or len({entry["level"] for entry in newest}) != 1:
+            return False
+
+        start = time.perf_counter()
+        name = f"segment{self.manifest['next_segment']:08d}"
+        temporary_path = self.folder / f".{name}.tmp"
+
+        segments = [MailIndexSegment(self.folder / entry["name"]) for entry in newest]
+        try:
+            message_count, _ = merge_mail_index_segments(segments, temporary_path)
+        finally:
+            for segment in segments:
+                segment.close()
+        os.replace(temporary_path, self.folder / name)
+
+        self.manifest["segments"][-self.merge_factor:] = [{"name": name, "first": newest[0]["first"], "messages": message_count,
+                                                            "level": newest[0]["level"] + 1}]
+        self.manifest["next_segment"] += 1
+        write_mail_index_manifest(self.folder, self.manifest)
+
+        # Only removed once the manifest no longer has them; a search that already opened them
+        # still has them mapped
+        for entry in newest:
+            (self.folder / entry["name"]).unlink(missing_ok=True)
+
+        self.merges += 1
+        DebugMode.print(self.debug_mode, f"merged {len(newest)} mail index segments ({message_count} messages) in {time.perf_counter() - start:.2f}s", DebugMode.INFO)
+        return True
+
+    def run(self):
+        """
+        Indexes queued messages until stop() is called.
+        """
+
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_seconds)
+            except queue.Empty:
+                self.flush()
+                continue
+
+            if item is None:
+                self.flush()
+                return
+
+            try:
+                self.add(*item)
+            except (OSError, ValueError) as e:
+                DebugMode.print(self.debug_mode, f"could not index a message: {e}", DebugMode.ERROR)
+
+    def start(self):
+        """
+        Starts indexing on a background thread.
+        """
+
+        self.thread = threading.Thread(target=self.run, name="mail-indexer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Indexes what is left on the queue, writes it out and waits for the thread to finish.
+        """
+
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        else:
+            self.flush()
+
+        self.lock_file.close()
+
+    def to_dict(self) -> dict:
+        """
+        Returns the counters for /stats.
+        """
+
+        return {
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "queued": self.queue.qsize(),
+            "indexed": self.indexed,
+            "flushes": self.flushes,
+            "merges": self.merges,
+            "segments": len(self.manifest["segments"]),
+        }
+
+
+def read_mail_index_manifest(folder: Path) -> dict:
+    """
+    Returns the manifest of the mail index in folder, or an empty one if there is no index yet.
+    """
+
+    try:
+        with (folder / "manifest.json").open("r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"next_message": 0, "next_segment": 1, "segments": []}
+
+
+def write_mail_index_manifest(folder: Path, manifest: dict):
+    """
+    Replaces the manifest of the mail index in folder in one step.
+    """
+
+    temporary_path = folder / "manifest.json.tmp"
+    with temporary_path.open("w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    os.replace(temporary_path, folder / "manifest.json")
+
+
+class DuplicateCache:
+    """
+    The messages accepted in the last few minutes, so a message that a client sends again (because
+    it did not see the 250 the first time, for example) is not written to the forward files twice.
+    A message is the same if it has the same sender, the same recipients in any order and the same
+    SHA-256 of its text.
+
+    The keys are kept in an OrderedDict in least recently used order, with the time each message
+    was first accepted. Once there are max_entries keys, the least recently used one is dropped,
+    and a key is forgotten ttl_seconds after its message was first accepted, however often it is
+    seen again.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def get_key(sender: str, recipients: list, body_hash: bytes) -> tuple:
+        """
+        Returns the key of a message. Addresses are compared without case.
+        """
+
+        return sender.casefold(), frozenset(address.casefold() for address in recipients), body_hash
+
+    def contains(self, key: tuple, now: float = None) -> bool:
+        """
+        Returns whether the message with key was accepted less than ttl_seconds ago, and counts a
+        hit or a miss.
+        """
+
+        now = time.monotonic() if now is None else now
+
+        # Keys at the front that have run out are removed here, so they do not take up room
+        # until the LRU order reaches them
+        while self.entries:
+            oldest_key, accepted = next(iter(self.entries.items()))
+            if now - accepted < self.ttl_seconds:
+                break
+            del self.entries[oldest_key]
+            self.expirations += 1
+
+        accepted = self.entries.get(key)
+        if accepted is not None and now - accepted < self.ttl_seconds:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+        if accepted is not None:
+            del self.entries[key]
+            self.expirations += 1
+
+        self.misses += 1
+        return False
+
+    def add(self, key: tuple, now: float = None):
+        """
+        Remembers that the message with key was accepted now.
+        """
+
+        self.entries[key] = time.monotonic() if now is None else now
+        self.entries.move_to_end(key)
+
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def to_dict(self) -> dict:
+        """
+        Returns the settings and counters for /stats.
+        """
+
+        return {
+            "ttl_seconds": self.ttl_seconds,
+            "max_entries": self.max_entries,
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SMTPServer:
+    """
+    Class that will operate like a state machine to keep track of what command
+    is being handled next.
+    """
+
+    EXPECTING_CONNECTION = 0
+    EXPECTING_HELO = 1
+    EXPECTING_MAIL_FROM = 2
+    EXPECTING_RCPT_TO = 3
+    EXPECTING_RCPT_TO_OR_DATA = 4
+    EXPECTING_DATA_END = 5
+    EXPECTING_QUIT = 6
+
+    STATE_NAMES = {
+        EXPECTING_CONNECTION: "EXPECTING_CONNECTION",
+        EXPECTING_HELO: "EXPECTING_HELO",
+        EXPECTING_MAIL_FROM: "EXPECTING_MAIL_FROM",
+        EXPECTING_RCPT_TO: "EXPECTING_RCPT_TO",
+        EXPECTING_RCPT_TO_OR_DATA: "EXPECTING_RCPT_TO_OR_DATA",
+        EXPECTING_DATA_END: "EXPECTING_DATA_END",
+        EXPECTING_QUIT: "EXPECTING_QUIT",
+    }
+
+    def __init__(self, debug_mode: bool = False, slow_threshold_ms: float = 0.0, slow_log=None):
+        self.state = self.EXPECTING_CONNECTION
+        self.to_email_addresses = []
+        self.to_domains = set()
+        self.email_text = []
+        self.parser = None
+        self.debug_mode = debug_mode
+        self.connection_socket = None
+
+        self.body_hash = hashlib.sha256()
+        """
+        SHA-256 of the lines of the current message so far, each with its newline, which is
+        updated as each line arrives. Once the message is complete, it is the hash of the text
+        that is written to the forward files, without going over the text again.
+        """
+
+        self.duplicate_cache = None
+        """
+        DuplicateCache of recently accepted messages (--dedup-seconds), or None to write every
+        message that is sent.
+        """
+
+        self.mail_indexer = None
+        """
+        MailIndexer that every message written is queued for (--mail-index), or None.
+        """
+
+        self.metrics = ServerMetrics(self.TRANSITIONS.keys())
+        """
+        Counters and latency histograms since the server started.
+        """
+
+        self.messages_on_connection = 0
+        """
+        The number of email messages accepted on the current connection. Anything above 1 means
+        that the client reused the connection instead of reconnecting for each message.
+        """
+
+        self.timeline = SessionTimeline(slow_threshold_ns=int(slow_threshold_ms * 1_000_000))
+        """
+        Timestamps of the state changes of the current connection.
+        """
+
+        self.slow_log = slow_log
+        """
+        Open text file that sessions with a phase over the threshold are written to, one JSON
+        object per line.
+        """
+
+        self.domain_table = None
+        """
+        DomainTable of policies by recipient domain (from --domain-table), or None to accept every
+        domain. Replaced as a whole on SIGHUP, never changed in place.
+        """
+
+        self.recipient_index = None
+        """
+        RecipientIndex of the addresses that can receive mail (from --recipient-index), or None to
+        accept every address. Also replaced as a whole on SIGHUP.
+        """
+
+        self.forward_format = "text"
+        """
+        Format of new forward files (--forward-format): "text" or "v2" (see FORWARD_V2_RECORD).
+        """
+
+        self.forward_compression = ""
+        self.forward_compression_level = None
+        """
+        Compression of the text of each message in v2 forward files (--forward-compression and
+        --compression-level): "" for none, or a name from FORWARD_COMPRESSORS.
+        """
+
+        self.forward_file_formats = {}
+        """
+        Domain -> format of its forward file, so the first bytes of each file are only read once.
+        """
+
+        self.from_address = ""
+        """
+        The address from MAIL FROM of the current message.
+        """
+
+        self.forward_segments = None
+        """
+        ForwardSegments that rotates the forward files (--rotate-bytes and --rotate-seconds), or
+        None to let them grow.
+        """
+
+    def set_parser(self, current_parser: Parser):
+        """
+        By the time the parser is set, the line has already been read. That means,
+        what we do is check the current state and act accordingly.
+        """
+        self.parser = current_parser
+
+        if not isinstance(current_parser, Parser):
+            raise ValueError("parser must be an instance of Parser class.")
+
+    def set_socket(self, connection_socket: socket.socket):
+        """
+        Docstring for set_socket
+
+        :param self: Description
+        :param connection_socket: Description
+        :type connection_socket: socket
+        """
+
+        self.connection_socket = connection_socket
+
+        if not socket_is_connected(connection_socket, self.debug_mode):
+            raise ValueError("connection_socket must be an instance of the socket class.")
+
+    def start_connection(self, connection_socket: socket.socket):
+        """
+        Puts the state machine back to the beginning for a newly accepted connection, no matter
+        where the previous connection left off.
+        """
+
+        self.set_socket(connection_socket)
+        self.state = self.EXPECTING_CONNECTION
+        self.reset()
+
+        self.metrics.connections += 1
+        self.messages_on_connection = 0
+        self.timeline.start(time.perf_counter_ns())
+
+    def end_connection(self):
+        """
+        Called once the current connection is closed, for whatever reason.
+        """
+
+        DebugMode.print(self.debug_mode, f"connection #{self.metrics.connections} closed; messages on this connection: {self.messages_on_connection}, messages since startup: {self.metrics.messages}", DebugMode.SUCCESS)
+
+        if self.timeline.is_slow():
+            self.metrics.slow_sessions += 1
+            self.write_slow_log()
+
+        self.state = self.EXPECTING_CONNECTION
+        self.reset()
+
+    def write_slow_log(self):
+        """
+        Writes the timeline of the current connection to the slow log as one line of JSON.
+        """
+
+        if self.slow_log is None:
+            return
+
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "connection": self.metrics.connections,
+            "messages": self.messages_on_connection,
+            **self.timeline.to_dict(),
+        }
+
+        self.slow_log.write(json.dumps(entry) + "\n")
+        self.slow_log.flush()
+
+    def add_text_to_email_body(self, text: str):
+        """
+        Add the input string without the trailing newline character to the list of lines that
+        will be appended to the message if the message parses correctly.
+
+        Note to self: .strip() is too greedy and will remove trailing and leading spaces and tabs,
+        changing the original content of each line passed to the parser.
+
+        Another note to self: if this function is called, just do it; do not try to prevent an
+        empty string from being sent to the email message.
+        """
+
+        self.email_text.append(text)
+        self.body_hash.update(text.encode() + b"\n")
+
+    def get_body_hash(self) -> bytes:
+        """
+        Returns the SHA-256 of the text of the current message, as process_email_message() writes
+        it.
+        """
+
+        # A message with no lines is written as a single newline
+        if not self.email_text:
+            return hashlib.sha256(b"\n").digest()
+
+        return self.body_hash.digest()
+
+
+    def evaluate_state(self):
+        """
+        Determines what should happen based on the current state and the command on the current
+        line. The (state, command) pair is looked up in the TRANSITIONS table, which gives the
+        handler to call and the state to move to afterwards.
+        """
+
+        DebugMode.print(self.debug_mode, "About to check whether the parser object is valid...")
+
+        if not isinstance(self.parser, Parser):
+            raise ValueError("parser must be an instance of Parser class.")
+
+        DebugMode.print(self.debug_mode, "About to check whether the socket object is valid...")
+
+        if not self.connection_socket or not socket_is_connected(self.connection_socket, self.debug_mode):
+            raise ValueError("connection_socket must be an instance of the socket class.")
+
+        DebugMode.print(self.debug_mode, f"evaluate_state(server): state: {self.state}")
+
+        start = time.perf_counter_ns()
+
+        key, handler, next_state = self.get_transition()
+
+        # A handler returns False when the transition should not happen, like when the greeting
+        # could not be sent to the client.
+        if handler(self):
+            self.advance(key[1], next_state)
+
+        self.metrics.transitions[key].observe(time.perf_counter_ns() - start)
+
+    def identify_command(self) -> str:
+        """
+        Returns the name of the command on the current line, which is the second half of the key
+        used for the TRANSITIONS table. Some states do not read a command at all, so a
+        pseudo-command is returned for those instead (CONNECT, TEXT, DATA_END).
+
+        An empty string means that no command was recognized.
+        """
+
+        if self.state == self.EXPECTING_CONNECTION:
+            return self.CONNECT
+
+        if self.state == self.EXPECTING_DATA_END:
+            # Any line that is not ".<CRLF>" is a line of text for the body of the message
+            is_data_end = self.parser.data_end_cmd()
+            self.parser.rewind(self.parser.BEGINNING_POSITION)
+            return self.DATA_END if is_data_end else self.TEXT
+
+        if self.parser.check_for_commands():
+            return self.parser.get_command_name()
+
+        # match_helo_msg() decides between 500 and 501 on its own, so every other line is treated
+        # as a HELO attempt while waiting for one.
+        if self.state == self.EXPECTING_HELO:
+            return "HELO"
+
+        return ""
+
+    def get_transition(self) -> tuple:
+        """
+        Returns the (state, command) key and the (handler, next_state) pair for the command on the
+        current line, as one tuple.
+
+        If no command is recognized, then that results in a 500 error.
+        If an unexpected command is recognized based on the current state, that results in a 503.
+        Syntax errors in the message name (type 500 errors) take precedence over out-of-order
+        errors (type 503 errors), which take precedence over parameter/argument errors (type 501
+        errors). The 501 errors are raised by the handlers once the sequence has been verified.
+        """
+
+        recognized_command = self.identify_command()
+
+        DebugMode.print(self.debug_mode, f"line: {self.parser.get_input_line()}, state: {self.state}, recognized_command: {recognized_command}")
+
+        key = (self.state, recognized_command)
+        transition = self.TRANSITIONS.get(key)
+
+        if transition is not None:
+            return key, *transition
+
+        if not recognized_command:
+            raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
+
+        raise ParserError(ParserError.BAD_SEQUENCE_OF_COMMANDS)
+
+    def send_greeting(self) -> bool:
+        """
+        A client has just connected, so the server "speaks" first with "220 hostname".
+        """
+
+        if not socket_send_msg(self.connection_socket, f"220 {get_hostname()}", self.debug_mode):
+            print("Failed to send initial 220 message to client upon establishing a connection.")
+            self.reset()
+            return False
+
+        return True
+
+    def handle_helo(self) -> bool:
+        """
+        Handles "HELO domain" by replying with "250 Hello domain pleased to meet you".
+        """
+
+        if not self.parser.match_helo_msg():
+            raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
+
+        client_domain = self.parser.get_domain_from_helo()
+        if not socket_send_msg(self.connection_socket, f"250 Hello {client_domain} pleased to meet you", self.debug_mode):
+            print('Failed to send 250 Hello message to client. Closing connection.')
+            close_socket(self.connection_socket)
+
+        return True
+
+    def handle_mail_from(self) -> bool:
+        """
+        Handles "MAIL FROM:", which starts a new email message. Any recipients or text left over
+        from the previous message on this connection are discarded first.
+        """
+
+        # if the command fails, that means a type 501 error occurred.
+        if not self.parser.mail_from_cmd():
+            raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
+
+        self.from_address = self.parser.get_email_address()
+        self.to_email_addresses = []
+        self.to_domains = set()
+        self.email_text = []
+        self.body_hash = hashlib.sha256()
+
+        if not socket_send_msg(self.connection_socket, f"250 OK", self.debug_mode):
+            print('Failed to send 250 OK to client. Closing connection.')
+            close_socket(self.connection_socket)
+
+        return True
+
+    def handle_rcpt_to(self) -> bool:
+        """
+        Handles "RCPT TO:" by keeping up with the domain of the recipient. The forward files are
+        named by domain, so that is all that is needed.
+        """
+
+        # if the command fails, that means a type 501 error occurred.
+        if not self.parser.rcpt_to_cmd():
+            raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
+
+        domain = self.parser.get_email_domain()
+
+        rejection = self.check_recipient(self.parser.get_email_address(), domain)
+        if rejection:
+            # The message itself is still fine, so the state stays the same; the client can go on
+            # with other recipients
+            self.metrics.count_error(550)
+            if not socket_send_msg(self.connection_socket, rejection, self.debug_mode):
+                print('Failed to send 550 to client. Closing connection.')
+                close_socket(self.connection_socket)
+            return False
+
+        # The forward files are named by domain; the addresses are only kept for the v2 format
+        self.to_email_addresses.append(self.parser.get_email_address())
+        self.to_domains.add(domain)
+        self.metrics.recipients += 1
+
+        if not socket_send_msg(self.connection_socket, f"250 OK", self.debug_mode):
+            print('Failed to send 250 OK to client. Closing connection.')
+            close_socket(self.connection_socket)
+
+        return True
+
+    def check_recipient(self, address: str, domain: str) -> str:
+        """
+        Returns the reply that refuses a recipient, or an empty string if the recipient is accepted.
+        """
+
+        # Read once, since SIGHUP can replace these at any time
+        domain_table = self.domain_table
+        if domain_table is not None and domain_table.lookup(domain) == REJECT_POLICY:
+            return f"550 No mail is accepted for {domain}"
+
+        recipient_index = self.recipient_index
+        if recipient_index is not None and not recipient_index.contains(address):
+            return f"550 No such user here: {address}"
+
+        return ""
+
+    def handle_data(self) -> bool:
+        """
+        Handles "DATA" by telling the client to start sending the body of the message.
+        """
+
+        if not self.parser.data_cmd():
+            raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
+
+        if not socket_send_msg(self.connection_socket, f"354 Start mail input; end with <CRLF>.<CRLF>", self.debug_mode):
+            print('Failed to send 354 message to client. Closing connection.')
+            close_socket(self.connection_socket)
+
+        return True
+
+    def handle_text(self) -> bool:
+        """
+        Handles a line of text for the body of the email. According to the writeup, "we'll assume
+        that 'text' is limited to printable text, whitespace, and newlines".
+        """
+
+        DebugMode.print(self.debug_mode, "Checking for whether this is a valid line of text for the body of the email...")
+        if not self.parser.data_read_msg_line():
+            DebugMode.print(self.debug_mode, f"This line is not valid for the body of the email: {self.parser.get_input_line()}")
+            raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
+
+        DebugMode.print(self.debug_mode, f"About to add this line to the email body: {self.parser.get_input_line()}")
+        self.add_text_to_email_body(self.parser.get_input_line())
+        return True
+
+    def handle_data_end(self) -> bool:
+        """
+        Handles ".<CRLF>" by appending the message to the forward files and sending a 250.
+        """
+
+        DebugMode.print(self.debug_mode, "End of message confirmed. About to process the email message...")
+        start = time.perf_counter_ns()
+        self.timeline.record("end-of-data", start)
+
+        # A message that was already accepted within the window gets the same 250 without being
+        # written again. It is only remembered once it has been written, so a message whose write
+        # failed is not mistaken for a duplicate when the client tries again.
+        duplicate_key = None
+        if self.duplicate_cache is not None:
+            duplicate_key = DuplicateCache.get_key(self.from_address, self.to_email_addresses, self.get_body_hash())
+
+        if duplicate_key is not None and self.duplicate_cache.contains(duplicate_key):
+            DebugMode.print(self.debug_mode, "This message was already accepted; not writing it again.", DebugMode.WARN)
+        else:
+            self.process_email_message()
+            if duplicate_key is not None:
+                self.duplicate_cache.add(duplicate_key)
+
+        elapsed = time.perf_counter_ns() - start
+        self.metrics.process_email_message.observe(elapsed)
+        self.timeline.disk_ns += elapsed
+
+        self.metrics.messages += 1
+        self.messages_on_connection += 1
+
+        if not socket_send_msg(self.connection_socket, f"250 OK", self.debug_mode):
+            print('Failed to send 250 OK to client. Closing connection.')
+            close_socket(self.connection_socket)
+
+        return True
+
+    def handle_quit(self) -> bool:
+        """
+        Handles "QUIT" by sending a 221 and closing the connection.
+        """
+
+        if not self.parser.quit_cmd():
+            raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
+
+        socket_send_msg(self.connection_socket, f"221 {get_hostname()} closing connection", self.debug_mode)
+        close_socket(self.connection_socket)
+        self.reset()
+        return True
+
+    def handle_rset(self) -> bool:
+        """
+        Handles "RSET" by throwing away the current email message, if any. The connection stays
+        open so that the client can start another message with MAIL FROM.
+        """
+
+        if not self.parser.rset_cmd():
+            raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
+
+        self.reset()
+
+        if not socket_send_msg(self.connection_socket, f"250 OK", self.debug_mode):
+            print('Failed to send 250 OK to client. Closing connection.')
+            close_socket(self.connection_socket)
+
+        return True
+
+    def handle_noop(self) -> bool:
+        """
+        Handles "NOOP" by sending a 250 without changing anything.
+        """
+
+        if not self.parser.noop_cmd():
+            raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
+
+        if not socket_send_msg(self.connection_socket, f"250 OK", self.debug_mode):
+            print('Failed to send 250 OK to client. Closing connection.')
+            close_socket(self.connection_socket)
+
+        return True
+
+    # Pseudo-commands for the states that do not read an SMTP command from the client
+    CONNECT = "CONNECT"
+    TEXT = "TEXT"
+    DATA_END = "DATA_END"
+
+    TRANSITIONS = {
+        (EXPECTING_CONNECTION, CONNECT): (send_greeting, EXPECTING_HELO),
+        (EXPECTING_HELO, "HELO"): (handle_helo, EXPECTING_MAIL_FROM),
+        (EXPECTING_MAIL_FROM, "MAIL FROM"): (handle_mail_from, EXPECTING_RCPT_TO),
+        (EXPECTING_RCPT_TO, "RCPT TO"): (handle_rcpt_to, EXPECTING_RCPT_TO_OR_DATA),
+        (EXPECTING_RCPT_TO_OR_DATA, "RCPT TO"): (handle_rcpt_to, EXPECTING_RCPT_TO_OR_DATA),
+        (EXPECTING_RCPT_TO_OR_DATA, "DATA"): (handle_data, EXPECTING_DATA_END),
+        (EXPECTING_DATA_END, TEXT): (handle_text, EXPECTING_DATA_END),
+        (EXPECTING_DATA_END, DATA_END): (handle_data_end, EXPECTING_QUIT),
+        # It is possible to encounter another MAIL FROM command after a message is finished.
+        (EXPECTING_QUIT, "MAIL FROM"): (handle_mail_from, EXPECTING_RCPT_TO),
+        (EXPECTING_QUIT, "QUIT"): (handle_quit, EXPECTING_CONNECTION),
+        # RSET abandons the current message but keeps the connection, so that more than one
+        # message can be sent without reconnecting. It is not allowed in the middle of DATA since
+        # every line there is part of the message.
+        (EXPECTING_HELO, "RSET"): (handle_rset, EXPECTING_HELO),
+        (EXPECTING_MAIL_FROM, "RSET"): (handle_rset, EXPECTING_MAIL_FROM),
+        (EXPECTING_RCPT_TO, "RSET"): (handle_rset, EXPECTING_MAIL_FROM),
+        (EXPECTING_RCPT_TO_OR_DATA, "RSET"): (handle_rset, EXPECTING_MAIL_FROM),
+        (EXPECTING_QUIT, "RSET"): (handle_rset, EXPECTING_MAIL_FROM),
+        (EXPECTING_HELO, "NOOP"): (handle_noop, EXPECTING_HELO),
+        (EXPECTING_MAIL_FROM, "NOOP"): (handle_noop, EXPECTING_MAIL_FROM),
+        (EXPECTING_RCPT_TO, "NOOP"): (handle_noop, EXPECTING_RCPT_TO),
+        (EXPECTING_RCPT_TO_OR_DATA, "NOOP"): (handle_noop, EXPECTING_RCPT_TO_OR_DATA),
+        (EXPECTING_QUIT, "NOOP"): (handle_noop, EXPECTING_QUIT),
+        # A client that gave up on a message after an error sends QUIT from wherever it is.
+        (EXPECTING_HELO, "QUIT"): (handle_quit, EXPECTING_CONNECTION),
+        (EXPECTING_MAIL_FROM, "QUIT"): (handle_quit, EXPECTING_CONNECTION),
+        (EXPECTING_RCPT_TO, "QUIT"): (handle_quit, EXPECTING_CONNECTION),
+        (EXPECTING_RCPT_TO_OR_DATA, "QUIT"): (handle_quit, EXPECTING_CONNECTION),
+    }
+    """
+    The state machine as a table: (state, command) -> (handler, next_state). Built once when the
+    class is defined so that each line only needs one dictionary lookup. Anything not in this
+    table is either a 500 (no command recognized) or a 503 (command in the wrong order).
+    """
+
+    def reset(self):
+        """
+        Resets the SMTP server state machine to expect a new email. Before HELO, the state is
+        left alone since there is no email to throw away yet.
+        """
+
+        if self.state >= self.EXPECTING_MAIL_FROM:
+            self.state = self.EXPECTING_MAIL_FROM
+
+        self.to_email_addresses = []
+        self.to_domains = set()
+        self.email_text = []
+        self.body_hash = hashlib.sha256()
+
+        DebugMode.print(self.debug_mode, "SERVER state machine has been reset.", DebugMode.ERROR)
+
+    # Command -> timeline event recorded when its transition happens. Lines of the body are not
+    # recorded, since they would push everything else out of the ring buffer.
+    TIMELINE_EVENTS = {
+        CONNECT: "220",
+        "HELO": "HELO",
+        "MAIL FROM": "MAIL",
+        "RCPT TO": "RCPT",
+        "DATA": "DATA",
+        DATA_END: "delivered",
+        "RSET": "RSET",
+        "NOOP": "NOOP",
+        "QUIT": "QUIT",
+    }
+
+    def advance(self, command: str, next_state: int):
+        """
+        Moves the state machine to next_state after command was handled, and records the time in
+        the session timeline.
+        """
+
+        self.state = next_state
+
+        event_name = self.TIMELINE_EVENTS.get(command)
+        if event_name is not None:
+            self.timeline.record(event_name)
+
+    def create_folder(self, folder_name: str) -> Path:
+        """
+        Create a folder with the specified name in the same location as this
+        Python script.
+        """
+
+        if not folder_name:
+            raise ValueError("create_folder(); must specify a folder name")
+
+        # This is the folder that this Python script lives in.
+        # I got this wrong the first time; this should be in the "current working directory" (p. 6)
+        current_folder = Path.cwd()
+        # This is the "forward" folder I want to create
+        new_folder = current_folder / folder_name
+
+        # it's okay if the folder already exists
+        new_folder.mkdir(exist_ok=True)
+
+        return new_folder
+
+    def process_email_message(self):
+        """
+        Takes the lines that make up the email message and appends them to the mailbox files in
+        the "forward" folder for each recipient of the current message (to_email_addresses).
+        """
+
+        # 1. Get the text of the message
+        email_complete_text = "\n".join(self.email_text) + "\n"
+        self.metrics.message_bytes += len(email_complete_text)
+
+        # 2. Create the "folder" folder
+        forward_folder = self.create_folder("forward")
+
+        # 3. For each recipient of the latest email message, append the text
+        # of the email to a file with the email address as the name.
+        message = (self.from_address, self.to_email_addresses, email_complete_text, self.get_body_hash(), time.time())
+        records = {}
+        locations = {} if self.mail_indexer is not None else None
+        for domain in self.to_domains:
+            self.append_to_forward_file(forward_folder, domain, [message], records, locations)
+
+        # 4. Queue the message for the mail index, which is updated on its own thread
+        if self.mail_indexer is not None:
+            self.mail_indexer.submit(message[4], self.from_address, self.to_email_addresses, email_complete_text, self.get_body_hash(),
+                                     locations.get(id(message), []))
+
+    def append_to_forward_file(self, forward_folder: Path, domain: str, messages: list, records: dict = None,
+                               locations: dict = None) -> int:
+        """
+        Appends messages, each (sender, recipients, text, SHA-256 of the text, timestamp), to the
+        forward file of domain with one write, and rotates the file afterwards if it is due.
+        Returns the size of the file after the write.
+
+        records holds the v2 records that have already been encoded, by id() of the message, so a
+        message to more than one domain is only encoded (and compressed) once. If locations is
+        given, where each message was written (see MAIL_INDEX_MESSAGE) is added to its list there,
+        by id() of the message, for the mail index.
+        """
+
+        forward_path = forward_folder / domain
+        records = {} if records is None else records
+
+        with forward_path.open("ab") as f:
+            # A new (or empty) file gets the configured format; an existing one keeps its own
+            if f.tell() == 0:
+                file_format = self.forward_format
+                if file_format == "v2":
+                    f.write(FORWARD_V2_MAGIC)
+            else:
+                file_format = self.forward_file_formats.get(domain) or get_forward_file_format(forward_path)
+            self.forward_file_formats[domain] = file_format
+
+            if file_format == "v2":
+                chunks = []
+                for message in messages:
+                    record = records.get(id(message))
+                    if record is None:
+                        sender, recipients, text, body_hash, timestamp = message
+                        record = records[id(message)] = encode_forward_record(sender, recipients, text, timestamp,
+                                                                              compression=self.forward_compression,
+                                                                              level=self.forward_compression_level, body_hash=body_hash)
+                    chunks.append(record)
+            else:
+                chunks = [message[2].encode() for message in messages]
+
+            if locations is not None:
+                # The inode stays the same when the file is rotated into a segment, so
+                # MailIndex.py can still find it there
+                offset = f.tell()
+                inode = os.fstat(f.fileno()).st_ino
+                for message, chunk in zip(messages, chunks):
+                    locations.setdefault(id(message), []).append(f"{domain}:{inode}:{offset}")
+                    offset += len(chunk)
+
+            f.write(b"".join(chunks))
+
+            size = f.tell()
+
+        if self.forward_segments is not None:
+            self.forward_segments.after_write(domain, size)
+
+        return size
+
+
+UNIX_ADDRESS_PREFIX = "unix:"
+"""
+Addresses that start with this are paths of Unix domain sockets instead of TCP ports.
+"""
+
+
+def parse_listen_address(text: str) -> int|str:
+    """
+    Converts an address from the command line: a port number (int) for TCP, or "unix:/path" for
+    a Unix domain socket, which is returned as just the path (str).
+    """
+
+    if text.startswith(UNIX_ADDRESS_PREFIX):
+        path = text[len(UNIX_ADDRESS_PREFIX):]
+        if not path:
+            raise argparse.ArgumentTypeError("unix: must be followed by the path of the socket file")
+        return path
+
+    try:
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{text}' is neither a port number nor unix:/path")
+
+
+def open_listening_socket(address: int|str, unix_mode: int, debug_mode: bool = False) -> socket.socket:
+    """
+    Creates a socket that is bound to address and listening. For a Unix domain socket, a file
+    left over from an earlier run is removed first, and the permissions of the new file are set
+    to unix_mode before listening, since the file permissions decide who can connect.
+    """
+
+    if isinstance(address, str):
+        path = Path(address)
+
+        # A socket file nobody answers on was left behind by a server that did not exit cleanly
+        if path.is_socket():
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                if probe.connect_ex(address) == 0:
+                    raise OSError(f"another server is already listening on {UNIX_ADDRESS_PREFIX}{address}")
+            path.unlink()
+
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        server_socket.bind(address)
+        os.chmod(address, unix_mode)
+    else:
+        # https://docs.python.org/3.12/library/socket.html#socket.AF_INET
+        # https://docs.python.org/3.12/library/socket.html#socket.SOCK_STREAM
+        # SOCK_STREAM represents a socket type, one of the two the official documentation lists as
+        # useful
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # The documentation provides a way to reuse a local socket in the TIME_WAIT state without
+        # waiting for its natural timeout to expire
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # https://docs.python.org/3.12/library/socket.html#socket.socket.bind
+        # This takes one parameter that is a 2-element tuple
+        server_socket.bind(('', address))
+
+    # https://docs.python.org/3.12/library/socket.html#socket.socket.listen
+    # The parameter specifies the number of unaccepted connections that the system will allow
+    # before refusing new connections. This can help prevent multiple sockets and issues.
+    server_socket.listen(1)
+
+    DebugMode.print(debug_mode, f"listening on {UNIX_ADDRESS_PREFIX + address if isinstance(address, str) else f'port {address}'}", DebugMode.INFO)
+
+    return server_socket
+
+
+def accept_next_connection(selector: selectors.BaseSelector) -> tuple:
+    """
+    Waits until one of the listening sockets registered with selector has a connection, then
+    accepts it and returns what .accept() returns. Connections are still handled one at a time;
+    this only lets TCP and Unix domain socket clients take turns.
+    """
+
+    while True:
+        for key, _ in selector.select():
+            return key.fileobj.accept()
+
+
+def get_command_line_arguments():
+    """
+    Handles command line arguments for the forward file and debug mode.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="HW4: Building an SMTP Client/Server System Using Sockets")
+    # https://docs.python.org/3/library/argparse.html#argparse.ArgumentParser.add_argument
+    arg_parser.add_argument(
+        "--debug",
+        # https://docs.python.org/3/library/argparse.html#action
+        action="store_true",
+        help="Enable additional logging that is helpful for debugging without modifying code."
+    )
+
+    # Add an argument for reading the forward file
+    arg_parser.add_argument(
+        "addresses",
+        # https://docs.python.org/3/library/argparse.html#action
+        # 'store' - This just stores the argument's value. This is the default action.
+        action="store",
+        nargs="+",
+        metavar="port_number",
+        help="Incoming port number for connecting to the SMTP server, or unix:/path for a Unix domain socket; give more than one to listen on all of them",
+        # https://docs.python.org/3/library/argparse.html#type
+        type=parse_listen_address
+    )
+
+    arg_parser.add_argument(
+        "--unix-mode",
+        action="store",
+        help="Permissions of unix:/path socket files, in octal (default 660: owner and group can connect)",
+        type=lambda text: int(text, 8),
+        default=0o660
+    )
+
+    arg_parser.add_argument(
+        "--stats-port",
+        action="store",
+        help="Serve counters and latency histograms on http://127.0.0.1:PORT/stats (JSON) and /metrics (text)",
+        type=int,
+        default=None
+    )
+
+    # SIGUSR1 samples stacks and SIGUSR2 diffs tracemalloc snapshots; see install_profiling_signals()
+    arg_parser.add_argument(
+        "--profile-dir",
+        action="store",
+        help="Folder for the output of SIGUSR1 (collapsed stacks) and SIGUSR2 (top allocators)",
+        type=Path,
+        default=Path("profiles")
+    )
+
+    arg_parser.add_argument(
+        "--profile-rate",
+        action="store",
+        help="Stack samples per second after SIGUSR1",
+        type=int,
+        default=100
+    )
+
+    arg_parser.add_argument(
+        "--profile-seconds",
+        action="store",
+        help="Number of seconds to sample stacks for after SIGUSR1",
+        type=float,
+        default=10.0
+    )
+
+    arg_parser.add_argument(
+        "--slow-ms",
+        action="store",
+        help="Log every session with a phase (e.g. HELO -> MAIL) that took longer than this many milliseconds",
+        type=float,
+        default=None
+    )
+
+    arg_parser.add_argument(
+        "--slow-log",
+        action="store",
+        help="File to append slow sessions to, one JSON object per line (default: standard error)",
+        type=Path,
+        default=None
+    )
+
+    arg_parser.add_argument(
+        "--domain-table",
+        action="store",
+        help='File of "pattern policy" lines (e.g. "*.example.com reject") checked at RCPT TO; reloaded on SIGHUP',
+        type=Path,
+        default=None
+    )
+
+    arg_parser.add_argument(
+        "--recipient-index",
+        action="store",
+        help="Only accept RCPT TO for the addresses in this file (built with BuildRecipientIndex.py); reloaded on SIGHUP",
+        type=Path,
+        default=None
+    )
+
+    arg_parser.add_argument(
+        "--forward-format",
+        action="store",
+        help="Format of new forward files: text, or v2 (length-prefixed records that can be skipped "
+             "without reading them; see ConvertForwardFile.py). Existing files keep their format",
+        choices=FORWARD_FORMATS,
+        default="text"
+    )
+
+    arg_parser.add_argument(
+        "--forward-compression",
+        action="store",
+        help="Compress the text of each message in v2 forward files on its own with zlib or lzma",
+        choices=list(FORWARD_COMPRESSORS),
+        default=""
+    )
+
+    arg_parser.add_argument(
+        "--compression-level",
+        action="store",
+        help="zlib level (1-9, default 6) or lzma preset (0-9, default 1)",
+        type=int,
+        default=None
+    )
+
+    arg_parser.add_argument(
+        "--rotate-bytes",
+        action="store",
+        help="Move a forward file to forward/.segments/<domain>/ once it is this many bytes long",
+        type=int,
+        default=0
+    )
+
+    arg_parser.add_argument(
+        "--rotate-seconds",
+        action="store",
+        help="Move a forward file to forward/.segments/<domain>/ at the first message after it is this many seconds old",
+        type=float,
+        default=0.0
+    )
+
+    arg_parser.add_argument(
+        "--compact-interval",
+        action="store",
+        help="Seconds between passes of the compactor that merges small segments and drops deleted messages",
+        type=float,
+        default=60.0
+    )
+
+    arg_parser.add_argument(
+        "--dedup-seconds",
+        action="store",
+        help="Accept a message with the same sender, recipients and text as one accepted this many seconds ago without writing it again",
+        type=float,
+        default=0.0
+    )
+
+    arg_parser.add_argument(
+        "--dedup-entries",
+        action="store",
+        help="Most messages to remember for --dedup-seconds; the least recently seen are forgotten first",
+        type=int,
+        default=100_000
+    )
+
+    arg_parser.add_argument(
+        "--mail-index",
+        action="store_true",
+        help="Keep an index of delivered mail by sender, recipient, subject and keyword in forward/.mailindex (search it with MailIndex.py)"
+    )
+
+    arg_parser.add_argument(
+        "--index-flush-messages",
+        action="store",
+        help="Messages the mail index collects in memory before writing them out as a new segment",
+        type=int,
+        default=10_000
+    )
+
+    args = arg_parser.parse_args()
+
+    if args.index_flush_messages < 1:
+        arg_parser.error("--index-flush-messages must be positive")
+
+    if args.dedup_seconds < 0 or args.dedup_entries < 1:
+        arg_parser.error("--dedup-seconds cannot be negative and --dedup-entries must be positive")
+
+    if args.rotate_bytes < 0 or args.rotate_seconds < 0 or args.compact_interval <= 0:
+        arg_parser.error("--rotate-bytes and --rotate-seconds cannot be negative, and --compact-interval must be positive")
+
+    if args.forward_compression and args.forward_format != "v2":
+        arg_parser.error("--forward-compression needs --forward-format v2; text forward files are never compressed")
+
+    if args.compression_level is not None and not 0 <= args.compression_level <= 9:
+        arg_parser.error("--compression-level must be between 0 and 9")
+
+    return args
+
+
+def main():
+    """
+    This code starts here.
+    """
+
+    # TODO: Print the hostname, delete this
+    # print(f"220 {get_hostname()}")
+
+    args = get_command_line_arguments()
+    debug_mode = args.debug
+    # 8000 + 4956 = 12956
+    server_addresses = args.addresses
+
+    # This is the maximum amount of data, in bytes, that can be received or sent via the socket.
+    bufsize = 1024
+
+    # Sessions with a slow phase go to standard error unless a file is given
+    slow_log = None
+    if args.slow_ms:
+        slow_log = args.slow_log.open("a", encoding="utf-8") if args.slow_log else sys.stderr
+
+    # Create an instance of the SMTPServer state machine
+    smtp_server = SMTPServer(debug_mode, args.slow_ms or 0.0, slow_log)
+    smtp_server.forward_format = args.forward_format
+    smtp_server.forward_compression = args.forward_compression
+    smtp_server.forward_compression_level = args.compression_level
+
+    if args.mail_index:
+        try:
+            smtp_server.mail_indexer = MailIndexer(smtp_server.create_folder("forward") / MAIL_INDEX_FOLDER_NAME, args.index_flush_messages, debug_mode=debug_mode)
+        except (OSError, ValueError) as e:
+            print(f"Could not open the mail index: {e}")
+            sys.exit(1)
+        smtp_server.mail_indexer.start()
+
+    if args.dedup_seconds:
+        smtp_server.duplicate_cache = DuplicateCache(args.dedup_seconds, args.dedup_entries)
+
+    if args.rotate_bytes or args.rotate_seconds:
+        smtp_server.forward_segments = ForwardSegments(smtp_server.create_folder("forward"), args.rotate_bytes, args.rotate_seconds, debug_mode)
+        smtp_server.forward_segments.start(args.compact_interval)
+
+    stack_sampler = StackSampler(args.profile_dir, args.profile_rate, args.profile_seconds, debug_mode)
+    install_profiling_signals(stack_sampler, MemorySnapshotter(args.profile_dir, debug_mode=debug_mode))
+
+    if args.stats_port:
+        start_stats_server(smtp_server, args.stats_port, stack_sampler, debug_mode)
+
+    if args.domain_table:
+        try:
+            smtp_server.domain_table = load_domain_table(args.domain_table)
+        except (OSError, ValueError) as e:
+            print(f"Could not read the domain table: {e}")
+            sys.exit(1)
+
+    if args.recipient_index:
+        try:
+            smtp_server.recipient_index = RecipientIndex(args.recipient_index)
+        except (OSError, ValueError) as e:
+            print(f"Could not read the recipient index: {e}")
+            sys.exit(1)
+
+    if args.domain_table or args.recipient_index:
+        install_reload_signal(smtp_server, args.domain_table, args.recipient_index, debug_mode)
+
+    # By following the first example from the documentation here, it looks like you should use
+    # "with" statements to properly close resources when they are done.
+    # https://docs.python.org/3.12/library/socket.html#example
+    # There is one listening socket per address (TCP port or unix:/path), and the selector waits
+    # on all of them at once.
+    with selectors.DefaultSelector() as selector:
+
+        server_sockets = []
+        connection_socket = None
+        addr = None
+        should_close_socket = True
+
+        try:
+
+            DebugMode.print(debug_mode, "about to create the listening sockets...")
+
+            for address in server_addresses:
+                server_socket = open_listening_socket(address, args.unix_mode, debug_mode)
+                server_sockets.append(server_socket)
+                selector.register(server_socket, selectors.EVENT_READ)
+
+            # This outer
+            while True:
+                # TODO: What is "addr" for?
+                # .accept() returns a tuple where the first element is a socket object
+                # the second element is a return address
+                # What is the difference between connection_socket and server_socket? It seems that
+                # connection_socket represents an actual socket object when the client connects and is
+                # spawned from the server_socket object.
+
+                DebugMode.print(debug_mode, "about to create a new connection socket and listen for connections...", DebugMode.INFO)
+
+                connection_socket, addr = accept_next_connection(selector)
+
+                with connection_socket:
+
+                    # if debug_mode:
+                    #     connection_socket.settimeout(4.0)
+
+                    DebugMode.print(debug_mode, f"socket_server.accept() received a new connection. addr: {addr}")
+
+                    parser = Parser("", debug_mode)
+
+                    smtp_server.set_parser(parser)
+                    smtp_server.start_connection(connection_socket)
+
+                    # Send a greeting message to the newly connected client
+                    smtp_server.evaluate_state()
+
+                    DebugMode.print(debug_mode, "should have sent an initial message to the client by now...")
+
+                    # Text received after the last newline character; this is the beginning of a
+                    # line whose end has not been received yet.
+                    pending_text = ""
+
+                    # The same goes for a UTF-8 character whose bytes are split across two calls to
+                    # recv(): the decoder holds the first bytes until the rest arrive.
+                    decoder = codecs.getincrementaldecoder("utf-8")()
+
+                    try:
+
+                        # This might be better than while True
+                        while socket_is_connected(connection_socket):
+
+                            # https://docs.python.org/3.12/library/socket.html#socket.socket.recv
+                            # The parameter is the maximum amount of data to be received at once
+                            recv_start = time.perf_counter_ns()
+                            bytes_recv = connection_socket.recv(bufsize)
+                            smtp_server.timeline.network_ns += time.perf_counter_ns() - recv_start
+
+                            # A returned empty bytes object indicates that the client has
+                            # disconnected.
+                            if len(bytes_recv) == 0:
+                                DebugMode.print(debug_mode, "0 bytes was received from the client. closing the socket.", DebugMode.WARN)
+                                break
+
+                            smtp_server.metrics.bytes_received += len(bytes_recv)
+
+                            # Reaching this point means we have data from the client
+                            sentence = decoder.decode(bytes_recv)
+
+                            # 2026-03-22: I think it is possible that the client could send more
+                            # than one line at a time, so we should compensate for that possibility.
+                            # A line can also be split across two calls to recv() when the client
+                            # sends the body of a long message, so the last token (which is empty
+                            # if the data ended with "\n") is held until the rest of it arrives.
+                            lines = (pending_text + sentence).split("\n")
+                            pending_text = lines.pop()
+
+                            DebugMode.print(debug_mode, f"data received: {sentence}", DebugMode.WARN)
+                            DebugMode.print(debug_mode, f"# of lines received: {len(lines)}", DebugMode.WARN)
+
+                            for line in lines:
+                                fixed_line = line + "\n"
+
+                                DebugMode.print(debug_mode, f"line of sentence: {fixed_line}", DebugMode.WARN)
+                                parser = Parser(fixed_line, debug_mode)
+                                smtp_server.set_parser(parser)
+                                smtp_server.set_socket(connection_socket)
+
+                                try:
+                                    smtp_server.evaluate_state()
+
+                                except ParserError as e:
+                                    # All errors that should be handled according to the writeup are handled as ParserError
+                                    # objects. All other exceptions are ValueError or some other type. If a ParserError
+                                    # occurrs, the write up says "upon receipt of any erroneous SMTP message you should
+                                    # reset your state machine and return to the state of waiting for a valid MAIL FROM
+                                    # message".
+
+                                    # 2026/04/20 - it does NOT say close the connection, so keep reading
+                                    # lines; the client can RSET or start another message.
+                                    socket_send_msg(connection_socket, str(e))
+                                    smtp_server.metrics.count_error(e.error_no)
+                                    smtp_server.reset()
+
+                                    DebugMode.print(debug_mode, f"ParserError: {e}, input_string: {parser.get_input_line()}", DebugMode.ERROR)
 
                     # break is not needed in any of the exceptions because to reach the exceptions
                     # means that the loop is already broken. A new connection would have to be
@@ -1811,23 +4332,6 @@ def main():
                         close_socket(connection_socket)
                         # print(e)
                         DebugMode.print(debug_mode, f"KeyboardInterrupt (error): {e}", DebugMode.ERROR)
-                    except ParserError as e:
-                        # All errors that should be handled according to the writeup are handled as ParserError
-                        # objects. All other exceptions are ValueError or some other type. If a ParserError
-                        # occurrs, the write up says "upon receipt of any erroneous SMTP message you should
-                        # reset your state machine and return to the state of waiting for a valid MAIL FROM
-                        # message".
-
-                        # 2026/04/20 - it does NOT say close the connection.
-
-                        socket_send_msg(connection_socket, str(e))
-                        # close_socket(connection_socket)
-
-                        input_line = ""
-                        if smtp_server is not None and smtp_server.parser is not None:
-                            input_line = smtp_server.parser.get_input_line()
-
-                        DebugMode.print(debug_mode, f"ParserError: {e}, input_string: {input_line}", DebugMode.ERROR)
                     except OSError as e:
                         # This can be useful for catching errors related to sockets
                         close_socket(connection_socket)
@@ -1841,7 +4345,7 @@ def main():
 
                     # attempt to shut down the connection socket anyway just in case
                     # close_socket(connection_socket)
-                    smtp_server.reset()
+                    smtp_server.end_connection()
 
                     should_close_socket = False
 
@@ -1872,11 +4376,26 @@ def main():
             DebugMode.print(debug_mode, f"General Exception (server_socket): {e}", DebugMode.ERROR)
             should_close_socket = True
 
-        # Attempt to close the server socket just in case
+        # Socket files are not removed by close(), so remove the ones this server created
+        for server_socket in server_sockets:
+            if server_socket.family == socket.AF_UNIX:
+                Path(server_socket.getsockname()).unlink(missing_ok=True)
+
+        # Attempt to close the server sockets just in case
         if should_close_socket:
-            close_socket(server_socket)
+            for server_socket in server_sockets:
+                server_socket.close()
+
         smtp_server.reset()
 
+        # Messages still on the queue are indexed before exiting
+        if smtp_server.mail_indexer is not None:
+            smtp_server.mail_indexer.stop()
+
+        # A compaction that is running is finished before exiting
+        if smtp_server.forward_segments is not None:
+            smtp_server.forward_segments.stop()
+
 
         # 1. Upon starting this program, create a socket and wait for a connection.
         # By simply accepting a connection from a client, the SMTP server will send
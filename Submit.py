@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patrick Lewis for COMP 431 Spring 2026
+HW4: Building an SMTP Client/Server System Using Sockets
+Submit.py
+Hands messages to ClientDaemon.py and exits without waiting for them to be sent. This only
+imports the standard library, so that starting it stays cheap.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+DEFAULT_SUBMIT_SOCKET = f"unix:/tmp/smtp-client-daemon-{os.getuid()}.sock"
+"""
+Must match the default in ClientDaemon.py.
+"""
+
+
+def get_command_line_arguments():
+    """
+    Handles either one message (addresses as options, body on standard input) or a JSON lines file.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Hand messages to ClientDaemon.py")
+
+    arg_parser.add_argument("--socket", action="store", default=DEFAULT_SUBMIT_SOCKET,
+                            help=f"unix:/path the daemon accepts submissions on (default {DEFAULT_SUBMIT_SOCKET})")
+    arg_parser.add_argument("--from", action="store", dest="from_address", help="Sender address")
+    arg_parser.add_argument("--to", action="append", default=[],
+                            help="Recipient address; repeat or separate with commas for more than one")
+    arg_parser.add_argument("--subject", action="store", default="")
+    arg_parser.add_argument("--jsonl", action="store", default=None,
+                            help='Submit every line of this JSON lines file ("-" for standard input) instead')
+
+    args = arg_parser.parse_args()
+
+    if args.jsonl is None and (not args.from_address or not args.to):
+        arg_parser.error("either --jsonl or both --from and --to are required")
+
+    return args
+
+
+def main():
+    """
+    Sends the messages, one JSON object per line, and prints the daemon's answer to each.
+    """
+
+    args = get_command_line_arguments()
+
+    if args.jsonl is not None:
+        with (sys.stdin if args.jsonl == "-" else open(args.jsonl, encoding="utf-8")) as f:
+            lines = [line.strip() for line in f if line.strip()]
+    else:
+        to_addresses = [address.strip() for value in args.to for address in value.split(",")]
+        body = sys.stdin.read().rstrip("\n")
+        lines = [json.dumps({"from": args.from_address, "to": to_addresses, "subject": args.subject, "body": body})]
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as submit_socket:
+        submit_socket.connect(args.socket.removeprefix("unix:"))
+        submit_socket.sendall("".join(line + "\n" for line in lines).encode())
+        submit_socket.shutdown(socket.SHUT_WR)
+
+        with submit_socket.makefile("r", encoding="utf-8") as replies:
+            answers = [reply.rstrip("\n") for reply in replies]
+
+    failed = 0
+    for line_no, answer in enumerate(answers, start=1):
+        if not answer.startswith("250"):
+            failed += 1
+            print(f"message #{line_no}: {answer}")
+
+    if len(answers) < len(lines):
+        failed += len(lines) - len(answers)
+        print("The daemon closed the connection before answering every message.")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()